@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+""" Chunked DHT values.
+
+A large value, such as a signed contract with embedded images, is stored
+as content-addressed chunks, each under the SHA-1 of its contents, plus a
+manifest record under the value's own key listing the chunk keys in order.
+Every node then only stores and relays chunk sized messages, and a
+requester fetches the chunks a few at a time, checking each against its
+key and handing them on in order as they arrive.
+"""
+
+import hashlib
+import logging
+
+import constants
+
+
+def split(value, chunk_size=constants.DHT_CHUNK_SIZE):
+    """ Split a value into chunks if it is large enough to need it
+
+    Chunks are cut on character boundaries so each of them is valid UTF-8
+    text, as values travel in JSON messages.
+
+    @return: The manifest and a list of (chunk key, chunk) pairs, or
+             (None, None) when the value is stored whole
+    @rtype: tuple
+    """
+    if not isinstance(value, basestring) or len(value) <= chunk_size:
+        return None, None
+    try:
+        text = value.decode('utf-8') if isinstance(value, str) else value
+    except UnicodeDecodeError:
+        return None, None
+
+    chunks = []
+    for start in range(0, len(text), chunk_size):
+        chunk = text[start:start + chunk_size].encode('utf-8')
+        chunks.append((hashlib.sha1(chunk).hexdigest(), chunk))
+
+    data = text.encode('utf-8')
+    manifest = {'chunked_value': {'size': len(data),
+                                  'sha1': hashlib.sha1(data).hexdigest(),
+                                  'chunks': [key for key, _ in chunks]}}
+    return manifest, chunks
+
+
+def is_manifest(value):
+    return isinstance(value, dict) and 'chunked_value' in value
+
+
+class Reassembler(object):
+    """ Fetch the chunks of a chunked value and put them back together """
+
+    def __init__(self, manifest, fetch, callback, on_chunk=None,
+                 window=constants.DHT_CHUNK_WINDOW, market_id=None):
+        """
+        @param manifest: The manifest record of the value
+        @type manifest: dict
+
+        @param fetch: Called as C{fetch(key, callback)} to look a chunk up,
+                      e.g. L{DHT.iterativeFindValue}
+        @type fetch: callable
+
+        @param callback: Called once with the whole value; or with True once
+                         every chunk has been handed to C{on_chunk}; or
+                         with None if a chunk is missing or corrupt
+        @type callback: callable
+
+        @param on_chunk: If given, chunks are passed to it in order as they
+                         arrive instead of being kept until the end
+        @type on_chunk: callable
+
+        @param window: Number of chunks fetched at the same time
+        @type window: int
+        """
+        self._log = logging.getLogger('[%s] %s' % (market_id, self.__class__.__name__))
+        self._manifest = manifest['chunked_value']
+        self._keys = self._manifest['chunks']
+        self._fetch = fetch
+        self._callback = callback
+        self._on_chunk = on_chunk
+        self._window = window
+        self._requested = 0  # Chunks looked up so far
+        self._next = 0  # Index of the next chunk to hand on
+        self._early = {}  # index -> chunk, arrived ahead of its turn
+        self._parts = []
+        self._digest = hashlib.sha1()
+        self._size = 0
+        self._draining = False
+        self._done = False
+
+    def start(self):
+        while self._requested < min(self._window, len(self._keys)):
+            self._request()
+        if not self._keys:
+            self._finish()
+
+    def _request(self):
+        index = self._requested
+        self._requested += 1
+        self._fetch(self._keys[index], lambda chunk, index=index: self._received(index, chunk))
+
+    def _received(self, index, chunk):
+        if self._done or index < self._next or index in self._early:
+            return
+
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        if not isinstance(chunk, str) or hashlib.sha1(chunk).hexdigest() != self._keys[index]:
+            self._log.error('Chunk %s of %s is missing or corrupt' % (index, self._manifest['sha1']))
+            self._fail()
+            return
+
+        self._early[index] = chunk
+        if self._draining:
+            # A synchronous fetch answered from inside the loop below, which
+            # picks the chunk up; recursing here would finish more than once
+            return
+
+        self._draining = True
+        try:
+            while not self._done and self._next in self._early:
+                chunk = self._early.pop(self._next)
+                self._next += 1
+                self._digest.update(chunk)
+                self._size += len(chunk)
+                if self._on_chunk is not None:
+                    self._on_chunk(chunk)
+                else:
+                    self._parts.append(chunk)
+                if self._requested < len(self._keys):
+                    self._request()
+        finally:
+            self._draining = False
+
+        if self._next == len(self._keys):
+            self._finish()
+
+    def _finish(self):
+        if self._done:
+            return
+        if self._digest.hexdigest() != self._manifest['sha1'] or self._size != self._manifest['size']:
+            self._log.error('Chunked value %s does not match its manifest' % self._manifest['sha1'])
+            self._fail()
+            return
+        self._done = True
+        self._callback(''.join(self._parts) if self._on_chunk is None else True)
+
+    def _fail(self):
+        self._done = True
+        self._early.clear()
+        self._callback(None)
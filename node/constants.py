@@ -26,8 +26,90 @@ dataExpireTimeout = 86400  # 24 hours
 # or whether any data needs to be republished (in seconds)
 checkRefreshInterval = refreshTimeout / 5
 
+# A contact that failed to answer this many RPCs in a row is replaced by one
+# from its k-bucket's replacement cache
+maxFailedRPCs = 3
+
+# Maximum number of contacts kept per k-bucket to replace stale ones with
+replacementCacheSize = k
+
+# Searches still running after this long are ended with the closest nodes found so far (in seconds)
+searchTimeout = 30
+
+# The interval in which the node looks for searches that have timed out (in seconds)
+searchReapInterval = 10
+
+# Number of peer connections kept open for reuse; sending to any other contact
+# makes a new one, closing the least recently used
+connectionPoolSize = 4 * k
+
+# A stored key is checked for republishing, replication or expiry at most this often (in seconds)
+republishCheckInterval = 60 * 60
+
+# Maximum number of due keys the republish scheduler handles per IOLoop tick
+republishSliceSize = 50
+
+# Maximum number of republish/replicate stores sent per second
+republishRate = 10
+
 # Max size of a single UDP datagram, in bytes. If a message is larger than this, it will
 # be spread accross several UDP packets.
 udpDatagramMaxSize = 8192  # 8 KB
 
 DB_PATH = "db/ob.db"
+
+# Number of long-lived database connections kept open (one per thread)
+DB_POOL_SIZE = 5
+
+# Number of prepared statements cached by each database connection
+DB_STATEMENT_CACHE_SIZE = 100
+
+# Default PRAGMA preset for database connections, see db_store.PRAGMA_PROFILES
+DB_PRAGMA_PROFILE = 'throughput'
+
+# Number of rows fetched at a time when streaming a table
+DB_CHUNK_SIZE = 100
+
+# Largest number of ? parameters put in one statement; SQLite builds
+# default to a limit of 999
+DB_MAX_VARIABLES = 500
+
+# Number of threads serving asynchronous database reads
+DB_READER_THREADS = 2
+
+# Queued DHT/peer writes are flushed once this many rows are pending...
+DB_WRITE_BATCH_SIZE = 200
+
+# ...or this many seconds after the first of them was queued
+DB_WRITE_FLUSH_INTERVAL = 0.5
+
+# New writes are refused once this many queued rows are waiting on the
+# database, so a slow disk can't stall the IOLoop
+DB_WRITE_MAX_IN_FLIGHT = 2000
+
+# A write-behind batch that fails is retried this many times, waiting a
+# little longer each time, before its rows are dropped
+DB_WRITE_RETRIES = 3
+
+# DHT values larger than this many bytes are stored zlib compressed
+DHT_VALUE_COMPRESS_THRESHOLD = 1024
+
+# String DHT values longer than this are split into content-addressed chunks
+# of this size, each stored under its own SHA-1, plus a manifest record
+DHT_CHUNK_SIZE = 16 * 1024
+
+# Number of chunks of a chunked value fetched at the same time
+DHT_CHUNK_WINDOW = alpha
+
+# Total size of the decoded DHT values kept in memory, in bytes
+DHT_VALUE_CACHE_BYTES = 16 * 1024 * 1024
+
+# Storage quotas for data other nodes store on this one, in bytes of
+# encoded values: in total, per original publisher and per value
+DHT_STORAGE_MAX_BYTES = 64 * 1024 * 1024
+DHT_STORAGE_MAX_PUBLISHER_BYTES = 8 * 1024 * 1024
+DHT_STORAGE_MAX_VALUE_BYTES = 1024 * 1024
+
+# Which data is evicted first when a quota is reached: 'oldest' (by
+# originallyPublished) or 'farthest' (by XOR distance from our GUID)
+DHT_EVICTION_POLICY = 'oldest'
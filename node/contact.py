@@ -1,14 +1,96 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+""" Contacts, and the pooled connections used to send to them.
+
+The routing table, the active peer list and searches keep a small
+L{Contact} record per peer. A L{crypto2crypto.CryptoPeerConnection}, with
+its own ZeroMQ context, is only made when a message is sent to a contact,
+and is then kept in a bounded L{ConnectionPool} for the next message.
+"""
+
+from collections import OrderedDict
+from urlparse import urlparse
+import logging
+import socket
+
+import constants
+
+
+def is_reachable(ip, port, timeout=5):
+    """ Whether a TCP connection to C{ip}:C{port} can be opened """
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect((ip, port))
+        s.close()
+        return True
+    except:
+        return False
+
+
 class Contact(object):
     """ Encapsulation for remote contact
 
     This class contains information on a single remote contact
     """
-    def __init__(self, guid, uri, firstComm=0):
+
+    __slots__ = ('guid', 'ip', 'port', 'pubkey', 'nickname',
+                 'lastSeen', 'rtt', 'failures', '_pool')
+
+    def __init__(self, guid, ip, port, pubkey=None, nickname=None, pool=None):
+        """
+        @param pool: The pool messages to this contact are sent through
+        @type pool: ConnectionPool
+        """
         self.guid = guid
-        self.uri = uri
-        # self._peerConnection = PeerConnection(uri, guid)
-        self.commTime = firstComm
-        self.failedRPCs = 0
+        self.ip = ip
+        self.port = port
+        self.pubkey = pubkey
+        self.nickname = nickname
+        self.lastSeen = 0  # When it was last added to the routing table
+        self.rtt = None  # Round trip time of its last answer to a search, in seconds
+        self.failures = 0  # RPCs it failed to answer in a row
+        self._pool = pool
+
+    @classmethod
+    def fromURI(cls, guid, uri, pubkey=None, nickname=None, pool=None):
+        contact = cls(guid, None, None, pubkey, nickname, pool)
+        contact.uri = uri
+        return contact
+
+    @property
+    def uri(self):
+        return 'tcp://%s:%s' % (self.ip, self.port)
+
+    @uri.setter
+    def uri(self, uri):
+        address = urlparse(uri)
+        self.ip, self.port = address.hostname, address.port
+
+    # The names used by code written against CryptoPeerConnection
+    _guid = property(lambda self: self.guid)
+    _ip = property(lambda self: self.ip)
+    _port = property(lambda self: self.port)
+    _address = property(lambda self: self.uri)
+    _pub = property(lambda self: self.pubkey)
+    _nickname = property(lambda self: self.nickname)
+
+    def toTuple(self):
+        """ The (ip, port, guid, nickname) form of known nodes and search shortlists """
+        return self.ip, self.port, self.guid, self.nickname
+
+    def send(self, data, callback=lambda msg: None):
+        self._pool.connection(self).send(data, callback)
+
+    def check_port(self):
+        return is_reachable(self.ip, self.port)
 
     def __eq__(self, other):
         if isinstance(other, Contact):
@@ -19,12 +101,95 @@ class Contact(object):
             return False
 
     def __ne__(self, other):
-        if isinstance(other, Contact):
-            return self.guid != other.guid
-        elif isinstance(other, str):
-            return self.guid != other
-        else:
-            return True
+        return not self == other
 
     def __str__(self):
         return '<%s.%s object; GUID: %s, URI: %s>' % (self.__module__, self.__class__.__name__, self.guid, self.uri)
+
+    def __repr__(self):
+        return '{ guid: %s, ip: %s, port: %s, pubkey: %s }' % (self.guid, self.ip, self.port, self.pubkey)
+
+
+class ConnectionPool(object):
+    """ Connections to the contacts last sent to, least recently used first """
+
+    def __init__(self, connect, market_id, size=constants.connectionPoolSize):
+        """
+        @param connect: Called with a contact to make a connection to it
+        @type connect: callable
+
+        @param size: Number of connections kept; the least recently used
+                     one is closed to make room for another
+        @type size: int
+        """
+        self._log = logging.getLogger('[%s] %s' % (market_id, self.__class__.__name__))
+        self._connect = connect
+        self._size = size
+        self._connections = OrderedDict()  # GUID -> connection
+
+    def contact(self, guid, uri, pubkey=None, nickname=None):
+        """ A new contact that sends through this pool """
+        return Contact.fromURI(guid, uri, pubkey, nickname, pool=self)
+
+    def adopt(self, connection, contact=None):
+        """ Pool a connection made elsewhere, e.g. for a handshake
+
+        @param contact: The contact to update from the connection; a new
+                        one is made if not given
+        @type contact: Contact
+
+        @return: The contact for the connection
+        @rtype: Contact
+        """
+        if contact is None:
+            contact = self.contact(connection._guid, connection._address)
+        else:
+            contact.uri = connection._address
+        contact.pubkey = connection._pub
+        contact.nickname = connection._nickname
+
+        if contact.guid:
+            replaced = self._connections.pop(contact.guid, None)
+            if replaced is not None and replaced is not connection:
+                replaced.close()
+            self._put(contact.guid, connection)
+        return contact
+
+    def connection(self, contact):
+        """ The pooled connection to C{contact}, made if there is none """
+        if not contact.guid:
+            return self._connect(contact)
+
+        connection = self._connections.pop(contact.guid, None)
+        if connection is not None and connection._address != contact.uri:
+            # The contact moved; the socket is still connected to its old
+            # address
+            self._log.debug('Reconnecting to %s at %s' % (contact.guid, contact.uri))
+            connection.close()
+            connection = None
+
+        if connection is None:
+            connection = self._connect(contact)
+        else:
+            # The contact may have changed keys since
+            connection._pub = contact.pubkey
+            connection._nickname = contact.nickname
+
+        self._put(contact.guid, connection)
+        return connection
+
+    def discard(self, guid):
+        """ Close the pooled connection to a node, if there is one """
+        connection = self._connections.pop(guid, None)
+        if connection is not None:
+            connection.close()
+
+    def _put(self, guid, connection):
+        self._connections[guid] = connection
+        while len(self._connections) > self._size:
+            guid, connection = self._connections.popitem(last=False)
+            self._log.debug('Closing the connection to %s' % guid)
+            connection.close()
+
+    def __len__(self):
+        return len(self._connections)
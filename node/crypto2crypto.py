@@ -1,7 +1,9 @@
+from contact import ConnectionPool, is_reachable
 from dht import DHT
 from p2p import PeerConnection, TransportLayer
 from pprint import pformat
 from protocol import hello_request, hello_response, proto_response_pubkey
+from settings_cache import SettingsCache
 from urlparse import urlparse
 from zmq.eventloop import ioloop
 from zmq.eventloop.ioloop import PeriodicCallback
@@ -12,7 +14,6 @@ import json
 import logging
 import pyelliptic as ec
 import requests
-import socket
 import traceback
 from threading import Thread
 import zlib
@@ -60,9 +61,10 @@ class CryptoPeerConnection(PeerConnection):
                     self._peer_alive = True
 
                     # Add this peer to active peers list
+                    contact = self._transport._dht.contactFor(self)
                     for idx, peer in enumerate(self._transport._dht._activePeers):
-                        if peer._guid == self._guid or peer._address == self._address:
-                            self._transport._dht._activePeers[idx] = self
+                        if peer.guid == self._guid or peer.uri == self._address:
+                            self._transport._dht._activePeers[idx] = contact
                             self._transport._dht.add_peer(self._transport,
                                                           self._address,
                                                           self._pub,
@@ -70,8 +72,8 @@ class CryptoPeerConnection(PeerConnection):
                                                           self._nickname)
                             return
 
-                    self._transport._dht._activePeers.append(self)
-                    self._transport._dht._routingTable.addContact(self)
+                    self._transport._dht._activePeers.append(contact)
+                    self._transport._dht._routingTable.addContact(contact)
 
                     if handshake_cb is not None:
                         handshake_cb()
@@ -89,14 +91,7 @@ class CryptoPeerConnection(PeerConnection):
         return obelisk.EncodeBase58Check('\x0F\x02%s' + guid.decode('hex'))
 
     def check_port(self):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(5)
-            s.connect((self._ip, self._port))
-            s.close()
-            return True
-        except:
-            return False
+        return is_reachable(self._ip, self._port)
 
     def sign(self, data):
         self._log.info('secret %s' % self._transport.settings['secret'])
@@ -173,6 +168,8 @@ class CryptoTransportLayer(TransportLayer):
 
         # Connect to database
         self._db = db
+        self._db.write_behind.register("peers", self.save_peers_to_db)
+        self.settings_cache = SettingsCache(self._db, market_id)
 
         self._bitmessage_api = None
         if (bm_user, bm_pass, bm_port) != (None, None, None):
@@ -189,6 +186,11 @@ class CryptoTransportLayer(TransportLayer):
         # Set up
         self._setup_settings()
 
+        # Connections are made when a contact is first sent to
+        self._connections = ConnectionPool(
+            lambda contact: self.get_crypto_peer(contact.guid, contact.uri, contact.pubkey, contact.nickname),
+            market_id)
+
         self._dht = DHT(self, self._market_id, self.settings, self._db)
 
         # self._myself = ec.ECC(pubkey=self.pubkey.decode('hex'),
@@ -235,24 +237,43 @@ class CryptoTransportLayer(TransportLayer):
             self._log.error('[Requests] error: %s' % e)
 
     def save_peer_to_db(self, peer_tuple):
-        pubkey = peer_tuple[0]
-        uri = peer_tuple[1]
-        guid = peer_tuple[2]
-        nickname = peer_tuple[3]
-
-        # Update query
-        self._db.deleteEntries("peers", {"uri": uri, "guid": guid}, "OR")
-        # if len(results) > 0:
-        #     self._db.updateEntries("peers", {"id": results[0]['id']}, {"market_id": self._market_id, "uri": uri, "pubkey": pubkey, "guid": guid, "nickname": nickname})
-        # else:
-        if guid is not None:
-            self._db.insertEntry("peers", {
-                "uri": uri,
-                "pubkey": pubkey,
-                "guid": guid,
-                "nickname": nickname,
-                "market_id": self._market_id
-            })
+        """ Queue the peer on the write-behind queue; handshakes with the
+        same peer before the next flush are saved once. The peer is not
+        saved while the database is behind; it is saved again on its next
+        handshake.
+        :param peer_tuple: (pubkey, uri, guid, nickname) tuple
+        """
+        self.queue_peers_to_db([peer_tuple])
+
+    def queue_peers_to_db(self, peer_tuples):
+        """ Batch variant of save_peer_to_db, e.g. for the nodes of a
+        findNode response
+        :param peer_tuples: list of (pubkey, uri, guid, nickname) tuples
+        """
+        items = [(guid or uri, (pubkey, uri, guid, nickname)) for pubkey, uri, guid, nickname in peer_tuples]
+        if not self._db.write_behind.putMany("peers", items):
+            self._log.debug('Not saving %d peers; the database is behind' % len(items))
+
+    def save_peers_to_db(self, peer_tuples):
+        """ Replace any previous records of these peers in a single commit
+        :param peer_tuples: list of (pubkey, uri, guid, nickname) tuples
+        """
+        new_peers = {}
+        with self._db.transaction():
+            for pubkey, uri, guid, nickname in peer_tuples:
+                self._db.deleteEntries("peers", {"uri": uri, "guid": guid}, "OR")
+                # Like the delete above, a later tuple replaces earlier ones with the same uri
+                for other in [g for g, peer in new_peers.items() if peer['uri'] == uri]:
+                    del new_peers[other]
+                if guid is not None:
+                    new_peers[guid] = {
+                        "uri": uri,
+                        "pubkey": pubkey,
+                        "guid": guid,
+                        "nickname": nickname,
+                        "market_id": self._market_id
+                    }
+            self._db.insertMany("peers", new_peers.values())
 
     def _connect_to_bitmessage(self, bm_user, bm_pass, bm_port):
         # Get bitmessage going
@@ -328,7 +349,7 @@ class CryptoTransportLayer(TransportLayer):
 
     def _setup_settings(self):
 
-        self.settings = self._db.selectEntries("settings", "market_id = '%s'" % self._market_id)
+        self.settings = self._db.selectEntries("settings", {"market_id": self._market_id})
         if len(self.settings) == 0:
             self.settings = None
             self._db.insertEntry("settings", {"market_id": self._market_id, "welcome": "enable"})
@@ -384,7 +405,7 @@ class CryptoTransportLayer(TransportLayer):
             if self._bitmessage_api is not None:
                 self._generate_new_bitmessage_address()
 
-            self.settings = self._db.selectEntries("settings", "market_id = '%s'" % self._market_id)[0]
+            self.settings = self.settings_cache.row()
 
         self._log.debug('Retrieved Settings: \n%s', pformat(self.settings))
 
@@ -468,11 +489,9 @@ class CryptoTransportLayer(TransportLayer):
             callback('Joined')
 
     def get_past_peers(self):
-        peers = []
-        result = self._db.selectEntries("peers", "market_id = '%s'" % self._market_id)
-        for peer in result:
-            peers.append(peer['uri'])
-        return peers
+        result = self._db.iterEntries("peers", {"market_id": self._market_id},
+                                      select_fields=['uri'])
+        return [peer['uri'] for peer in result]
 
     def search_for_my_node(self):
         print 'Searching for myself'
@@ -533,7 +552,7 @@ class CryptoTransportLayer(TransportLayer):
     def get_profile(self):
         peers = {}
 
-        self.settings = self._db.selectEntries("settings", "market_id = '%s'" % self._market_id)[0]
+        self.settings = self.settings_cache.row()
 
         for uri, peer in self._peers.iteritems():
             if peer._pub:
@@ -605,7 +624,7 @@ class CryptoTransportLayer(TransportLayer):
 
             for peer in self._dht._activePeers:
                 try:
-                    peer = self._dht._routingTable.getContact(peer._guid)
+                    peer = self._dht._routingTable.getContact(peer.guid)
                     data['senderGUID'] = self._guid
                     data['pubkey'] = self.pubkey
 
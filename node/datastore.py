@@ -8,15 +8,43 @@
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
 import UserDict
+import heapq
 import logging
 import ast
 
+import constants
+import value_codec
+from node_id import NodeID
+from value_cache import ValueCache
+
+# Cache miss marker, as None is a valid value
+_MISSING = object()
+
+EVICTION_POLICIES = ('oldest', 'farthest')
+
+
+class DataRecord(object):
+    """ A stored value together with its publishing metadata """
+    __slots__ = ('key', 'value', 'lastPublished', 'originallyPublished',
+                 'originalPublisherID', 'market_id', 'size')
+
+    def __init__(self, key, value, lastPublished, originallyPublished, originalPublisherID, market_id=None,
+                 size=None):
+        self.key = key
+        self.value = value
+        self.lastPublished = lastPublished
+        self.originallyPublished = originallyPublished
+        self.originalPublisherID = originalPublisherID
+        self.market_id = market_id
+        self.size = size  # Encoded size of the value, in bytes
+
 
 class DataStore(UserDict.DictMixin):
     """ Interface for classes implementing physical storage (for data
     published via the "STORE" RPC) for the Kademlia DHT
 
-    @note: This provides an interface for a dict-like object
+    @note: This provides an interface for a dict-like object; every method
+           takes and returns keys in the same (hex-encoded) form
     """
     def keys(self):
         """ Return a list of the keys in this data store """
@@ -39,6 +67,21 @@ class DataStore(UserDict.DictMixin):
         """ Get the time the C{(key, value)} pair identified by C{key}
         was originally published """
 
+    def getRecord(self, key, value=True):
+        """ Get the value and all the metadata of C{key} at once
+
+        @param value: Whether to fill in the value; pass False when only
+                      the metadata is needed
+        @return: A L{DataRecord}, or None if C{key} is not stored
+        """
+
+    def iterRecords(self, values=True):
+        """ Iterate over the L{DataRecord}s of all the stored keys
+
+        @param values: Whether to fill in the values; pass False when only
+                       the metadata is needed
+        """
+
     def setItem(self, key, value, lastPublished, originallyPublished, originalPublisherID, market_id):
         """ Set the value of the (key, value) pair identified by C{key};
         this should set the "last published" value for the (key, value)
@@ -59,10 +102,15 @@ class DataStore(UserDict.DictMixin):
 
 class DictDataStore(DataStore):
     """ A datastore using an in-memory Python dictionary """
-    def __init__(self):
+    def __init__(self, cache=None):
+        """
+        @param cache: An optional L{ValueCache} reads go through, e.g. to
+                      test it without a database
+        """
         # Dictionary format:
         # { <key>: (<value>, <lastPublished>, <originallyPublished> <originalPublisherID>) }
         self._dict = {}
+        self._cache = cache
         self._log = logging.getLogger(self.__class__.__name__)
 
     def keys(self):
@@ -90,6 +138,14 @@ class DictDataStore(DataStore):
         was originally published """
         return self._dict[key][2]
 
+    def getRecord(self, key, value=True):
+        if key in self._dict:
+            return DataRecord(key, *self._dict[key])
+
+    def iterRecords(self, values=True):
+        for key, entry in self._dict.items():
+            yield DataRecord(key, *entry)
+
     def setItem(self, key, value, lastPublished, originallyPublished, originalPublisherID, market_id):
         """ Set the value of the (key, value) pair identified by C{key};
         this should set the "last published" value for the (key, value)
@@ -97,14 +153,25 @@ class DictDataStore(DataStore):
         """
         print 'Here is the key: %s' % key
         self._dict[key] = (value, lastPublished, originallyPublished, originalPublisherID)
+        if self._cache is not None:
+            self._cache.invalidate(key)
 
     def __getitem__(self, key):
         """ Get the value identified by C{key} """
-        return self._dict[key][0]
+        if self._cache is None:
+            return self._dict[key][0]
+
+        value = self._cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._dict[key][0]
+            self._cache.put(key, value)
+        return value
 
     def __delitem__(self, key):
         """ Delete the specified key (and its value) """
         del self._dict[key]
+        if self._cache is not None:
+            self._cache.invalidate(key)
 
 
 class MongoDataStore(DataStore):
@@ -121,7 +188,7 @@ class MongoDataStore(DataStore):
             db_keys = self._db.selectEntries("datastore")
 
             for row in db_keys:
-                keys.append(row['key'].decode('hex'))
+                keys.append(row['key'])
 
         finally:
             # self._log.info('Keys: %s' % keys)
@@ -148,9 +215,28 @@ class MongoDataStore(DataStore):
         was originally published """
         return int(self._dbQuery(key, 'originallyPublished'))
 
+    def getRecord(self, key, value=True):
+        rows = self._db.selectEntries("datastore", {"key": key}, select_fields=self._recordFields(value))
+        if len(rows) != 0:
+            return self._rowToRecord(rows[0])
+
+    def iterRecords(self, values=True):
+        for row in self._db.iterEntries("datastore", select_fields=self._recordFields(values)):
+            yield self._rowToRecord(row)
+
+    def _recordFields(self, value):
+        fields = ['key', 'lastPublished', 'originallyPublished', 'originalPublisherID', 'market_id']
+        return fields + ['value'] if value else fields
+
+    def _rowToRecord(self, row):
+        value = value_codec.decode(row['value']) if 'value' in row.keys() else None
+        return DataRecord(row['key'], value, row['lastPublished'],
+                          row['originallyPublished'], row['originalPublisherID'], row['market_id'])
+
     def setItem(self, key, value, lastPublished, originallyPublished, originalPublisherID, market_id=1):
+        value = buffer(value_codec.encode(value))
 
-        rows = self._db.selectEntries("datastore", "key = '%s' and market_id = '%s'" % (key, market_id))
+        rows = self._db.selectEntries("datastore", {"key": key, "market_id": market_id})
         if len(rows) == 0:
             # FIXME: Wrap text.
             self._db.insertEntry("datastore", {'key': key, 'market_id': market_id, 'key': key, 'value': value, 'lastPublished': lastPublished, 'originallyPublished': originallyPublished, 'originalPublisherID': originalPublisherID, 'market_id': market_id})
@@ -163,47 +249,130 @@ class MongoDataStore(DataStore):
         #     self._cursor.execute('UPDATE data SET value=?, lastPublished=?, originallyPublished=?, originalPublisherID=? WHERE key=?', (buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), lastPublished, originallyPublished, originalPublisherID, encodedKey))
 
     def _dbQuery(self, key, columnName):
-        row = self._db.selectEntries("datastore", "key = '%s'" % key)
+        row = self._db.selectEntries("datastore", {"key": key})
 
         if len(row) != 0:
             value = row[0][columnName]
             try:
                 value = ast.literal_eval(value)
-            except:
+            except (ValueError, SyntaxError):
                 pass
             return value
 
     def __getitem__(self, key):
-        return self._dbQuery(key, 'value')
+        rows = self._db.selectEntries("datastore", {"key": key})
+        if len(rows) != 0:
+            return value_codec.decode(rows[0]['value'])
 
     def __delitem__(self, key):
-        self._db.deleteEntries("datastore", {"key": key.encode("hex")})
+        self._db.deleteEntries("datastore", {"key": key})
 
 
 class SqliteDataStore(DataStore):
     """ Sqlite database-based datastore
+
+    The metadata of every record is kept in memory, indexed by key, and the
+    decoded values of the most used keys are kept in a L{ValueCache}, so a
+    lookup of a hot key never touches the database. The datastore table is
+    the durable copy: the metadata is loaded from it at startup and writes
+    reach it in batches through the database's write-behind queue.
+
+    Data published by other nodes is subject to storage quotas, checked
+    when it is stored: values over C{max_value_bytes} are refused, and
+    when a publisher or the whole store goes over its quota, stored data
+    is evicted according to the eviction policy to make room. Data this
+    node published is never refused or evicted.
     """
-    def __init__(self, db_connection):
+    def __init__(self, db_connection, cache=None, guid=None,
+                 max_bytes=constants.DHT_STORAGE_MAX_BYTES,
+                 max_publisher_bytes=constants.DHT_STORAGE_MAX_PUBLISHER_BYTES,
+                 max_value_bytes=constants.DHT_STORAGE_MAX_VALUE_BYTES,
+                 eviction=constants.DHT_EVICTION_POLICY):
+        """
+        @param cache: The L{ValueCache} holding decoded values; one of
+                      DHT_VALUE_CACHE_BYTES is created by default
+        @param guid: This node's GUID
+        @param max_bytes: Total size of the stored values
+        @param max_publisher_bytes: Total size of the values stored by a
+                                    single original publisher
+        @param max_value_bytes: Size of the largest value accepted
+        @param eviction: 'oldest' evicts the data published longest ago
+                         first, 'farthest' the keys farthest from C{guid}
+        """
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy %s" % eviction)
+
         self._db = db_connection
         self._log = logging.getLogger(self.__class__.__name__)
+        self._cache = cache if cache is not None else ValueCache()
+        self._guid = guid
+        self._guidID = NodeID(guid) if guid else None
+        self._max_bytes = max_bytes
+        self._max_publisher_bytes = max_publisher_bytes
+        self._max_value_bytes = max_value_bytes
+        self._eviction = eviction
+
+        self._queue = self._db.write_behind
+        self._queue.register("datastore", self._writeRows)
+
+        self._records = {}
+        self._bytes = 0
+        self._publisherKeys = {}  # originalPublisherID -> keys it published
+        self._publisherBytes = {}
+        self._evictionHeap = []  # (rank, key); entries not matching a record are stale
+        self._evicted = 0
+        self._rejected = 0
+        for row in self._db.iterEntries("datastore", select_fields=[
+                'key', 'lastPublished', 'originallyPublished', 'originalPublisherID',
+                'market_id', 'length(value) AS size']):
+            self._addRecord(DataRecord(row['key'],
+                                       None,
+                                       row['lastPublished'],
+                                       row['originallyPublished'],
+                                       row['originalPublisherID'],
+                                       row['market_id'],
+                                       row['size'] or 0))
+        self._log.debug('Loaded %d records' % len(self._records))
 
     def keys(self):
         """ Return a list of the keys in this data store """
-        keys = []
-        try:
-            db_keys = self._db.selectEntries("datastore")
-
-            for row in db_keys:
-                keys.append(row['key'].decode('hex'))
-
-        finally:
-            # self._log.info('Keys: %s' % keys)
-            return keys
+        return self._records.keys()
+
+    def getRecord(self, key, value=True):
+        record = self._records.get(key)
+        if record is not None:
+            return self._withValue(record) if value else record
+
+    def iterRecords(self, values=True):
+        # A snapshot, so records can be set or deleted while iterating
+        for record in self._records.values():
+            yield self._withValue(record) if values else record
+
+    def cacheStats(self):
+        """ Return the counters of the value cache """
+        return self._cache.stats()
+
+    def usage(self):
+        """ Return the storage used against the quotas and the number of
+        records evicted and refused so far """
+        return {'bytes': self._bytes,
+                'max_bytes': self._max_bytes,
+                'records': len(self._records),
+                'publishers': len(self._publisherKeys),
+                'max_publisher_bytes': self._max_publisher_bytes,
+                'max_value_bytes': self._max_value_bytes,
+                'eviction': self._eviction,
+                'evicted': self._evicted,
+                'rejected': self._rejected}
+
+    def publisherUsage(self, originalPublisherID):
+        """ Return the size of the values stored for C{originalPublisherID} """
+        return self._publisherBytes.get(originalPublisherID, 0)
 
     def lastPublished(self, key):
         """ Get the time the C{(key, value)} pair identified by C{key}
         was last published """
-        return int(self._dbQuery(key, 'lastPublished'))
+        return int(self._records[key].lastPublished)
 
     def originalPublisherID(self, key):
         """ Get the original publisher of the data's node ID
@@ -214,40 +383,222 @@ class SqliteDataStore(DataStore):
         @return: Return the node ID of the original publisher of the
         C{(key, value)} pair identified by C{key}.
         """
-        return self._dbQuery(key, 'originalPublisherID')
+        record = self._records.get(key)
+        if record is not None:
+            return record.originalPublisherID
 
     def originalPublishTime(self, key):
         """ Get the time the C{(key, value)} pair identified by C{key}
         was originally published """
-        return int(self._dbQuery(key, 'originallyPublished'))
+        return int(self._records[key].originallyPublished)
 
     def setItem(self, key, value, lastPublished, originallyPublished, originalPublisherID, market_id=1):
-
-        rows = self._db.selectEntries("datastore", "key = '%s' and market_id = '%s'" % (key, market_id))
-        if len(rows) == 0:
-            # FIXME: Wrap text.
-            self._db.insertEntry("datastore", {'key': key, 'market_id': market_id, 'key': key, 'value': value, 'lastPublished': lastPublished, 'originallyPublished': originallyPublished, 'originalPublisherID': originalPublisherID, 'market_id': market_id})
+        """ @return: False if the value was refused by the storage quotas """
+        return len(self.setItems([(key, value, lastPublished, originallyPublished, originalPublisherID)],
+                                 market_id)) == 1
+
+    def setItems(self, items, market_id=1):
+        """ Batch variant of C{setItem}. The records are updated in memory
+        right away and queued on the write-behind queue.
+
+        @param items: An iterable of (key, value, lastPublished,
+                      originallyPublished, originalPublisherID) tuples
+        @return: The keys that were stored; the others were refused by
+                 the storage quotas
+        """
+        stored = []
+        evicted = []
+        for key, value, lastPublished, originallyPublished, originalPublisherID in items:
+            stored_value = buffer(value_codec.encode(value))
+            record = DataRecord(key,
+                                None,
+                                lastPublished,
+                                originallyPublished,
+                                originalPublisherID,
+                                market_id,
+                                len(stored_value))
+            # Refuse rather than block the IOLoop while the database is
+            # behind; our own data is queued regardless
+            own = originalPublisherID == self._guid
+            if not own and self._queue.full():
+                self._rejected += 1
+                self._log.debug('Refused %s from %s; the database is behind' % (key, originalPublisherID))
+                continue
+            if not self._makeRoom(record, evicted):
+                self._rejected += 1
+                self._log.debug('Refused %d bytes for %s from %s' % (record.size, key, originalPublisherID))
+                continue
+
+            self._removeRecord(key)
+            self._addRecord(record)
+            stored.append(key)
+            # Write-through; the cache keeps its own copy of the value. The
+            # queue was not full above, or the row is forced, and it only
+            # drains in between, so the row is not refused.
+            self._cache.put(key, value)
+            self._queue.put("datastore", key, {'key': key,
+                                               'value': stored_value,
+                                               'lastPublished': lastPublished,
+                                               'originallyPublished': originallyPublished,
+                                               'originalPublisherID': originalPublisherID,
+                                               'market_id': market_id},
+                            force=own)
+
+        # A key evicted early in the batch may have been stored again since
+        evicted = [key for key in evicted if key not in self._records]
+        if evicted:
+            self._deleteRows(evicted)
+        return stored
+
+    def _addRecord(self, record):
+        self._records[record.key] = record
+        self._bytes += record.size
+        publisher = record.originalPublisherID
+        self._publisherKeys.setdefault(publisher, set()).add(record.key)
+        self._publisherBytes[publisher] = self._publisherBytes.get(publisher, 0) + record.size
+
+        if publisher != self._guid:
+            heapq.heappush(self._evictionHeap, (self._evictionRank(record), record.key))
+            # Replaced and removed records leave stale entries behind
+            if len(self._evictionHeap) > 2 * len(self._records) + 64:
+                self._evictionHeap = [(self._evictionRank(r), r.key) for r in self._records.itervalues()
+                                      if r.originalPublisherID != self._guid]
+                heapq.heapify(self._evictionHeap)
+
+    def _removeRecord(self, key):
+        """ Forget C{key} in memory """
+        record = self._records.pop(key, None)
+        if record is None:
+            return
+        self._bytes -= record.size
+        publisher = record.originalPublisherID
+        keys = self._publisherKeys[publisher]
+        keys.discard(key)
+        if keys:
+            self._publisherBytes[publisher] -= record.size
         else:
-            self._db.updateEntries("datastore", {'key': key, 'market_id': market_id}, {'key': key, 'value': value, 'lastPublished': lastPublished, 'originallyPublished': originallyPublished, 'originalPublisherID': originalPublisherID, 'market_id': market_id})
-
-        # if self._cursor.fetchone() == None:
-        #     self._cursor.execute('INSERT INTO data(key, value, lastPublished, originallyPublished, originalPublisherID) VALUES (?, ?, ?, ?, ?)', (encodedKey, buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), lastPublished, originallyPublished, originalPublisherID))
-        # else:
-        #     self._cursor.execute('UPDATE data SET value=?, lastPublished=?, originallyPublished=?, originalPublisherID=? WHERE key=?', (buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), lastPublished, originallyPublished, originalPublisherID, encodedKey))
-
-    def _dbQuery(self, key, columnName):
-        row = self._db.selectEntries("datastore", "key = '%s'" % key)
-
-        if len(row) != 0:
-            value = row[0][columnName]
-            try:
-                value = ast.literal_eval(value)
-            except:
-                pass
-            return value
+            del self._publisherKeys[publisher]
+            del self._publisherBytes[publisher]
+        self._cache.invalidate(key)
+
+    def _evictionRank(self, record):
+        """ Records with the lowest rank are evicted first """
+        if self._eviction == 'farthest' and self._guid:
+            return -self._guidID.distance(record.key)
+        return int(record.originallyPublished)
+
+    def _makeRoom(self, record, evicted):
+        """ Evict records until C{record} fits in the quotas. Nothing is
+        evicted unless it then fits.
+        @param evicted: The keys evicted are appended to this list
+        @return: False if it can't fit
+        """
+        if record.originalPublisherID == self._guid:
+            return True
+        if record.size > self._max_value_bytes:
+            return False
+
+        previous = self._records.get(record.key)
+        previous_size = previous.size if previous is not None else 0
+        publisher = record.originalPublisherID
+
+        # Room within the publisher's own quota, made at its own expense
+        used = self._publisherBytes.get(publisher, 0)
+        if previous is not None and previous.originalPublisherID == publisher:
+            used -= previous_size
+        planned = []  # Keys to evict, once both quotas are known to be met
+        freed = 0
+        if used + record.size > self._max_publisher_bytes:
+            candidates = sorted((self._records[key] for key in self._publisherKeys.get(publisher, ())
+                                 if key != record.key),
+                                key=self._evictionRank)
+            needed = used + record.size - self._max_publisher_bytes
+            if sum(candidate.size for candidate in candidates) < needed:
+                return False
+            for candidate in candidates:
+                if needed <= 0:
+                    break
+                needed -= candidate.size
+                planned.append(candidate.key)
+                freed += candidate.size
+
+        # Room within the total quota
+        planned_keys = set(planned)
+        popped = []
+        while self._bytes - freed - previous_size + record.size > self._max_bytes and self._evictionHeap:
+            rank, key = heapq.heappop(self._evictionHeap)
+            candidate = self._records.get(key)
+            if candidate is None or candidate.originalPublisherID == self._guid \
+                    or self._evictionRank(candidate) != rank:
+                continue
+            popped.append((rank, key))
+            if key == record.key or key in planned_keys:
+                continue
+            planned.append(key)
+            planned_keys.add(key)
+            freed += candidate.size
+
+        fits = self._bytes - freed - previous_size + record.size <= self._max_bytes
+        for rank, key in popped:
+            if not fits or key not in planned_keys:
+                heapq.heappush(self._evictionHeap, (rank, key))
+        if fits:
+            for key in planned:
+                self._evict(key, evicted)
+        return fits
+
+    def _evict(self, key, evicted):
+        self._removeRecord(key)
+        self._evicted += 1
+        evicted.append(key)
+
+    def _deleteRows(self, keys):
+        for key in keys:
+            self._queue.discard("datastore", key)
+        for start in range(0, len(keys), constants.DB_MAX_VARIABLES):
+            chunk = tuple(keys[start:start + constants.DB_MAX_VARIABLES])
+            self._queue.after_writes(self._db.deleteEntries, "datastore",
+                                     ("key IN (%s)" % ", ".join(["?"] * len(chunk)), chunk))
+
+    def _writeRows(self, rows):
+        # Updated in place, so existing entries keep their id
+        self._db.upsertMany("datastore", rows, ["market_id", "key"])
+
+    def _value(self, record):
+        value = self._cache.get(record.key, _MISSING)
+        if value is _MISSING:
+            # Rows still waiting on the write-behind queue are not in the table yet
+            row = self._queue.get("datastore", record.key)
+            if row is None:
+                row = self._db.selectEntries("datastore", {"key": record.key}, select_fields=['value'])[0]
+            value = value_codec.decode(row['value'])
+            self._cache.put(record.key, value)
+        return value
+
+    def _withValue(self, record):
+        return DataRecord(record.key, self._value(record), record.lastPublished,
+                          record.originallyPublished, record.originalPublisherID,
+                          record.market_id, record.size)
+
+    def __contains__(self, key):
+        return key in self._records
 
     def __getitem__(self, key):
-        return self._dbQuery(key, 'value')
+        record = self._records.get(key)
+        if record is not None:
+            return self._value(record)
 
     def __delitem__(self, key):
-        self._db.deleteEntries("datastore", {"key": key.encode("hex")})
+        self._removeRecord(key)
+        self._deleteRows([key])
+
+    def clear(self):
+        """ Delete every record, in memory and in the database """
+        self._records.clear()
+        self._bytes = 0
+        self._publisherKeys.clear()
+        self._publisherBytes.clear()
+        self._evictionHeap = []
+        self._cache.clear()
+        self._queue.discard("datastore")
+        self._queue.after_writes(self._db.deleteEntries, "datastore")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+import Queue
+import logging
+import sys
+import threading
+
+from tornado.concurrent import Future
+from zmq.eventloop import ioloop
+
+import constants
+
+
+class DbExecutor(object):
+    """ Runs Obdb calls off the IOLoop thread and hands back tornado Futures,
+    so coroutines can C{yield} them instead of blocking every peer and UI
+    socket on a slow query.
+
+    Writes go through a single writer thread, which keeps them in submission
+    order and avoids lock contention between writers. Reads are spread over
+    a pool of reader threads. Each thread has its own pooled Obdb connection.
+    Reads are not ordered against writes: yield a write's Future before
+    submitting a read that has to see it.
+    """
+
+    def __init__(self, db, readers=constants.DB_READER_THREADS, io_loop=None):
+        """
+        @param db: The Obdb instance to run calls against
+        @param readers: Number of reader threads
+        @param io_loop: The IOLoop the Futures are resolved on
+        """
+        self._db = db
+        self._io_loop = io_loop or ioloop.IOLoop.instance()
+        self._log = logging.getLogger(self.__class__.__name__)
+
+        self._write_queue = Queue.Queue()
+        self._read_queue = Queue.Queue()
+        self._threads = [self._start_worker(self._write_queue, 'DB writer')]
+        for i in range(readers):
+            self._threads.append(self._start_worker(self._read_queue, 'DB reader %s' % i))
+
+    def _start_worker(self, queue, name):
+        thread = threading.Thread(target=self._work, args=(queue,), name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _work(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                self._log.exception('Database call %s failed' % fn.__name__)
+                exc_info = sys.exc_info()
+                self._io_loop.add_callback(future.set_exc_info, exc_info)
+            else:
+                self._io_loop.add_callback(future.set_result, result)
+
+    def _submit(self, queue, fn, args, kwargs):
+        future = Future()
+        queue.put((future, fn, args, kwargs))
+        return future
+
+    def submit_read(self, fn, *args, **kwargs):
+        """ Run C{fn} on a reader thread
+        @return: A Future resolved with the return value of C{fn}
+        """
+        return self._submit(self._read_queue, fn, args, kwargs)
+
+    def submit_write(self, fn, *args, **kwargs):
+        """ Run C{fn} on the writer thread, after all previous writes
+        @return: A Future resolved with the return value of C{fn}
+        """
+        return self._submit(self._write_queue, fn, args, kwargs)
+
+    def selectEntries(self, *args, **kwargs):
+        return self.submit_read(self._db.selectEntries, *args, **kwargs)
+
+    def numEntries(self, *args, **kwargs):
+        return self.submit_read(self._db.numEntries, *args, **kwargs)
+
+    def getOrCreate(self, *args, **kwargs):
+        return self.submit_write(self._db.getOrCreate, *args, **kwargs)
+
+    def insertEntry(self, *args, **kwargs):
+        return self.submit_write(self._db.insertEntry, *args, **kwargs)
+
+    def insertMany(self, *args, **kwargs):
+        return self.submit_write(self._db.insertMany, *args, **kwargs)
+
+    def upsertMany(self, *args, **kwargs):
+        return self.submit_write(self._db.upsertMany, *args, **kwargs)
+
+    def updateEntries(self, *args, **kwargs):
+        return self.submit_write(self._db.updateEntries, *args, **kwargs)
+
+    def deleteEntries(self, *args, **kwargs):
+        return self.submit_write(self._db.deleteEntries, *args, **kwargs)
+
+    def shutdown(self):
+        """ Stop the worker threads once the queued calls have run """
+        self._write_queue.put(None)
+        for thread in self._threads[1:]:
+            self._read_queue.put(None)
+        for thread in self._threads:
+            thread.join()
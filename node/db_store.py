@@ -8,36 +8,255 @@
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
 import logging
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from pysqlcipher import dbapi2 as sqlite
 
+import constants
+
+sqlite.register_adapter(bool, int)
+sqlite.register_converter("bool", lambda v: bool(int(v)))
+
+# PRAGMA presets applied to every connection. The SQLCipher settings
+# (kdf_iter, cipher_page_size) are deliberately not part of them: they have
+# to be the ones the database was created with or it can't be decrypted.
+PRAGMA_PROFILES = {
+    # WAL lets readers run alongside the writer; NORMAL only syncs at
+    # checkpoints, which can lose the last transactions on power loss but
+    # never corrupts the database.
+    'throughput': {'journal_mode': 'WAL',
+                   'synchronous': 'NORMAL',
+                   'cache_size': -16000,
+                   'mmap_size': 64 * 1024 * 1024,
+                   'temp_store': 'MEMORY'},
+    # Every commit is synced to disk before it returns.
+    'durability': {'journal_mode': 'WAL',
+                   'synchronous': 'FULL',
+                   'cache_size': -2000,
+                   'mmap_size': 0,
+                   'temp_store': 'DEFAULT'},
+}
+
+CIPHER_PRAGMAS = ('kdf_iter', 'cipher_page_size')
+CONNECTION_PRAGMAS = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store')
+
+# PRAGMA values are formatted into the statement, so only plain words and
+# numbers are accepted
+PRAGMA_VALUE = re.compile(r'^[\w.-]+$')
+
+
+def check_pragma(name, value):
+    """ Raise ValueError unless C{name} is a supported PRAGMA and C{value}
+    is safe to set it to """
+    if name not in CIPHER_PRAGMAS + CONNECTION_PRAGMAS:
+        raise ValueError("Unsupported database PRAGMA: %s" % name)
+    if not PRAGMA_VALUE.match(str(value)):
+        raise ValueError("Invalid value for database PRAGMA %s: %r" % (name, value))
+
+
+def resolve_pragmas(profile=None, overrides=None):
+    """ Build the PRAGMA settings for a connection
+    @param profile: Name of one of the PRAGMA_PROFILES, or None
+    @param overrides: A dictionary of individual PRAGMAs to set on top
+    @return: A dictionary of PRAGMA names and values
+    """
+    if profile is not None and profile not in PRAGMA_PROFILES:
+        raise ValueError("Unknown database profile: %s" % profile)
+    pragmas = dict(PRAGMA_PROFILES.get(profile, {}))
+    pragmas.update(overrides or {})
+    for name, value in pragmas.items():
+        check_pragma(name, value)
+    return pragmas
+
+
+def unlock_db(cur, pragmas=None):
+    """ Decrypt a freshly opened connection and apply the PRAGMA settings
+    @param cur: A cursor of the new connection
+    @param pragmas: A dictionary as returned by resolve_pragmas
+    """
+    pragmas = pragmas or {}
+
+    # Use PRAGMA key to encrypt / decrypt database.
+    cur.execute("PRAGMA key = 'passphrase';")
+
+    # The cipher settings have to follow the key, before the first access
+    for name in CIPHER_PRAGMAS + CONNECTION_PRAGMAS:
+        if name in pragmas:
+            check_pragma(name, pragmas[name])
+            cur.execute("PRAGMA %s = %s" % (name, pragmas[name]))
+
 
 class Obdb():
     """ Interface for db storage. Serves as segregation of the persistence layer
     and the application logic
     """
-    def __init__(self, db_path):
+    def __init__(self, db_path, pool_size=constants.DB_POOL_SIZE, pragmas=None):
+        """
+        @param db_path: Path to the encrypted database file
+        @param pool_size: Maximum number of long-lived connections (one per
+        thread) kept open. Threads beyond this limit fall back to a
+        connection that is opened and closed for every call. Use 0 to
+        disable pooling entirely.
+        @param pragmas: PRAGMA settings applied to every connection, see
+        resolve_pragmas
+        """
         self.db_path = db_path
-        self.con = False
+        self.pool_size = pool_size
+        self.pragmas = pragmas or {}
+        self._local = threading.local()
+        self._pool_lock = threading.Lock()
+        self._pool = {}
+        self._executor = None
+        self._write_behind = None
+        self._listeners = {}
         self._log = logging.getLogger('DB')
 
-    def _connectToDb(self):
-        """ Opens a db connection
+    @property
+    def executor(self):
+        """ The DbExecutor running this instance's calls off the IOLoop
+        thread. It is started on first use.
         """
-        self.con = sqlite.connect(self.db_path, detect_types=sqlite.PARSE_DECLTYPES)
-        sqlite.register_adapter(bool, int)
-        sqlite.register_converter("bool", lambda v: bool(int(v)))
-        self.con.row_factory = self._dictFactory
+        if self._executor is None:
+            from db_executor import DbExecutor
+            self._executor = DbExecutor(self)
+        return self._executor
 
-        # Use PRAGMA key to encrypt / decrypt database.
-        cur = self.con.cursor()
-        cur.execute("PRAGMA key = 'passphrase';")
+    @property
+    def write_behind(self):
+        """ The WriteBehindQueue batching this instance's high-frequency
+        writes. It is created on first use.
+        """
+        if self._write_behind is None:
+            from db_write_behind import WriteBehindQueue
+            self._write_behind = WriteBehindQueue(self)
+        return self._write_behind
 
-    def _disconnectFromDb(self):
+    def addChangeListener(self, table, callback):
+        """ Call C{callback(table)} after every write to C{table}. Writes
+        made inside a transaction() block are reported once it has ended.
+        """
+        self._listeners.setdefault(table, []).append(callback)
+
+    def _changed(self, table):
+        changed = getattr(self._local, 'changed', None)
+        if changed is not None:
+            changed.add(table)
+        else:
+            self._notifyChanged(table)
+
+    def _notifyChanged(self, table):
+        for callback in self._listeners.get(table, ()):
+            callback(table)
+
+    def _connectToDb(self):
+        """ Opens a db connection and unlocks it. This is the expensive part
+        since SQLCipher derives the key on PRAGMA key.
+        """
+        con = sqlite.connect(self.db_path,
+                             detect_types=sqlite.PARSE_DECLTYPES,
+                             check_same_thread=False,
+                             cached_statements=constants.DB_STATEMENT_CACHE_SIZE)
+        con.row_factory = self._dictFactory
+        unlock_db(con.cursor(), self.pragmas)
+        return con
+
+    def _disconnectFromDb(self, con):
         """ Close the db connection
         """
-        if self.con:
-            self.con.close()
-        self.con = False
+        if con:
+            con.close()
+
+    def _acquire(self):
+        """ Returns the connection bound to the calling thread, binding a
+        pooled one if there is room. Returns None if the pool is exhausted.
+        """
+        con = getattr(self._local, 'con', None)
+        if con is not None or not self.pool_size:
+            return con
+
+        current = threading.current_thread()
+        with self._pool_lock:
+            # Take over connections left behind by threads that have exited
+            # (e.g. the short-lived threads spawned by connect_to_peers).
+            for pooled_con, owner in self._pool.items():
+                if not owner.is_alive():
+                    con = pooled_con
+                    break
+            if con is None and len(self._pool) < self.pool_size:
+                con = self._connectToDb()
+            if con is not None:
+                self._pool[con] = current
+        self._local.con = con
+        return con
+
+    @contextmanager
+    def _connection(self):
+        """ Yields a connection inside a transaction for a single operation.
+        Inside a transaction() block the block's connection is reused and
+        nothing is committed until the block ends.
+        """
+        txn = getattr(self._local, 'txn', None)
+        if txn is not None:
+            yield txn
+            return
+
+        con = self._acquire()
+        transient = con is None
+        if transient:
+            con = self._connectToDb()
+        try:
+            with con:
+                yield con
+        finally:
+            if transient:
+                self._disconnectFromDb(con)
+
+    @contextmanager
+    def transaction(self):
+        """ Groups several operations into a single unit of work. Every call
+        made from this thread inside the block shares one connection and is
+        committed once when the block exits, or rolled back if it raises.
+        Nested blocks simply join the outermost one.
+
+            with db.transaction():
+                db.deleteEntries("peers", {"guid": guid})
+                db.insertEntry("peers", peer)
+        """
+        if getattr(self._local, 'txn', None) is not None:
+            yield self
+            return
+
+        changed = self._local.changed = set()
+        try:
+            with self._connection() as con:
+                self._local.txn = con
+                try:
+                    yield self
+                finally:
+                    self._local.txn = None
+        finally:
+            self._local.changed = None
+            for table in changed:
+                self._notifyChanged(table)
+
+    def close(self):
+        """ Flush queued writes, stop the executor and close every pooled
+        connection. The instance can still be used afterwards; connections
+        are reopened on demand.
+        """
+        if self._write_behind is not None:
+            self._write_behind.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        with self._pool_lock:
+            pool, self._pool = self._pool, {}
+        for con in pool:
+            self._disconnectFromDb(con)
+        self._local = threading.local()
 
     def _dictFactory(self, cursor, row):
         """ A factory that allows sqlite to return a dictionary instead of a tuple
@@ -50,159 +269,261 @@ class Obdb():
                 d[col[0]] = row[idx]
         return d
 
+    @staticmethod
+    def _bindValue(value):
+        """ Prepares a Python value to be bound to a statement parameter.
+        Containers are stored by their repr, as they always have been.
+        """
+        if value is None or isinstance(value, (bool, int, long, float, basestring, buffer)):
+            return value
+        return str(value)
+
+    def _whereClause(self, where_clause, operator="AND"):
+        """ Turns a WHERE specification into a clause with ? placeholders and
+        the parameters to bind to it.
+        @param where_clause: A dictionary of column/value pairs, a
+        (clause, params) tuple or a raw SQL string
+        @param operator: The operator joining the pairs of a dictionary
+        @return: A (clause, params) tuple
+        """
+        if isinstance(where_clause, dict):
+            if not where_clause:
+                return "1", ()
+            # Sorted so the same columns always produce the same statement
+            # text and hit the connection's statement cache.
+            columns = sorted(where_clause)
+            clause = (" %s " % operator).join("%s = ?" % column for column in columns)
+            return clause, tuple(self._bindValue(where_clause[column]) for column in columns)
+        if isinstance(where_clause, tuple):
+            clause, params = where_clause
+            return clause, tuple(self._bindValue(value) for value in params)
+        return where_clause, ()
+
     def getOrCreate(self, table, where_clause, data_dict):
         """ This method attempts to grab the record first. If it fails to find it,
         it will create it.
         @param table: The table to search to
-        @param get_where_dict: A dictionary with the WHERE/SET clauses
+        @param where_clause: The WHERE clauses, in any form selectEntries takes
+        @param data_dict: A dictionary with the values of a new record
         """
-        entries = self.selectEntries(table, where_clause)
-        if len(entries) == 0:
-            self.insertEntry(table, data_dict)
-        return self.selectEntries(table, where_clause)[0]
+        with self.transaction():
+            entries = self.selectEntries(table, where_clause)
+            if len(entries) == 0:
+                self.insertEntry(table, data_dict)
+                entries = self.selectEntries(table, where_clause)
+        return entries[0]
 
     def updateEntries(self, table, where_dict, set_dict, operator="AND"):
         """ A wrapper for the SQL UPDATE operation
         @param table: The table to search to
-        @param whereDict: A dictionary with the WHERE clauses
-        @param setDict: A dictionary with the SET clauses
-        """
-
-        self._connectToDb()
-        with self.con:
-            cur = self.con.cursor()
-            first = True
-            for key, value in set_dict.iteritems():
-                key = str(key).replace("'", "''")
-
-                if type(value) == bool:
-                    value = bool(value)
-                else:
-                    value = unicode(value).replace("'", "''")
-
-                if first:
-                    set_part = "%s = '%s'" % (key, value)
-                    first = False
-                else:
-                    set_part = set_part + ", %s = '%s'" % (key, value)
-            first = True
-            for key, value in where_dict.iteritems():
-                key = str(key).replace("'", "''")
-                value = str(value).replace("'", "''")
-                if first:
-                    where_part = "%s = '%s'" % (key, value)
-                    first = False
-                else:
-                    where_part = where_part + "%s %s = '%s'" % (operator, key, value)
-            query = "UPDATE %s SET %s WHERE %s" \
-                    % (table, set_part, where_part)
-            self._log.debug('query: %s' % query)
-            cur.execute(query)
-        self._disconnectFromDb()
+        @param where_dict: The WHERE clauses, in any form selectEntries takes
+        @param set_dict: A dictionary with the SET clauses
+        """
+        columns = sorted(set_dict)
+        set_part = ", ".join("%s = ?" % column for column in columns)
+        where_part, where_params = self._whereClause(where_dict, operator)
+        params = tuple(self._bindValue(set_dict[column]) for column in columns) + where_params
+
+        query = "UPDATE %s SET %s WHERE %s" % (table, set_part, where_part)
+        self._log.debug('query: %s' % query)
+        with self._connection() as con:
+            con.execute(query, params)
+        self._changed(table)
 
     def insertEntry(self, table, update_dict):
         """ A wrapper for the SQL INSERT operation
         @param table: The table to search to
-        @param updateDict: A dictionary with the values to set
-        """
-        self._connectToDb()
-        with self.con:
-            cur = self.con.cursor()
-            first = True
-            for key, value in update_dict.iteritems():
-                key = str(key).replace("'", "''")
-
-                if type(value) == bool:
-                    value = bool(value)
-                else:
-                    value = str(value).replace("'", "''")
-
-                if first:
-                    updatefield_part = "%s" % (key)
-                    setfield_part = "'%s'" % (value)
-                    first = False
-                else:
-                    updatefield_part = updatefield_part + ", %s" % (key)
-                    setfield_part = setfield_part + ", '%s'" % (value)
-            query = "INSERT INTO %s(%s) VALUES(%s)"  \
-                    % (table, updatefield_part, setfield_part)
-            cur.execute(query)
+        @param update_dict: A dictionary with the values to set
+        """
+        columns = sorted(update_dict)
+        query = "INSERT INTO %s(%s) VALUES(%s)" \
+                % (table, ", ".join(columns), ", ".join(["?"] * len(columns)))
+        params = tuple(self._bindValue(update_dict[column]) for column in columns)
+
+        self._log.debug("query: %s " % query)
+        with self._connection() as con:
+            cur = con.execute(query, params)
             lastrowid = cur.lastrowid
-            self._log.debug("query: %s " % query)
-        self._disconnectFromDb()
+        self._changed(table)
         if lastrowid:
             return lastrowid
 
-    def selectEntries(self, table, where_clause="'1'='1'", order_field="id", order="ASC", limit=None, limit_offset=None, select_fields="*"):
+    def insertMany(self, table, rows, on_conflict=None):
+        """ Inserts several records with a single prepared statement and a
+        single commit.
+        @param table: The table to insert into
+        @param rows: An iterable of dictionaries, all with the same keys
+        @param on_conflict: Conflict resolution for UNIQUE constraints, e.g.
+        "IGNORE" to skip rows that exist already. Use upsertMany to update
+        them instead; "REPLACE" deletes the existing record and gives the
+        new one another id
+        @return: The row id of the record written for each row, in order;
+        None for a row that was not written, e.g. skipped by "IGNORE"
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+
+        columns = sorted(rows[0])
+        for row in rows:
+            if sorted(row) != columns:
+                raise ValueError("All rows passed to insertMany must have the same columns")
+
+        query = "INSERT %sINTO %s(%s) VALUES(%s)" \
+                % ("OR %s " % on_conflict if on_conflict else "",
+                   table, ", ".join(columns), ", ".join(["?"] * len(columns)))
+        params = [tuple(self._bindValue(row[column]) for column in columns) for row in rows]
+
+        self._log.debug("query: %s (x%d)" % (query, len(rows)))
+        ids = []
+        with self.transaction():
+            with self._connection() as con:
+                # One cursor keeps the statement prepared across the rows
+                cur = con.cursor()
+                for row_params in params:
+                    cur.execute(query, row_params)
+                    ids.append(cur.lastrowid if cur.rowcount else None)
+            self._changed(table)
+        return ids
+
+    def upsertMany(self, table, rows, key_columns):
+        """ Updates the records matching each row on C{key_columns} and
+        inserts the rows that have no match, all in a single commit. When
+        several rows share a key the last one wins.
+        @param table: The table to write to
+        @param rows: An iterable of dictionaries, all with the same keys
+        @param key_columns: The columns that identify a record
+        @return: The row ids of the written records, one per row passed in
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+
+        columns = sorted(rows[0])
+        key_columns = sorted(key_columns)
+        latest = OrderedDict()
+        keys = []
+        for row in rows:
+            if sorted(row) != columns:
+                raise ValueError("All rows passed to upsertMany must have the same columns")
+            key = tuple(self._bindValue(row[column]) for column in key_columns)
+            latest[key] = row
+            keys.append(key)
+
+        select_query = "SELECT id FROM %s WHERE %s" \
+                       % (table, " AND ".join("%s = ?" % column for column in key_columns))
+        update_query = "UPDATE %s SET %s WHERE id = ?" \
+                       % (table, ", ".join("%s = ?" % column for column in columns))
+
+        ids = {}
+        with self.transaction():
+            with self._connection() as con:
+                for key in latest:
+                    existing = con.execute(select_query, key).fetchone()
+                    if existing:
+                        ids[key] = existing['id']
+
+                params = [tuple(self._bindValue(latest[key][column]) for column in columns) + (row_id,)
+                          for key, row_id in ids.iteritems()]
+                if params:
+                    self._log.debug("query: %s (x%d)" % (update_query, len(params)))
+                    con.executemany(update_query, params)
+                    self._changed(table)
+
+            new_keys = [key for key in latest if key not in ids]
+            ids.update(zip(new_keys, self.insertMany(table, [latest[key] for key in new_keys])))
+
+        return [ids[key] for key in keys]
+
+    def selectEntries(self, table, where_clause="1", order_field="id", order="ASC", limit=None, limit_offset=None, select_fields="*"):
         """ A wrapper for the SQL SELECT operation. It will always return all the
             attributes for the selected rows.
         @param table: The table to search to
-        @param whereDict: A dictionary with the WHERE clauses. If ommited it will
-        return all the rows of the table
+        @param where_clause: A dictionary of column/value pairs, a
+        (clause, params) tuple with ? placeholders or a raw SQL string. If
+        ommited it will return all the rows of the table
         """
-        self._connectToDb()
-        with self.con:
-            cur = self.con.cursor()
+        where_part, params = self._whereClause(where_clause)
 
-            if limit is not None and limit_offset is None:
-                limit_clause = "LIMIT %s" % limit
-            elif limit is not None and limit_offset is not None:
-                limit_clause = "LIMIT %s %s %s" % (limit_offset, ",", limit)
-            else:
-                limit_clause = ""
+        if limit is not None and limit_offset is None:
+            limit_clause = "LIMIT ?"
+            params += (limit,)
+        elif limit is not None and limit_offset is not None:
+            limit_clause = "LIMIT ? OFFSET ?"
+            params += (limit, limit_offset)
+        else:
+            limit_clause = ""
 
-            if select_fields is not "*":
-                columns = ",".join(select_fields)
-            else:
-                columns = "*"
+        if select_fields != "*":
+            columns = ",".join(select_fields)
+        else:
+            columns = "*"
 
-            query = "SELECT %s FROM %s WHERE %s ORDER BY %s %s %s" \
-                    % (columns, table, where_clause, order_field, order, limit_clause)
+        query = "SELECT %s FROM %s WHERE %s ORDER BY %s %s %s" \
+                % (columns, table, where_part, order_field, order, limit_clause)
 
-            print query
-            self._log.debug("query: %s " % query)
-            cur.execute(query)
-            rows = cur.fetchall()
-        self._disconnectFromDb()
+        self._log.debug("query: %s %s" % (query, params))
+        with self._connection() as con:
+            rows = con.execute(query, params).fetchall()
         return rows
 
-    def deleteEntries(self, table, where_dict={"\"1\"": "1"}, operator="AND"):
-        """ A wrapper for the SQL DELETE operation. It will always return all the
-            attributes for the selected rows.
+    def iterEntries(self, table, where_clause="1", order="ASC", select_fields="*", chunk_size=constants.DB_CHUNK_SIZE):
+        """ A streaming variant of selectEntries. Rows are read C{chunk_size}
+        at a time by paging on the id column, so memory use is bounded by the
+        chunk and writes made while iterating don't invalidate the cursor.
+        @param table: The table to search to
+        @param where_clause: The WHERE clauses, in any form selectEntries takes
+        @param order: "ASC" or "DESC", by id
+        @param select_fields: The columns to fetch; id is always included
+        @return: An iterator of sqlite Row objects, indexable by column name
+        """
+        where_part, params = self._whereClause(where_clause)
+
+        if select_fields != "*":
+            columns = ",".join(["id"] + [column for column in select_fields if column != "id"])
+        else:
+            columns = "*"
+
+        if order == "ASC":
+            comparison, last_id = ">", -1
+        else:
+            comparison, last_id = "<", 2 ** 63 - 1
+
+        query = "SELECT %s FROM %s WHERE (%s) AND id %s ? ORDER BY id %s LIMIT ?" \
+                % (columns, table, where_part, comparison, order)
+        self._log.debug("query: %s %s" % (query, params))
+
+        while True:
+            with self._connection() as con:
+                cur = con.cursor()
+                cur.row_factory = sqlite.Row
+                rows = cur.execute(query, params + (last_id, chunk_size)).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1]["id"]
+
+    def deleteEntries(self, table, where_dict=None, operator="AND"):
+        """ A wrapper for the SQL DELETE operation.
         @param table: The table to search to
-        @param whereDict: A dictionary with the WHERE clauses. If ommited it will
-        delete all the rows of the table
-
-        """
-
-        self._connectToDb()
-        with self.con:
-            cur = self.con.cursor()
-            first = True
-            for key, value in where_dict.iteritems():
-                key = str(key).replace("'", "''")
-                value = str(value).replace("'", "''")
-                if first:
-                    where_part = "%s = '%s'" % (key, value)
-                    first = False
-                else:
-                    where_part = where_part + "%s %s = '%s'" % (operator, key, value)
-            query = "DELETE FROM %s WHERE %s" \
-                    % (table, where_part)
-            self._log.debug('Query: %s' % query)
-            cur.execute(query)
-        self._disconnectFromDb()
-
-    def numEntries(self, table, where_clause="'1'='1'"):
-        self._connectToDb()
-        with self.con:
-            cur = self.con.cursor()
-
-            query = "SELECT count(*) as count FROM %s WHERE %s" \
-                    % (table, where_clause)
-            self._log.debug('query: %s' % query)
-            cur.execute(query)
-            rows = cur.fetchall()
-        self._disconnectFromDb()
+        @param where_dict: The WHERE clauses, in any form selectEntries takes.
+        If ommited it will delete all the rows of the table
+        """
+        where_part, params = self._whereClause(where_dict or {}, operator)
+
+        query = "DELETE FROM %s WHERE %s" % (table, where_part)
+        self._log.debug('Query: %s' % query)
+        with self._connection() as con:
+            con.execute(query, params)
+        self._changed(table)
+
+    def numEntries(self, table, where_clause="1"):
+        where_part, params = self._whereClause(where_clause)
+
+        query = "SELECT count(*) as count FROM %s WHERE %s" % (table, where_part)
+        self._log.debug('query: %s' % query)
+        with self._connection() as con:
+            rows = con.execute(query, params).fetchall()
 
         return rows[0]['count']
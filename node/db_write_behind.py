@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from zmq.eventloop import ioloop
+
+import constants
+
+
+class WriteBehindQueue(object):
+    """ Buffers high-frequency writes (DHT stores, peer handshakes) and
+    hands them to the database writer thread in batches, so a flood of
+    messages costs a few commits instead of one fsync each.
+
+    Rows are queued per table under a key; a newer row for the same key
+    replaces the queued one. Each table has a writer callable which
+    receives the list of rows of a batch and runs on the DbExecutor
+    writer thread. Queued and in-flight rows can be read back with
+    C{get} until they have been written.
+    """
+
+    def __init__(self, db,
+                 batch_size=constants.DB_WRITE_BATCH_SIZE,
+                 flush_interval=constants.DB_WRITE_FLUSH_INTERVAL,
+                 max_in_flight=constants.DB_WRITE_MAX_IN_FLIGHT,
+                 retries=constants.DB_WRITE_RETRIES,
+                 io_loop=None):
+        """
+        @param db: The Obdb instance whose executor runs the batches
+        @param batch_size: Number of queued rows that triggers a flush
+        @param flush_interval: Seconds after which queued rows are flushed
+        @param max_in_flight: Number of flushed but unwritten rows at
+                              which C{put} refuses new rows, or blocks
+                              until the writer catches up if asked to
+        @param retries: Number of times a failed batch is retried before
+                        its rows are dropped
+        @param io_loop: The IOLoop running the flush timer
+        """
+        self._db = db
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_in_flight = max_in_flight
+        self._retries = retries
+        self._io_loop = io_loop or ioloop.IOLoop.instance()
+        self._log = logging.getLogger(self.__class__.__name__)
+
+        self._cond = threading.Condition()
+        self._writers = {}
+        self._pending = {}  # table -> OrderedDict of key -> row
+        self._pending_rows = 0
+        self._in_flight = {}  # table -> list of batches handed to the writer
+        self._in_flight_rows = 0
+        self._timer_scheduled = False
+        self._stats = {
+            'queued': 0,
+            'coalesced': 0,
+            'flushes': 0,
+            'flushed_rows': 0,
+            'failed_flushes': 0,
+            'dropped_rows': 0,
+            'refused_rows': 0,
+            'flush_seconds': 0.0,
+            'backpressure_waits': 0,
+            'backpressure_seconds': 0.0,
+        }
+
+    def register(self, table, writer):
+        """ Set the callable that writes a batch of C{table} rows
+        @param writer: Called with a list of rows on the writer thread
+        """
+        self._writers[table] = writer
+
+    def put(self, table, key, row, block=False, force=False):
+        """ Queue C{row} to be written to C{table}, replacing any queued
+        row with the same C{key}
+
+        @param block: Wait for the writer to catch up instead of refusing
+                      the row when too many rows are in flight. Never
+                      block on the IOLoop thread.
+        @param force: Queue the row even when too many rows are in flight,
+                      without waiting; for the few rows that must not be
+                      refused
+        @return: False if the row was refused
+        """
+        return self.putMany(table, [(key, row)], block, force)
+
+    def putMany(self, table, items, block=False, force=False):
+        """ Batch variant of C{put}; the rows are queued or refused together
+
+        @param items: A list of (key, row) pairs
+        @return: False if the rows were refused
+        """
+        with self._cond:
+            if self._in_flight_rows >= self._max_in_flight and not force:
+                if not block:
+                    self._stats['refused_rows'] += len(items)
+                    return False
+                self._stats['backpressure_waits'] += 1
+                start = time.time()
+                while self._in_flight_rows >= self._max_in_flight:
+                    self._cond.wait()
+                self._stats['backpressure_seconds'] += time.time() - start
+
+            pending = self._pending.setdefault(table, OrderedDict())
+            for key, row in items:
+                if key in pending:
+                    self._stats['coalesced'] += 1
+                else:
+                    self._pending_rows += 1
+                pending[key] = row
+                self._stats['queued'] += 1
+
+            full = self._pending_rows >= self._batch_size
+            if not full and not self._timer_scheduled:
+                self._timer_scheduled = True
+                # add_timeout is not thread-safe, add_callback is
+                self._io_loop.add_callback(self._schedule_flush)
+
+        if full:
+            self.flush()
+        return True
+
+    def full(self):
+        """ Whether C{put} would refuse a row right now """
+        with self._cond:
+            return self._in_flight_rows >= self._max_in_flight
+
+    def get(self, table, key, default=None):
+        """ Return the newest unwritten row queued under C{key} """
+        with self._cond:
+            pending = self._pending.get(table)
+            if pending and key in pending:
+                return pending[key]
+            for batch in reversed(self._in_flight.get(table, [])):
+                if key in batch:
+                    return batch[key]
+        return default
+
+    def keys(self, table):
+        """ Return the keys of the unwritten rows of C{table} """
+        with self._cond:
+            keys = set(self._pending.get(table, ()))
+            for batch in self._in_flight.get(table, []):
+                keys.update(batch)
+        return keys
+
+    def discard(self, table, key=None):
+        """ Drop the queued row stored under C{key}, or all the queued rows
+        of C{table} if no key is given. Rows already handed to the writer
+        are still written; delete rows directly with L{after_writes}, so
+        the delete is not undone by them.
+        """
+        with self._cond:
+            pending = self._pending.get(table)
+            if pending:
+                if key is None:
+                    self._pending_rows -= len(pending)
+                    pending.clear()
+                elif key in pending:
+                    self._pending_rows -= 1
+                    del pending[key]
+
+    def after_writes(self, fn, *args, **kwargs):
+        """ Run C{fn} on the writer thread once the batches handed to it so
+        far are written, without waiting for them
+        @return: A Future resolved with the return value of C{fn}
+        """
+        return self._db.executor.submit_write(fn, *args, **kwargs)
+
+    def flush(self):
+        """ Hand all queued rows to the writer thread, one batch per table,
+        without waiting for them to be written """
+        with self._cond:
+            batches = [(table, pending) for table, pending in self._pending.items() if pending]
+            self._pending = {}
+            self._pending_rows = 0
+            for table, batch in batches:
+                self._in_flight.setdefault(table, []).append(batch)
+                self._in_flight_rows += len(batch)
+
+        for table, batch in batches:
+            self._db.executor.submit_write(self._write, table, batch)
+
+    def stats(self):
+        """ Return the flush, refusal and backpressure counters along with the
+        number of rows currently queued and in flight """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = self._pending_rows
+            stats['in_flight'] = self._in_flight_rows
+        return stats
+
+    def _schedule_flush(self):
+        self._io_loop.add_timeout(self._io_loop.time() + self._flush_interval, self._on_timer)
+
+    def _on_timer(self):
+        with self._cond:
+            self._timer_scheduled = False
+        self.flush()
+
+    def _write(self, table, batch):
+        """ Runs on the writer thread. A failed batch is retried here, so it
+        is still written before any batch queued after it.
+        """
+        start = time.time()
+        written = False
+        for attempt in range(self._retries + 1):
+            if attempt:
+                time.sleep(self._flush_interval * attempt)
+            try:
+                self._writers[table](batch.values())
+                written = True
+                break
+            except Exception:
+                self._log.exception('Writing %s %s rows failed (attempt %s of %s)'
+                                    % (len(batch), table, attempt + 1, self._retries + 1))
+                with self._cond:
+                    self._stats['failed_flushes'] += 1
+
+        with self._cond:
+            batches = self._in_flight[table]
+            for i, in_flight in enumerate(batches):
+                if in_flight is batch:
+                    del batches[i]
+                    break
+            self._in_flight_rows -= len(batch)
+            if written:
+                self._stats['flushes'] += 1
+                self._stats['flushed_rows'] += len(batch)
+                self._stats['flush_seconds'] += time.time() - start
+            else:
+                self._log.error('Dropped %s unwritten %s rows' % (len(batch), table))
+                self._stats['dropped_rows'] += len(batch)
+            self._cond.notify_all()
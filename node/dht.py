@@ -1,9 +1,13 @@
+from node_id import NodeID
 from protocol import proto_store
-from urlparse import urlparse
+from republisher import RepublishScheduler
+from tornado import ioloop
+import bisect
+import chunked_value
 import constants
 import datastore
 import hashlib
-import json
+import index_set
 import logging
 import os
 import routingtable
@@ -11,23 +15,27 @@ import time
 
 
 class DHT(object):
-    def __init__(self, transport, market_id, settings, db_connection):
+    def __init__(self, transport, market_id, settings, db_connection, io_loop=None):
 
         self._log = logging.getLogger('[%s] %s' % (market_id,
                                                    self.__class__.__name__))
         self._settings = settings
         self._knownNodes = []
-        self._searches = []
+        self._searches = {}  # findID -> DHTSearch
+        self._reaper = None
         self._search_keys = {}
         self._activePeers = []
         self._republishThreads = []
         self._transport = transport
         self._market_id = market_id
+        self._io_loop = io_loop or ioloop.IOLoop.instance()
 
         # Routing table
         self._routingTable = routingtable.OptimizedTreeRoutingTable(
             self._settings['guid'], market_id)
-        self._dataStore = datastore.SqliteDataStore(db_connection)
+        self._dataStore = datastore.SqliteDataStore(db_connection, guid=self._settings['guid'])
+        self._republisher = RepublishScheduler(self._dataStore, self._settings['guid'],
+                                               self._republishStore, market_id)
 
     def getActivePeers(self):
         return self._activePeers
@@ -57,14 +65,14 @@ class DHT(object):
     def find_active_peer(self, uri, pubkey=None, guid=None, nickname=None):
         found_peer = False
         for idx, peer in enumerate(self._activePeers):
-            if (guid, uri, pubkey, nickname) == (peer._guid, peer._address, peer._pub, peer._nickname):
+            if (guid, uri, pubkey, nickname) == (peer.guid, peer.uri, peer.pubkey, peer.nickname):
                 found_peer = peer
         return found_peer
 
     def remove_active_peer(self, uri):
         for idx, peer in enumerate(self._activePeers):
-            if uri == peer._address:
-                self._activePeers[idx].cleanup_context()
+            if uri == peer.uri:
+                self._transport._connections.discard(peer.guid)
                 del self._activePeers[idx]
 
     def add_seed(self, transport, uri):
@@ -73,18 +81,18 @@ class DHT(object):
         self._log.debug(new_peer)
 
         def start_handshake_cb():
-            self._knownNodes.append((urlparse(uri).hostname,
-                                     urlparse(uri).port,
-                                     new_peer._guid))
+            self.add_known_node(self.contactFor(new_peer).toTuple())
             self._log.debug('Known Nodes: %s' % self._knownNodes)
 
         new_peer.start_handshake(start_handshake_cb)
 
-    def add_peer(self, transport, uri, pubkey=None, guid=None, nickname=None):
+    def add_peer(self, transport, uri, pubkey=None, guid=None, nickname=None, save=True):
         """ This takes a tuple (pubkey, URI, guid) and adds it to the active
         peers list if it doesn't already reside there.
 
         :param transport: (CryptoTransportLayer) so we can get a new CryptoPeer
+        :param save: Whether to save a new peer once its handshake is done;
+        pass False if the caller saves it itself
         """
 
         assert(uri)
@@ -93,30 +101,31 @@ class DHT(object):
 
             peer_tuple = (uri, pubkey, guid, nickname)
 
-            for idx, peer in enumerate(self._activePeers):
-
-                active_peer_tuple = (peer._pub, peer._address, peer._guid, peer._nickname)
-
-                if active_peer_tuple == peer_tuple:
+            for peer in self._activePeers:
 
-                    old_peer = self._routingTable.getContact(guid)
+                if (peer.uri, peer.pubkey, peer.guid, peer.nickname) == peer_tuple:
 
-                    if old_peer and (old_peer._address != uri or old_peer._pub != pubkey):
-                        self._routingTable.removeContact(guid)
-                        self._routingTable.addContact(peer)
+                    # Seen again: move it to the tail of its k-bucket
+                    self._routingTable.addContact(peer)
 
                     self._log.info('Already in active peer list')
                     return
                 else:
-                    if peer._guid == guid or peer._address == uri:
+                    if peer.guid == guid or peer.uri == uri:
                         self._log.debug('Partial Match')
+                        if peer.guid != guid:
+                            # The routing table and the connection pool
+                            # know the peer by its GUID, so take it out
+                            # under the old one; it is still alive, so no
+                            # replacement takes its place
+                            self._routingTable.removeContact(peer.guid, replace=False)
+                            self._transport._connections.discard(peer.guid)
+
                         # Update peer
-                        peer._guid = guid
-                        peer._address = uri
-                        peer._pub = pubkey
-                        peer._nickname = nickname
-                        self._activePeers[idx] = peer
-                        self._routingTable.removeContact(guid)
+                        peer.guid = guid
+                        peer.uri = uri
+                        peer.pubkey = pubkey
+                        peer.nickname = nickname
                         self._routingTable.addContact(peer)
 
                         return
@@ -127,10 +136,11 @@ class DHT(object):
 
             def cb():
                 self._log.debug('Back from handshake')
-                self._routingTable.removeContact(new_peer._guid)
-                self._routingTable.addContact(new_peer)
-                self._knownNodes.append((urlparse(uri).hostname, urlparse(uri).port, new_peer._guid))
-                self._transport.save_peer_to_db(peer_tuple)
+                contact = self.contactFor(new_peer)
+                self._routingTable.addContact(contact)
+                self.add_known_node(contact.toTuple())
+                if save:
+                    self._transport.save_peer_to_db((pubkey, uri, guid, nickname))
 
             if new_peer.check_port():
                 new_peer.start_handshake(handshake_cb=cb)
@@ -152,6 +162,20 @@ class DHT(object):
         """
         return self._knownNodes
 
+    def contactFor(self, peer):
+        """ The contact for a connection that has finished its handshake
+
+        The connection is pooled for sending to the peer later, and the
+        contact already known for its GUID, if any, is updated from it.
+
+        :param peer: (CryptoPeerConnection)
+        :return: (Contact)
+        """
+        contact = self._routingTable.getContact(peer._guid)
+        if contact is None:
+            contact = next((active for active in self._activePeers if active.guid == peer._guid), None)
+        return self._transport._connections.adopt(peer, contact)
+
     def on_find_node(self, msg):
         """ When a findNode message is received it will be of several types:
         - findValue: Looking for a specific key-value
@@ -187,7 +211,8 @@ class DHT(object):
         if new_peer is not None:
 
             if msg['findValue'] is True:
-                if key in self._dataStore and self._dataStore[key] is not None:
+                value = self._dataStore[key]
+                if value is not None:
 
                     # Found key in local data store
                     new_peer.send(
@@ -195,7 +220,7 @@ class DHT(object):
                          "senderGUID": self._transport.guid,
                          "uri": self._transport._uri,
                          "pubkey": self._transport.pubkey,
-                         "foundKey": self._dataStore[key],
+                         "foundKey": index_set.public_value(value),
                          "senderNick": self._transport._nickname,
                          "findID": findID})
                 else:
@@ -218,9 +243,10 @@ class DHT(object):
 
                 if foundContact:
                     self._log.info('Found the node')
-                    foundNode = (foundContact._guid,
-                                 foundContact._address,
-                                 foundContact._pub)
+                    foundNode = (foundContact.guid,
+                                 foundContact.uri,
+                                 foundContact.pubkey,
+                                 foundContact.nickname)
                     new_peer.send(
                         {"type": "findNodeResponse",
                          "senderGUID": self._transport.guid,
@@ -243,18 +269,17 @@ class DHT(object):
                          "foundNodes": contacts,
                          "findID": findID})
 
-            if new_peer is None or new_peer._address != uri:
-                new_peer._address = uri
-                self._routingTable.removeContact(new_peer._guid)
+            if new_peer.uri != uri:
+                new_peer.uri = uri
                 self._routingTable.addContact(new_peer)
 
     def close_nodes(self, key, guid):
         contacts = self._routingTable.findCloseNodes(key, constants.k, guid)
         contactTriples = []
         for contact in contacts:
-            contactTriples.append((contact._guid, contact._address, contact._pub, contact._nickname))
+            contactTriples.append((contact.guid, contact.uri, contact.pubkey, contact.nickname))
 
-        return self.dedupe(contactTriples)
+        return contactTriples
 
     def on_findNodeResponse(self, transport, msg):
 
@@ -264,100 +289,44 @@ class DHT(object):
         # localPeer = next((peer for peer in self._activePeers if peer._guid == msg['senderGUID']), None)
 
         # Update existing peer's pubkey if active peer
-        for idx, peer in enumerate(self._activePeers):
-            if peer._guid == msg['senderGUID']:
-                peer._nickname = msg['senderNick']
-                peer._pub = msg['pubkey']
-                self._activePeers[idx] = peer
+        for peer in self._activePeers:
+            if peer.guid == msg['senderGUID']:
+                peer.nickname = msg['senderNick']
+                peer.pubkey = msg['pubkey']
+
+        if 'foundNode' in msg.keys():
+
+            foundNode = msg['foundNode']
+            self._log.debug('Found the node you were looking for: %s' % foundNode)
+
+            # Add foundNode to active peers list and routing table
+            if foundNode[2] != self._transport._guid:
+                self._log.debug('Found a tuple %s' % foundNode)
+                if len(foundNode) == 3:
+                    foundNode.append('')
+                self.add_peer(self._transport, foundNode[1], foundNode[2], foundNode[0], foundNode[3])
+
+        search = self._getSearch(msg['findID'])
+        if search is None:
+            self._log.info('No search found')
+            return
 
         # If key was found by this node then
         if 'foundKey' in msg.keys():
             self._log.debug('Found the key-value pair. Executing callback.')
+            self._finishSearch(search, msg['foundKey'])
 
-            for idx, s in enumerate(self._searches):
-                if s._findID == msg['findID']:
-                    s._callback(msg['foundKey'])
-                    del self._searches[idx]
-                    # self._searches[msg['findID']]._callback(msg['foundKey'])
-
-                    # Remove active search
+        elif 'foundNode' in msg.keys():
+            self._finishSearch(search, (foundNode[2], foundNode[1], foundNode[0], foundNode[3]))
 
         else:
+            self._probeAnswered(search, msg['senderGUID'])
 
-            if 'foundNode' in msg.keys():
-
-                foundNode = msg['foundNode']
-                self._log.debug('Found the node you were looking for: %s' % foundNode)
-
-                # Add foundNode to active peers list and routing table
-                if foundNode[2] != self._transport._guid:
-                    self._log.debug('Found a tuple %s' % foundNode)
-                    if len(foundNode) == 3:
-                        foundNode.append('')
-                    self.add_peer(self._transport, foundNode[1], foundNode[2], foundNode[0], foundNode[3])
-
-                for idx, search in enumerate(self._searches):
-                    if search._findID == msg['findID']:
-
-                        # Execute callback
-                        if search._callback is not None:
-                            search._callback((foundNode[2], foundNode[1], foundNode[0], foundNode[3]))
-
-                        # Clear search
-                        del self._searches[idx]
-
-            else:
-
-                # Add any close nodes found to the shortlist
-                # self.extendShortlist(transport, msg['findID'], msg['foundNodes'])
-
-                foundSearch = False
-                search = ""
-                findID = msg['findID']
-                for s in self._searches:
-                    if s._findID == findID:
-                        search = s
-                        foundSearch = True
-
-                if not foundSearch:
-                    self._log.info('No search found')
-                    return
-                else:
+            # Add any close nodes found to the shortlist
+            foundNodes = [node for node in msg['foundNodes'] if not self._isSelf(node)]
+            self.extendShortlist(transport, msg['findID'], foundNodes)
 
-                    # Get current shortlist length
-                    shortlist_length = len(search._shortlist)
-
-                    # Extends shortlist if necessary
-                    for node in msg['foundNodes']:
-                        self._log.info('FOUND NODE: %s' % node)
-                        if node[0] != self._transport._guid and node[2] != self._transport.pubkey \
-                                and node[1] != self._transport._uri:
-                            self._log.info('Found it %s %s' % (node[0], self._transport.guid))
-                            self.extendShortlist(transport, msg['findID'], [node])
-
-                    # Remove active probe to this node for this findID
-                    search_ip = urlparse(msg['uri']).hostname
-                    search_port = urlparse(msg['uri']).port
-                    search_guid = msg['senderGUID']
-                    search_tuple = (search_ip, search_port, search_guid)
-                    for idx, probe in enumerate(search._active_probes):
-                        if probe == search_tuple:
-                            del search._active_probes[idx]
-                    self._log.debug('Find Node Response - Active Probes After: %s' % search._active_probes)
-
-                    # Add this to already contacted list
-                    if search_tuple not in search._already_contacted:
-                        search._already_contacted.append(search_tuple)
-                    self._log.debug('Already Contacted: %s' % search._already_contacted)
-
-                    # If we added more to shortlist then keep searching
-                    if len(search._shortlist) > shortlist_length:
-                        self._log.info('Lets keep searching')
-                        self._searchIteration(search)
-                    else:
-                        self._log.info('Shortlist is empty')
-                        if search._callback is not None:
-                            search._callback(search._shortlist)
+            self._searchIteration(search)
 
     def _refreshNode(self):
         """ Periodically called to perform k-bucket refreshes and data
@@ -384,86 +353,63 @@ class DHT(object):
         searchForNextNodeID()
 
     def _republishData(self, *args):
-        self._threadedRepublishData()
-
-    def _threadedRepublishData(self, *args):
         """ Republishes and expires any stored data (i.e. stored
-        C{(key, value pairs)} that need to be republished/expired
-
-        This method should run in a deferred thread
-        """
-        self._log.debug('Republishing Data')
-        expiredKeys = []
-
-        for key in self._dataStore.keys():
-
-            # Filter internal variables stored in the data store
-            if key == 'nodeState':
-                continue
-
-            now = int(time.time())
-            key = key.encode('hex')
-            originalPublisherID = self._dataStore.originalPublisherID(key)
-            age = now - self._dataStore.originalPublishTime(key) + 500000
+        C{(key, value pairs)} that need to be republished/expired, as
+        they fall due """
+        self._republisher.start()
+
+    def _republishStore(self, key, value, originalPublisherID, age):
+        self.iterativeStore(self._transport, key, value, originalPublisherID, age)
+
+    def _storeLocally(self, key, value, lastPublished, originallyPublished, originalPublisherID):
+        update = index_set.parse(value, originalPublisherID, lastPublished)
+        if update is not None:
+            index = index_set.IndexSet.from_value(update.field, self._dataStore[key])
+            if not index.merge(update) and key in self._dataStore:
+                return
+            value = index.to_value()
 
-            if originalPublisherID == self._settings['guid']:
-                # This node is the original publisher; it has to republish
-                # the data before it expires (24 hours in basic Kademlia)
-                if age >= constants.dataExpireTimeout:
-                    self.iterativeStore(self._transport, key, self._dataStore[key])
+        if self._dataStore.setItem(key, value, lastPublished, originallyPublished, originalPublisherID,
+                                   market_id=self._market_id):
+            self._republisher.schedule(key)
+        else:
+            self._log.debug('Not storing %s from %s' % (key, originalPublisherID))
 
-            else:
-                # This node needs to replicate the data at set intervals,
-                # until it expires, without changing the metadata associated with it
-                # First, check if the data has expired
-                if age >= constants.dataExpireTimeout:
-                    # This key/value pair has expired (and it has not been republished by the original publishing node
-                    # - remove it
-                    expiredKeys.append(key)
-                elif now - self._dataStore.lastPublished(key) >= constants.replicateInterval:
-                    self.iterativeStore(self._transport, key, self._dataStore[key], originalPublisherID, age)
-
-        for key in expiredKeys:
-            del self._dataStore[key]
+    def _isSelf(self, node):
+        """ Whether a (guid, uri, pubkey, nickname) node tuple is this node """
+        guid, uri, pubkey = node[:3]
+        return guid == self._transport._guid or pubkey == self._transport.pubkey or uri == self._transport._uri
 
     def extendShortlist(self, transport, findID, foundNodes):
 
         self._log.debug('foundNodes: %s' % foundNodes)
 
-        foundSearch = False
-        for s in self._searches:
-            if s._findID == findID:
-                search = s
-                foundSearch = True
-
-        if not foundSearch:
+        search = self._getSearch(findID)
+        if search is None:
             self._log.error('There was no search found for this ID')
             return
 
-        self._log.debug('Short list before: %s' % search._shortlist)
-
+        found_peers = []
         for node in foundNodes:
 
             node_guid, node_uri, node_pubkey, node_nick = node
-            node_ip = urlparse(node_uri).hostname
-            node_port = urlparse(node_uri).port
-
-            # Add to shortlist
-            if (node_ip, node_port, node_guid, node_nick) not in search._shortlist:
-                search.add_to_shortlist([(node_ip, node_port, node_guid, node_nick)])
 
             # Skip ourselves if returned
             if node_guid == self._settings['guid']:
                 continue
 
-            for peer in self._activePeers:
-                if node_guid == peer._guid:
-                    # Already an active peer or it's myself
-                    continue
+            # Add to shortlist
+            contact = self._transport._connections.contact(node_guid, node_uri, node_pubkey, node_nick)
+            search.add_to_shortlist([contact.toTuple()])
+            search._contacts[node_guid] = contact
+
+            self._log.debug('Adding new peer to active peers list: %s' % (node,))
+            self.add_peer(self._transport, node_uri, node_pubkey, node_guid, node_nick, save=False)
+            found_peers.append((node_pubkey, node_uri, node_guid, node_nick))
 
-            if node_guid != self._settings['guid']:
-                self._log.debug('Adding new peer to active peers list: %s' % node)
-                self.add_peer(self._transport, node_uri, node_pubkey, node_guid, node_nick)
+        # Saved together: one write for the k nodes of a response
+        if found_peers:
+            self._transport.queue_peers_to_db(found_peers)
 
         self._log.debug('Short list after: %s' % search._shortlist)
 
@@ -528,6 +474,14 @@ class DHT(object):
         if originalPublisherID is None:
             originalPublisherID = self._transport._guid
 
+        # Large values are stored as chunks, each under its own key, and a
+        # manifest under this one
+        manifest, chunks = chunked_value.split(value_to_store)
+        if manifest is not None:
+            for chunk_key, chunk in chunks:
+                self.iterativeStore(transport, chunk_key, chunk, originalPublisherID, age)
+            value_to_store = manifest
+
         # Find appropriate storage nodes and save key value
         if value_to_store:
             self.iterativeFindNode(key, lambda msg, findKey=key, value=value_to_store,
@@ -539,74 +493,17 @@ class DHT(object):
 
         self._log.debug('Store Key Value: (%s, %s %s)' % (nodes, key, type(value)))
 
-        try:
-
-            value_json = json.loads(value)
-
-            # Add Notary GUID to index
-            if 'notary_index_add' in value_json:
-                existing_index = self._dataStore[key]
-                if existing_index is not None:
-                    if not value_json['notary_index_add'] in existing_index['notaries']:
-                        existing_index['notaries'].append(value_json['notary_index_add'])
-                    value = existing_index
-                else:
-                    value = {'notaries': [value_json['notary_index_add']]}
-                self._log.info('Notaries: %s' % existing_index)
-
-            if 'notary_index_remove' in value_json:
-                existing_index = self._dataStore[key]
-                if existing_index is not None:
-                    if value_json['notary_index_remove'] in existing_index['notaries']:
-                        existing_index['notaries'].remove(value_json['notary_index_remove'])
-                        value = existing_index
-                    else:
-                        return
-                else:
-                    return
-
-            # Add listing to keyword index
-            if 'keyword_index_add' in value_json:
-
-                existing_index = self._dataStore[key]
-
-                if existing_index is not None:
-
-                    if not value_json['keyword_index_add'] in existing_index['listings']:
-                        existing_index['listings'].append(value_json['keyword_index_add'])
-
-                    value = existing_index
-
-                else:
-
-                    value = {'listings': [value_json['keyword_index_add']]}
-
-                self._log.info('keyword %s' % existing_index)
-
-            if 'keyword_index_remove' in value_json:
-
-                existing_index = self._dataStore[key]
-
-                if existing_index is not None:
-
-                    if value_json['keyword_index_remove'] in existing_index['listings']:
-                        existing_index['listings'].remove(value_json['keyword_index_remove'])
-                        value = existing_index
-                    else:
-                        return
-
-                else:
-                    # Not in keyword index anyways
-                    return
-
-        except Exception as e:
-            self._log.debug('Value is not a JSON array: %s' % e)
+        # Index updates are stamped here and sent on as deltas, which the
+        # other nodes merge into their copy of the index
+        update = index_set.parse(value, self._transport.guid, time.time())
+        if update is not None:
+            value = update.to_value()
 
         now = int(time.time())
         originallyPublished = now - age
 
         # Store it in your own node
-        self._dataStore.setItem(key, value, now, originallyPublished, originalPublisherID, market_id=self._market_id)
+        self._storeLocally(key, value, now, originallyPublished, originalPublisherID)
 
         for node in nodes:
 
@@ -637,7 +534,8 @@ class DHT(object):
         originallyPublished = now - age
 
         if value:
-            self._dataStore.setItem(key, value, now, originallyPublished, originalPublisherID, self._market_id)
+            # Queued on the write-behind queue, see SqliteDataStore.setItems
+            self._storeLocally(key, value, now, originallyPublished, originalPublisherID)
         else:
             self._log.info('No value to store')
 
@@ -659,9 +557,9 @@ class DHT(object):
 
         @rtype: str
 
-        @todo: Since the data (value) may be large, passing it around as a buffer
-               (which is the case currently) might not be a good idea... will have
-               to fix this (perhaps use a stream from the Protocol class?)
+        @note: Large values are not passed around whole; L{iterativeStore}
+               splits them into chunks stored under their own keys, see
+               L{chunked_value}
         """
         # Get the sender's ID (if any)
         if '_rpcNodeID' in kwargs:
@@ -678,7 +576,7 @@ class DHT(object):
 
         now = int(time.time())
         originallyPublished = now - age
-        self._dataStore.setItem(key, value, now, originallyPublished, originalPublisherID, market_id=self._market_id)
+        self._storeLocally(key, value, now, originallyPublished, originalPublisherID)
         return 'OK'
 
     def iterativeFindNode(self, key, callback=None):
@@ -701,15 +599,10 @@ class DHT(object):
     def _iterativeFind(self, key, startupShortlist=None, call='findNode', callback=None):
         """
         - Create a new DHTSearch object and add the key and call back to it
-        - Add the search to our search queue (self._searches)
-        - Find out if we're looking for a value or for a node
-        -
-
+        - Seed its shortlist with the k closest nodes we know of
+        - Add the search to our search queue (self._searches) and start it,
+          see L{_searchIteration}
         """
-        # Create a new search object
-        new_search = DHTSearch(self._market_id, key, call, callback=callback)
-        self._searches.append(new_search)
-
         # Determine if we're looking for a node or a key
         findValue = True if call != 'findNode' else False
 
@@ -721,20 +614,17 @@ class DHT(object):
         if not findValue:
             self._log.info('Looking for node in your active connections list')
             for node in self._activePeers:
-                if node._guid == key:
+                if node.guid == key:
                     return [node]
 
-        if startupShortlist == [] or startupShortlist is None:
-
-            # Retrieve closest nodes adn add them to the shortlist for the search
-            closeNodes = self._routingTable.findCloseNodes(key, constants.alpha, self._settings['guid'])
-            shortlist = []
+        # Create a new search object
+        new_search = DHTSearch(self._market_id, key, call, callback=callback)
 
-            for closeNode in closeNodes:
-                shortlist.append((closeNode._ip, closeNode._port, closeNode._guid))
+        if startupShortlist == [] or startupShortlist is None:
 
-            if len(shortlist) > 0:
-                new_search.add_to_shortlist(shortlist)
+            # Retrieve closest nodes and add them to the shortlist for the search
+            closeNodes = self._routingTable.findCloseNodes(key, constants.k, self._settings['guid'])
+            new_search.add_to_shortlist([closeNode.toTuple() for closeNode in closeNodes])
 
             # Refresh the k-bucket for this key
             if key != self._settings['guid']:
@@ -745,144 +635,180 @@ class DHT(object):
                 self._log.info('Out of nodes to search, stopping search')
                 if callback is not None:
                     callback([])
-                else:
-                    return []
+                return []
 
         else:
             # On startup of the server the shortlist is pulled from the DB
             # TODO: Right now this is just hardcoded to be seed URIs but should pull from db
-            new_search._shortlist = startupShortlist
-
-        self._searchIteration(new_search, findValue=findValue)
-
-    def _searchIteration(self, new_search, findValue=False):
-
-        # Update slow nodes count
-        new_search._slowNodeCount[0] = len(new_search._active_probes)
-
-        # Sort shortlist from closest to farthest
-        # self._activePeers.sort(lambda firstContact, secondContact, targetKey=key: cmp(self._routingTable.distance(firstContact._guid, targetKey), self._routingTable.distance(secondContact._guid, targetKey)))
-        # new_search._shortlist.sort(lambda firstContact, secondContact, targetKey=key: cmp(self._routingTable.distance(firstContact._guid, targetKey), self._routingTable.distance(secondContact._guid, targetKey)))
-
-        self._activePeers.sort(lambda firstNode, secondNode, targetKey=new_search._key: cmp(
-            self._routingTable.distance(firstNode._guid, targetKey),
-            self._routingTable.distance(secondNode._guid, targetKey)))
-
-        # while len(self._pendingIterationCalls):
-        # del self._pendingIterationCalls[0]
-
-        # TODO: Put this in the callback
-        # if new_search._key in new_search._find_value_result:
-        # return new_search._find_value_result
-        # elif len(new_search._shortlist) and findValue is False:
-        #
-        # # If you have more k amount of nodes in your shortlist then stop
-        # # or ...
-        # if (len(new_search._shortlist) >= constants.k) or (
-        # new_search._shortlist[0] == new_search._previous_closest_node and len(
-        # new_search._active_probes) ==
-        # new_search._slowNodeCount[0]):
-        # if new_search._callback is not None:
-        # new_search._callback(new_search._shortlist)
-        # return
-
-        # Update closest node
-        if len(self._activePeers):
-            closestPeer = self._activePeers[0]
-            closestPeer_ip = urlparse(closestPeer._address).hostname
-            closestPeer_port = urlparse(closestPeer._address).port
-            new_search._previous_closest_node = (closestPeer_ip, closestPeer_port, closestPeer._guid)
-            self._log.debug('Previous Closest Node %s' % (new_search._previous_closest_node,))
-
-        # Sort short list again
-        if len(new_search._shortlist) > 1:
-            self._log.info('Short List: %s' % new_search._shortlist)
-
-            # Remove dupes
-            new_search._shortlist = self.dedupe(new_search._shortlist)
-
-            new_search._shortlist.sort(lambda firstNode, secondNode, targetKey=new_search._key: cmp(
-                self._routingTable.distance(firstNode[2], targetKey),
-                self._routingTable.distance(secondNode[2], targetKey)))
-
-            new_search._prevShortlistLength = len(new_search._shortlist)
-
-        # See if search was cancelled
-        if not self.activeSearchExists(new_search._findID):
-            self._log.info('Active search does not exist')
-            return
+            new_search.add_to_shortlist(startupShortlist)
 
-        # Send findNodes out to all nodes in the shortlist
-        for node in new_search._shortlist:
-            if node not in new_search._already_contacted:
-                if node[2] != self._transport._guid:
+        self._searches[new_search._findID] = new_search
+        self._scheduleReaper()
+        self._searchIteration(new_search)
 
-                    new_search._active_probes.append(node)
-                    new_search._already_contacted.append(node)
-                    contact = self._routingTable.getContact(node[2])
+    def _searchIteration(self, search):
+        """ Keep up to alpha findNode/findValue RPCs in flight to the
+        closest candidates that have not been queried yet.
 
-                    if contact:
+        Candidates that do not answer within rpcTimeout free their slot and
+        are passed over. The search finishes once the k closest candidates
+        left have all answered, with those candidates as its result.
+        """
+        while not search._finished:
+
+            if search.is_converged():
+                self._log.debug('Search for %s converged' % search._key)
+                self._finishSearch(search, search.result())
+                return
 
-                        msg = {"type": "findNode",
-                               "uri": contact._transport._uri,
-                               "senderGUID": self._transport._guid,
-                               "key": new_search._key,
-                               "findValue": findValue,
-                               "senderNick": self._transport._nickname,
-                               "findID": new_search._findID,
-                               "pubkey": contact._transport.pubkey}
-                        self._log.debug('Sending findNode to: %s %s' % (contact._address, msg))
+            candidates = search.next_to_query()
+            slots = constants.alpha - len(search._active_probes)
+            if not candidates or slots <= 0:
+                return
 
-                        contact.send(msg)
-                        new_search._contactedNow += 1
+            for node in candidates[:slots]:
+                self._probe(search, node)
 
-                    else:
-                        self._log.error('No contact was found for this guid: %s' % node[2])
+    def _probe(self, search, node):
+        guid = node[2]
+        search._already_contacted.add(guid)
 
-            if new_search._contactedNow == constants.alpha:
-                break
+        contact = self._routingTable.getContact(guid) or search._contacts.get(guid)
 
-    def activeSearchExists(self, findID):
+        if contact is None:
+            self._log.error('No contact was found for this guid: %s' % guid)
+            search._failed.add(guid)
+            return
+
+        msg = {"type": "findNode",
+               "uri": self._transport._uri,
+               "senderGUID": self._transport._guid,
+               "key": search._key,
+               "findValue": search._call != 'findNode',
+               "senderNick": self._transport._nickname,
+               "findID": search._findID,
+               "pubkey": self._transport.pubkey}
+        self._log.debug('Sending findNode to: %s %s' % (contact.uri, msg))
+
+        search._active_probes.add(guid)
+        search._sent[guid] = time.time()
+        search._timeouts[guid] = self._io_loop.add_timeout(
+            time.time() + constants.rpcTimeout, lambda: self._probeTimedOut(search, guid))
+        contact.send(msg)
+
+    def _probeTimedOut(self, search, guid):
+        search._timeouts.pop(guid, None)
+        if guid in search._active_probes:
+            self._log.debug('No answer from %s for search %s' % (guid, search._findID))
+            search._active_probes.discard(guid)
+            search._failed.add(guid)
+            self._routingTable.contactFailed(guid)
+            self._searchIteration(search)
+
+    def _probeAnswered(self, search, guid):
+        timeout = search._timeouts.pop(guid, None)
+        if timeout is not None:
+            self._io_loop.remove_timeout(timeout)
+        search._active_probes.discard(guid)
+
+        # A late answer still counts
+        search._failed.discard(guid)
+        search._responded.add(guid)
+
+        # Seen alive: reset its failure count and move it to the tail of its k-bucket
+        contact = self._routingTable.getContact(guid)
+        if contact is not None:
+            if guid in search._sent:
+                contact.rtt = time.time() - search._sent[guid]
+            self._routingTable.addContact(contact)
+
+    def _finishSearch(self, search, result):
+        """ Stop a search, forget it and pass its result to its callback """
+        if search._finished:
+            return
+        search._finished = True
+
+        for timeout in search._timeouts.values():
+            self._io_loop.remove_timeout(timeout)
+        search._timeouts.clear()
+        self._searches.pop(search._findID, None)
+        if not self._searches and self._reaper is not None:
+            self._io_loop.remove_timeout(self._reaper)
+            self._reaper = None
+
+        if search._callback is not None:
+            search._callback(result)
+
+    def _scheduleReaper(self):
+        if self._reaper is None:
+            self._reaper = self._io_loop.add_timeout(time.time() + constants.searchReapInterval,
+                                                     self._reapSearches)
+
+    def _reapSearches(self):
+        """ End the searches that have been running for longer than
+        searchTimeout with the closest nodes they found so far """
+        self._reaper = None
+        expired = time.time() - constants.searchTimeout
+        for search in [s for s in self._searches.values() if s._started < expired]:
+            self._log.info('Search for %s timed out' % search._key)
+            self._finishSearch(search, search.result())
+        if self._searches:
+            self._scheduleReaper()
+
+    def _getSearch(self, findID):
+        return self._searches.get(findID)
 
-        activeSearchExists = False
-        for search in self._searches:
-            if findID == search._findID:
-                return True
-        if not activeSearchExists:
-            return False
+    def activeSearchExists(self, findID):
+        return findID in self._searches
 
-    def iterativeFindValue(self, key, callback=None):
+    def iterativeFindValue(self, key, callback=None, on_chunk=None):
+        """ The Kademlia find value operation
 
+        A chunked value is reassembled before C{callback} gets it, unless
+        C{on_chunk} is given to stream its chunks, see
+        L{chunked_value.Reassembler}.
+        """
         self._log.debug('[Iterative Find Value]')
+        if callback is not None:
+            callback = self._reassembling(callback, on_chunk)
         self._iterativeFind(key, call='findValue', callback=callback)
 
-    @staticmethod
-    def dedupe(lst):
-        seen = set()
-        result = []
-        for item in lst:
-            fs = frozenset(item)
-            if fs not in seen:
-                result.append(item)
-                seen.add(fs)
-        return result
+    def _reassembling(self, callback, on_chunk=None):
+        def found(value):
+            if chunked_value.is_manifest(value):
+                chunked_value.Reassembler(value, self._findChunk, callback, on_chunk,
+                                          market_id=self._market_id).start()
+            else:
+                callback(value)
+        return found
+
+    def _findChunk(self, key, callback):
+        # Chunks are immutable, so a local copy is as good as any
+        chunk = self._dataStore[key]
+        if chunk is not None:
+            callback(chunk)
+        else:
+            self._iterativeFind(key, call='findValue', callback=callback)
 
 
 class DHTSearch(object):
     def __init__(self, market_id, key, call="findNode", callback=None):
         self._key = key  # Key to search for
+        self._keyID = NodeID(key)  # ...parsed once for the distance calculations
         self._call = call  # Either findNode or findValue depending on search
         self._callback = callback  # Callback for when search finishes
-        self._shortlist = []  # List of nodes that are being searched against
-        self._active_probes = []  #
-        self._already_contacted = []  # Nodes are added to this list when they've been sent a findXXX action
-        self._previous_closest_node = None  # This is updated to be the closest node found during search
-        self._find_value_result = {}  # If a findValue search is found this is the value
-        self._pendingIterationCalls = []  #
-        self._slowNodeCount = [0]  #
-        self._contactedNow = 0  # Counter for how many nodes have been contacted
-        self._dhtCallbacks = []  # Callback list
-        self._prevShortlistLength = 0
+        self._shortlist = []  # Candidate nodes, closest to the key first
+        self._distances = []  # Distance to the key of each node in the shortlist
+        self._shortlisted = set()  # GUIDs of the nodes in the shortlist
+        self._contacts = {}  # GUID -> contact, for candidates found during the search
+        self._active_probes = set()  # GUIDs of the nodes with a findXXX action in flight
+        self._already_contacted = set()  # GUIDs are added to this set when they've been sent a findXXX action
+        self._responded = set()  # GUIDs of the nodes that answered
+        self._failed = set()  # GUIDs of the nodes that timed out or could not be reached
+        self._timeouts = {}  # GUID -> IOLoop timeout of the findXXX action in flight to it
+        self._sent = {}  # GUID -> when it was sent a findXXX action
+        self._finished = False
+        self._started = time.time()
 
         self._log = logging.getLogger('[%s] %s' % (market_id,
                                                    self.__class__.__name__))
@@ -894,7 +820,32 @@ class DHTSearch(object):
 
         self._log.debug('Additions: %s' % additions)
         for item in additions:
-            if item not in self._shortlist:
-                self._shortlist.append(item)
+            if item[2] not in self._shortlisted:
+                self._shortlisted.add(item[2])
+                itemDistance = self._keyID.distance(item[2])
+                index = bisect.bisect(self._distances, itemDistance)
+                self._distances.insert(index, itemDistance)
+                self._shortlist.insert(index, item)
 
         self._log.debug('Updated short list: %s' % self._shortlist)
+
+    def closest(self, count=constants.k):
+        """ The closest candidates that have not failed to answer """
+        closest = []
+        for node in self._shortlist:
+            if len(closest) == count:
+                break
+            if node[2] not in self._failed:
+                closest.append(node)
+        return closest
+
+    def result(self):
+        """ The closest candidates that have answered """
+        return [node for node in self.closest() if node[2] in self._responded]
+
+    def next_to_query(self):
+        return [node for node in self.closest() if node[2] not in self._already_contacted]
+
+    def is_converged(self):
+        """ Whether the k closest candidates have all been queried and answered """
+        return not self._active_probes and not self.next_to_query()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+""" Set-valued DHT index records, such as the keyword and notary indexes.
+
+An index is a set that many nodes add to and remove from concurrently. It
+is kept as a last-writer-wins element set: every element carries the
+version stamp of its latest add and of its latest remove, a stamp being a
+C{[timestamp, publisher GUID]} pair, and is in the set unless it was
+removed after it was last added (adds win ties).
+
+Merging keeps the newest stamps, so replicas converge whatever order
+updates arrive in, and an update only needs to carry the elements it
+changes. Stores therefore send a one-element index (a delta) instead of
+the whole list, and the receiving node merges it into its own copy.
+
+Stored values keep the materialised list under the usual field, e.g.
+C{{'listings': [...], 'versions': {...}}}, so readers are unaffected.
+"""
+
+import json
+
+ADD = 'add'
+REMOVE = 'remove'
+
+# Index type (the prefix of its delta operations) -> field holding the elements
+INDEX_FIELDS = {'keyword_index': 'listings', 'notary_index': 'notaries'}
+
+# Elements of an index written before version stamps existed count as
+# added at the beginning of time, so any stamped remove wins over them
+LEGACY_STAMP = [0, '']
+
+
+class IndexSet(object):
+    """ A set of index elements with the version stamps of their adds and removes """
+
+    __slots__ = ('field', 'versions')
+
+    def __init__(self, field, versions=None):
+        """
+        @param field: The value field holding the elements, e.g. 'listings'
+        @type field: str
+
+        @param versions: element -> [add stamp, remove stamp], either may be None
+        @type versions: dict
+        """
+        self.field = field
+        self.versions = versions if versions is not None else {}
+
+    @classmethod
+    def from_value(cls, field, value):
+        """ Read an index from a stored value; anything else is an empty index """
+        versions = {}
+        if isinstance(value, dict):
+            for element in value.get(field) or []:
+                versions[element] = [LEGACY_STAMP, None]
+            for element, (added, removed) in (value.get('versions') or {}).items():
+                versions[element] = [added, removed]
+        return cls(field, versions)
+
+    def apply(self, op, element, stamp):
+        """ Record an add or remove of C{element}
+
+        @return: Whether this changed the index, False for an update that
+                 is older than the one already recorded
+        @rtype: bool
+        """
+        versions = self.versions.get(element) or [None, None]
+        slot = 0 if op == ADD else 1
+        if versions[slot] is not None and versions[slot] >= stamp:
+            return False
+        versions[slot] = stamp
+        self.versions[element] = versions
+        return True
+
+    def merge(self, other):
+        """ Merge another replica of, or a delta to, this index
+
+        @return: Whether this changed the index
+        @rtype: bool
+        """
+        changed = False
+        for element, (added, removed) in other.versions.items():
+            if added is not None:
+                changed = self.apply(ADD, element, added) or changed
+            if removed is not None:
+                changed = self.apply(REMOVE, element, removed) or changed
+        return changed
+
+    def elements(self):
+        """ The elements currently in the set, sorted """
+        return sorted(element for element, (added, removed) in self.versions.items()
+                      if added is not None and (removed is None or added >= removed))
+
+    def to_value(self, versions=True):
+        """ The value to store or send; without versions for plain readers """
+        value = {self.field: self.elements()}
+        if versions:
+            value['versions'] = dict((element, list(stamps))
+                                     for element, stamps in self.versions.items())
+        return value
+
+
+def parse(value, publisher, now):
+    """ Recognise an index update in a value being stored
+
+    Understands delta operations such as C{'{"keyword_index_add": key}'}
+    (stamped with C{now} and C{publisher} unless they carry a stamp), and
+    whole or partial index values, stamped or from before stamps existed.
+
+    @return: The update as an L{IndexSet}, or None if C{value} is not an index
+    @rtype: IndexSet
+    """
+    if isinstance(value, basestring):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    if not isinstance(value, dict):
+        return None
+
+    for index, field in INDEX_FIELDS.items():
+        for op in (ADD, REMOVE):
+            name = '%s_%s' % (index, op)
+            if name in value:
+                update = IndexSet(field)
+                update.apply(op, value[name], value.get('stamp') or [now, publisher])
+                return update
+        if field in value:
+            return IndexSet.from_value(field, value)
+    return None
+
+
+def public_value(value):
+    """ Strip the version stamps from a stored index for lookup responses """
+    for field in INDEX_FIELDS.values():
+        if isinstance(value, dict) and field in value and 'versions' in value:
+            return IndexSet.from_value(field, value).to_value(versions=False)
+    return value
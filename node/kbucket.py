@@ -1,6 +1,8 @@
+from collections import OrderedDict
 import logging
 
 import constants
+from node_id import NodeID
 
 
 class BucketFull(Exception):
@@ -21,7 +23,7 @@ class KBucket(object):
         self.lastAccessed = 0
         self.rangeMin = rangeMin
         self.rangeMax = rangeMax
-        self._contacts = list()
+        self._contacts = OrderedDict()  # GUID -> contact, least recently seen first
 
         self._log = logging.getLogger('[%s] %s' % (market_id, self.__class__.__name__))
 
@@ -34,35 +36,21 @@ class KBucket(object):
                                             already
 
         @param contact: The contact to add
-        @type contact: p2p.PeerConnection
+        @type contact: contact.Contact
         """
-        found = False
-
-        for idx, old_contact in enumerate(self._contacts):
-            if contact._guid == old_contact._guid:
-                found = True
-                foundId = idx
-                break
-
-        if found:
+        if contact.guid in self._contacts:
             # Move the existing contact to the end of the list
             # - using the new contact to allow add-on data (e.g. optimization-specific stuff) to be updated as well
-            del self._contacts[foundId]
-            self._contacts.append(contact)
+            del self._contacts[contact.guid]
+            self._contacts[contact.guid] = contact
         elif len(self._contacts) < constants.k:
-            self._contacts.append(contact)
+            self._contacts[contact.guid] = contact
         else:
             raise BucketFull("No space in bucket to insert contact")
 
     def getContact(self, contactID):
-        """ Get the contact specified node ID"""
-        self._log.debug('[getContact] %s' % contactID)
-        self._log.debug('contacts %s' % self._contacts)
-        for contact in self._contacts:
-            if contact._guid == contactID:
-                self._log.debug('[getContact] Found %s' % contact)
-                return contact
-        self._log.debug('[getContact] No Results')
+        """ Get the contact specified node ID, or None if it is not in this bucket """
+        return self._contacts.get(contactID)
 
     def getContacts(self, count=-1, excludeContact=None):
         """ Returns a list containing up to the first count number of contacts
@@ -78,52 +66,33 @@ class KBucket(object):
         @type excludeContact: kademlia.contact.Contact or str
 
 
-        @raise IndexError: If the number of requested contacts is too large
-
         @return: Return up to the first count number of contacts in a list
                 If no contacts are present an empty is returned
         @rtype: list
         """
-        # Return all contacts in bucket
-        if count <= 0:
-            count = len(self._contacts)
-
-        # Get current contact number
-        currentLen = len(self._contacts)
-
-        # If count greater than k - return only k contacts
-        if count > constants.k:
+        # Return all contacts in bucket, but never more than k
+        if count <= 0 or count > constants.k:
             count = constants.k
 
-        # Check if count value in range and,
-        # if count number of contacts are available
-        if not currentLen:
-            contactList = list()
-
-        # length of list less than requested amount
-        elif currentLen < count:
-            contactList = self._contacts[0:currentLen]
-        # enough contacts in list
-        else:
-            contactList = self._contacts[0:count]
-
-        if excludeContact in contactList:
-            contactList.remove(excludeContact)
+        excludeID = getattr(excludeContact, 'guid', excludeContact)
 
+        contactList = []
+        for guid, contact in self._contacts.iteritems():
+            if len(contactList) == count:
+                break
+            if guid != excludeID:
+                contactList.append(contact)
         return contactList
 
     def removeContact(self, contact):
-        """ Remove given contact from list
+        """ Remove given contact from list; removing a contact that is not
+        in this bucket does nothing
 
         @param contact: The contact to remove, or a string containing the
                         contact's node ID
-        @type contact: kademlia.contact.Contact or str
-
-        @raise ValueError: The specified contact is not in this bucket
+        @type contact: contact.Contact or str
         """
-        self._log.debug('Contacts %s %s' % (contact, self._contacts))
-        self._contacts[:] = [x for x in self._contacts if x._guid != contact]
-        self._log.debug('Contacts %s %s' % (contact, self._contacts))
+        self._contacts.pop(getattr(contact, 'guid', contact), None)
 
     def keyInRange(self, key):
         """ Tests whether the specified key (i.e. node ID) is in the range
@@ -132,15 +101,19 @@ class KBucket(object):
         k-bucket)
 
         @param key: The key to test
-        @type key: str or int
+        @type key: str or int or NodeID
 
         @return: C{True} if the key is in this k-bucket's range, or C{False}
                  if not.
         @rtype: bool
         """
-        if isinstance(key, str):
-            key = long(key.encode('hex'), 32)
+        if not isinstance(key, (int, long)):
+            key = NodeID(key).value
         return self.rangeMin <= key < self.rangeMax
 
+    def head(self):
+        """ The least recently seen contact, or None if the bucket is empty """
+        return next(self._contacts.itervalues(), None)
+
     def __len__(self):
         return len(self._contacts)
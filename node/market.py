@@ -14,6 +14,7 @@ import traceback
 from PIL import Image, ImageOps
 import gnupg
 import tornado
+import tornado.gen
 from zmq.eventloop import ioloop
 
 import constants
@@ -21,7 +22,6 @@ from data_uri import DataURI
 from orders import Orders
 from protocol import proto_page, query_page
 from crypto2crypto import CryptoTransportLayer
-from pybitcointools import *
 
 ioloop.install()
 
@@ -246,11 +246,12 @@ class Market(object):
                                self.settings)
 
     def republish_contracts(self):
-        listings = self._db.selectEntries("contracts")
+        listings = self._db.iterEntries("contracts",
+                                        select_fields=['key', 'signed_contract_body'])
         for listing in listings:
             self._transport._dht.iterativeStore(self._transport,
                                                 listing['key'],
-                                                listing.get('signed_contract_body'),
+                                                listing['signed_contract_body'],
                                                 self._transport._guid)
         self.update_listings_index()
 
@@ -278,7 +279,7 @@ class Market(object):
     def republish_listing(self, msg):
 
         listing_id = msg.get('productID')
-        listing = self._db.selectEntries("products", "id = '%s'" % listing_id)
+        listing = self._db.selectEntries("products", {"id": listing_id})
         if listing:
             listing = listing[0]
         else:
@@ -313,12 +314,10 @@ class Market(object):
         contract_index_key = hashvalue.hexdigest()
 
         # Calculate index of contracts
-        contract_ids = self._db.selectEntries("contracts",
-                                              "market_id = '%s'" %
-                                              self._transport._market_id)
-        my_contracts = []
-        for contract_id in contract_ids:
-            my_contracts.append(contract_id['key'])
+        contract_ids = self._db.iterEntries("contracts",
+                                            {"market_id": self._transport._market_id},
+                                            select_fields=['key'])
+        my_contracts = [contract_id['key'] for contract_id in contract_ids]
 
         self._log.debug('My Contracts: %s' % my_contracts)
 
@@ -346,7 +345,7 @@ class Market(object):
         self.update_listings_index()
 
     def remove_from_keyword_indexes(self, contract_id):
-        contract = self._db.selectEntries("contracts", "id = '%s'" % contract_id)[0]
+        contract = self._db.selectEntries("contracts", {"id": contract_id})[0]
         contract_key = contract['key']
 
         contract = json.loads(contract['contract_body'])
@@ -402,9 +401,24 @@ class Market(object):
 
     def get_contracts(self, page=0):
         self._log.info('Getting contracts for market: %s' % self._transport._market_id)
-        contracts = self._db.selectEntries("contracts", "market_id = '%s'" % self._transport._market_id,
+        contracts = self._db.selectEntries("contracts", {"market_id": self._transport._market_id},
                                            limit=10,
                                            limit_offset=(page * 10))
+        return self._contracts_page(contracts, page, self._db.numEntries("contracts"))
+
+    @tornado.gen.coroutine
+    def get_contracts_async(self, page=0):
+        """ Same as get_contracts, but the queries run on the database executor """
+        self._log.info('Getting contracts for market: %s' % self._transport._market_id)
+        contracts, total_contracts = yield [
+            self._db.executor.selectEntries("contracts", {"market_id": self._transport._market_id},
+                                            limit=10,
+                                            limit_offset=(page * 10)),
+            self._db.executor.numEntries("contracts")
+        ]
+        raise tornado.gen.Return(self._contracts_page(contracts, page, total_contracts))
+
+    def _contracts_page(self, contracts, page, total_contracts):
         my_contracts = []
         for contract in contracts:
             try:
@@ -425,7 +439,7 @@ class Market(object):
                 self._log.error('Problem loading the contract body JSON')
 
         return {"contracts": my_contracts, "page": page,
-                "total_contracts": self._db.numEntries("contracts")}
+                "total_contracts": total_contracts}
 
     # SETTINGS
     def save_settings(self, msg):
@@ -461,25 +475,11 @@ class Market(object):
     def get_settings(self):
 
         self._log.info('Getting settings info for Market %s' % self._transport._market_id)
-        settings = self._db.getOrCreate("settings", "market_id = '%s'" % self._transport._market_id, {"market_id": self._transport._market_id})
-
-        if settings['arbiter'] == 1:
-            settings['arbiter'] = True
-        if settings['notary'] == 1:
-            settings['notary'] = True
+        settings = self._transport.settings_cache.get()
 
-        settings['notaries'] = ast.literal_eval(settings['notaries']) if settings['notaries'] != "" else []
-        settings['trustedArbiters'] = ast.literal_eval(settings['trustedArbiters']) if settings['trustedArbiters'] != "" else []
-        settings['privkey'] = settings['privkey'] if 'secret' in settings else ""
-        settings['btc_pubkey'] = privkey_to_pubkey(settings.get('privkey'))
-        settings['secret'] = settings['secret'] if 'secret' in settings else ""
+        self._log.debug('SETTINGS: %s' % settings)
 
-        self._log.info('SETTINGS: %s' % settings)
-
-        if settings:
-            return settings
-        else:
-            return {}
+        return settings
 
     # PAGE QUERYING
     def query_page(self, find_guid, callback=lambda msg: None):
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+""" Node IDs and keys in the 160-bit Kademlia ID space.
+
+GUIDs and DHT keys travel as 40 character hex strings, while some routing
+code works with raw 20 byte IDs; L{NodeID} reads either, parses it once
+and keeps the integer value, so distances are a single XOR.
+"""
+
+ID_BYTES = 20
+ID_BITS = 8 * ID_BYTES
+
+
+class NodeID(object):
+    """ A node ID or key, with its integer value cached """
+
+    __slots__ = ('_value', '_hex')
+
+    def __init__(self, key):
+        """
+        @param key: A hex string, the usual form; a raw 20 byte string; an
+                    integer; or another NodeID. Other strings are read as
+                    big-endian bytes, like older versions of L{distance} did.
+        @type key: str or int or NodeID
+        """
+        if isinstance(key, NodeID):
+            value = key._value
+        elif isinstance(key, (int, long)):
+            value = long(key)
+        elif not key:
+            value = 0L
+        else:
+            try:
+                if len(key) != 2 * ID_BYTES:
+                    raise ValueError()
+                value = long(key, 16)
+            except ValueError:
+                value = long(key.encode('hex'), 16)
+        self._value = value
+        self._hex = None
+
+    @property
+    def value(self):
+        return self._value
+
+    @property
+    def hex(self):
+        """ The ID as a 40 character hex string """
+        if self._hex is None:
+            self._hex = '%040x' % self._value
+        return self._hex
+
+    def distance(self, other):
+        """ The XOR distance to another ID or key """
+        return self._value ^ toNodeID(other)._value
+
+    def __eq__(self, other):
+        return isinstance(other, NodeID) and self._value == other._value
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._value)
+
+    def __long__(self):
+        return self._value
+
+    def __str__(self):
+        return self.hex
+
+    def __repr__(self):
+        return 'NodeID(%r)' % self.hex
+
+
+def toNodeID(key):
+    """ C{key} as a L{NodeID}, without copying it if it already is one """
+    return key if isinstance(key, NodeID) else NodeID(key)
+
+
+def distance(keyOne, keyTwo):
+    """ The XOR distance between two IDs or keys
+
+    @rtype: long
+    """
+    return toNodeID(keyOne)._value ^ toNodeID(keyTwo)._value
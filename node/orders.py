@@ -10,6 +10,7 @@ import string
 import time
 import urllib
 from pybitcointools import *
+from tornado import gen
 
 
 class Orders(object):
@@ -121,9 +122,19 @@ class Orders(object):
     def get_order(self, order_id, by_buyer_id=False):
 
         if not by_buyer_id:
-            _order = self._db.selectEntries("orders", "order_id = '%s'" % order_id)[0]
+            _order = self._db.selectEntries("orders", {"order_id": order_id})[0]
         else:
-            _order = self._db.selectEntries("orders", "buyer_order_id = '%s'" % order_id)[0]
+            _order = self._db.selectEntries("orders", {"buyer_order_id": order_id})[0]
+        return self._build_order(_order)
+
+    @gen.coroutine
+    def get_order_async(self, order_id, by_buyer_id=False):
+        """ Same as get_order, but the query runs on the database executor """
+        column = "order_id" if not by_buyer_id else "buyer_order_id"
+        _order = (yield self._db.executor.selectEntries("orders", {column: order_id}))[0]
+        raise gen.Return(self._build_order(_order))
+
+    def _build_order(self, _order):
         total_price = 0
 
         offer_data_json = self.get_offer_json(_order['signed_contract_body'], _order['state'])
@@ -181,66 +192,70 @@ class Orders(object):
 
         return order
 
+    def _orders_filter(self, merchant):
+        """ WHERE clause selecting all orders, the orders where we are the
+        merchant (merchant=True) or the ones where we are the buyer """
+        if merchant is None:
+            return {"market_id": self._market_id}
+        elif merchant:
+            return {"market_id": self._market_id, "merchant": self._transport._guid}
+        else:
+            return ("market_id = ? and merchant <> ?", (self._market_id, self._transport._guid))
+
     def get_orders(self, page=0, merchant=None):
 
-        orders = []
+        where_clause = self._orders_filter(merchant)
+        order_ids = self._db.selectEntries(
+            "orders",
+            where_clause,
+            order_field="updated",
+            order="DESC",
+            limit=10,
+            limit_offset=page * 10,
+            select_fields=['order_id']
+        )
+        orders = [self.get_order(result['order_id']) for result in order_ids]
+        total_orders = self._db.numEntries("orders", where_clause)
 
-        if merchant is None:
-            order_ids = self._db.selectEntries(
+        for order in orders:
+            buyer = self._db.selectEntries("peers", {"guid": order['buyer']})
+            if len(buyer) > 0:
+                order['buyer_nickname'] = buyer[0]['nickname']
+            merchant = self._db.selectEntries("peers", {"guid": order['merchant']})
+            if len(merchant) > 0:
+                order['merchant_nickname'] = merchant[0]['nickname']
+
+        return {"total": total_orders, "orders": orders}
+
+    @gen.coroutine
+    def get_orders_async(self, page=0, merchant=None):
+        """ Same as get_orders, but the queries run on the database executor """
+        executor = self._db.executor
+
+        where_clause = self._orders_filter(merchant)
+        order_ids, total_orders = yield [
+            executor.selectEntries(
                 "orders",
-                "market_id = '%s'" % self._market_id,
+                where_clause,
                 order_field="updated",
                 order="DESC",
                 limit=10,
                 limit_offset=page * 10,
                 select_fields=['order_id']
-            )
-            for result in order_ids:
-                order = self.get_order(result['order_id'])
-                orders.append(order)
-
-            total_orders = self._db.numEntries("orders", "market_id = '%s'" % self._market_id)
-        else:
-            if merchant:
-                order_ids = self._db.selectEntries(
-                    "orders",
-                    "market_id = '%s' and merchant = '%s'" % (self._market_id, self._transport._guid),
-                    order_field="updated",
-                    order="DESC",
-                    limit=10,
-                    limit_offset=page * 10,
-                    select_fields=['order_id']
-                )
-                for result in order_ids:
-                    order = self.get_order(result['order_id'])
-                    orders.append(order)
-                total_orders = self._db.numEntries("orders", "market_id = '%s' and merchant = '%s'" % (
-                    self._market_id, self._transport._guid))
-            else:
-                order_ids = self._db.selectEntries("orders", "market_id = '%s' and merchant <> '%s'" % (
-                    self._market_id,
-                    self._transport._guid
-                ),
-                    order_field="updated",
-                    order="DESC", limit=10,
-                    limit_offset=page * 10
-                )
-                for result in order_ids:
-                    order = self.get_order(result['order_id'])
-                    orders.append(order)
-
-                total_orders = self._db.numEntries("orders", "market_id = '%s' and merchant <> '%s'" % (
-                    self._market_id, self._transport._guid))
+            ),
+            executor.numEntries("orders", where_clause)
+        ]
+        orders = yield [self.get_order_async(result['order_id']) for result in order_ids]
 
         for order in orders:
-            buyer = self._db.selectEntries("peers", "guid = '%s'" % order['buyer'])
+            buyer, merchant = yield [executor.selectEntries("peers", {"guid": order['buyer']}),
+                                     executor.selectEntries("peers", {"guid": order['merchant']})]
             if len(buyer) > 0:
                 order['buyer_nickname'] = buyer[0]['nickname']
-            merchant = self._db.selectEntries("peers", "guid = '%s'" % order['merchant'])
             if len(merchant) > 0:
                 order['merchant_nickname'] = merchant[0]['nickname']
 
-        return {"total": total_orders, "orders": orders}
+        raise gen.Return({"total": total_orders, "orders": orders})
 
     # Create a new order
     # def create_order(self, seller, text):
@@ -423,7 +438,7 @@ class Orders(object):
 
         # Save order locally in database
         order_id = random.randint(0, 1000000)
-        while self._db.numEntries("orders", "id = '%s'" % order_id) > 0:
+        while self._db.numEntries("orders", {"id": order_id}) > 0:
             order_id = random.randint(0, 1000000)
 
         seller = self._transport._dht._routingTable.getContact(msg['sellerGUID'])
@@ -433,6 +448,8 @@ class Orders(object):
         buyer['Buyer']['buyer_GUID'] = self._transport._guid
         buyer['Buyer']['buyer_BTC_uncompressed_pubkey'] = msg['btc_pubkey']
         buyer['Buyer']['buyer_pgp'] = self._transport.settings['PGPPubKey']
+        # Routing table contacts are plain records; encrypt with the connection to the seller
+        seller = self._transport._connections.connection(seller)
         buyer['Buyer']['buyer_deliveryaddr'] = seller.encrypt(str(json.dumps(self.get_shipping_address()))).encode(
             'hex')
         buyer['Buyer']['note_for_seller'] = msg['message']
@@ -505,7 +522,7 @@ class Orders(object):
 
         # Generate unique id for this bid
         order_id = random.randint(0, 1000000)
-        while self._db.numEntries("contracts", "id = '%s'" % order_id) > 0:
+        while self._db.numEntries("contracts", {"id": order_id}) > 0:
             order_id = random.randint(0, 1000000)
 
         # Add to contract and sign
@@ -732,7 +749,7 @@ class Orders(object):
             state = 'Waiting for Payment'
 
             merchant_order_id = random.randint(0, 1000000)
-            while self._db.numEntries("orders", "id = '%s'" % order_id) > 0:
+            while self._db.numEntries("orders", {"id": order_id}) > 0:
                 merchant_order_id = random.randint(0, 1000000)
 
             buyer_id = str(bid_data_json['Buyer']['buyer_GUID']) + '-' + str(bid_data_json['Buyer']['buyer_order_id'])
@@ -25,6 +25,9 @@ class PeerConnection(object):
             '[%s] %s' % (self._transport._market_id, self.__class__.__name__)
         )
         self._ctx = zmq.Context()
+        self._streams = set()  # Sends waiting on a reply
+        self._closing = False
+        self._close_timeout = None
 
     def create_socket(self):
         self._log.info('Creating Socket')
@@ -34,8 +37,21 @@ class PeerConnection(object):
         return socket
 
     def cleanup_context(self):
+        if self._close_timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(self._close_timeout)
+            self._close_timeout = None
         self._ctx.destroy()
 
+    def close(self):
+        """ Destroy the context once the sends waiting on a reply have got
+        it, or after the timeout if they don't, so they are not lost """
+        self._closing = True
+        if not self._streams:
+            self.cleanup_context()
+        elif self._close_timeout is None:
+            io_loop = ioloop.IOLoop.current()
+            self._close_timeout = io_loop.add_timeout(io_loop.time() + self._timeout, self.cleanup_context)
+
     def cleanup_socket(self):
         self._socket.close(0)
 
@@ -52,6 +68,7 @@ class PeerConnection(object):
 
             stream = zmqstream.ZMQStream(s, io_loop=ioloop.IOLoop.current())
             stream.send(compressed_data)
+            self._streams.add(stream)
 
             def cb(stream, msg):
                 response = json.loads(msg[0])
@@ -68,6 +85,10 @@ class PeerConnection(object):
                     callback(msg)
                 stream.close()
 
+                self._streams.discard(stream)
+                if self._closing and not self._streams:
+                    self.cleanup_context()
+
             stream.on_recv_stream(cb)
         except Exception as e:
             self._log.error(e)
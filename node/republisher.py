@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+import heapq
+import logging
+import time
+
+from zmq.eventloop import ioloop
+
+import constants
+
+# Stored data is treated as this much older (in seconds) than it is, as
+# the original republish loop always did
+AGE_OFFSET = 500000
+
+REPUBLISH, REPLICATE, EXPIRE = range(3)
+
+
+class RepublishScheduler(object):
+    """ Republishes, replicates and expires the records of a DHT data store
+    as they fall due, instead of walking every stored key at once.
+
+    Keys are kept in a heap ordered by the time they next need attention,
+    so each run only looks at due keys. A run handles at most
+    C{slice_size} keys before yielding the IOLoop, and outgoing stores are
+    limited to C{rate} per second.
+    """
+
+    def __init__(self, dataStore, guid, store, market_id,
+                 slice_size=constants.republishSliceSize,
+                 rate=constants.republishRate,
+                 check_interval=constants.republishCheckInterval,
+                 io_loop=None):
+        """
+        @param dataStore: The DataStore holding the records
+        @param guid: This node's GUID; records it published are republished,
+                     the others replicated and expired
+        @param store: Called as C{store(key, value, originalPublisherID, age)}
+                      to send a record to the network
+        @param slice_size: Number of due keys handled per IOLoop tick
+        @param rate: Number of stores sent per second
+        @param check_interval: Minimum time (in seconds) between two checks
+                               of the same key
+        @param io_loop: The IOLoop the scheduler runs on
+        """
+        self._dataStore = dataStore
+        self._guid = guid
+        self._store = store
+        self._slice_size = slice_size
+        self._rate = float(rate)
+        self._check_interval = check_interval
+        self._io_loop = io_loop or ioloop.IOLoop.instance()
+        self._log = logging.getLogger('[%s] %s' % (market_id, self.__class__.__name__))
+
+        self._heap = []  # (dueAt, key); entries not matching self._due are stale
+        self._due = {}  # key -> dueAt
+        self._tokens = float(slice_size)
+        self._last_refill = time.time()
+        self._timeout = None
+        self._timeout_at = None
+        self._started = False
+
+        # Everything already stored is due on the first run
+        for record in dataStore.iterRecords(values=False):
+            self.schedule(record.key, 0, record)
+
+    def start(self):
+        """ Start handling due keys; calling it again runs a check now """
+        self._started = True
+        self._arm(time.time())
+
+    def stop(self):
+        self._started = False
+        self._disarm()
+
+    def schedule(self, key, earliest=None, record=None):
+        """ Compute when C{key} next needs attention. Call this whenever
+        the record stored under C{key} changes.
+
+        @param earliest: Do not handle the key before this time; defaults
+                         to one check interval from now
+        @param record: The record's metadata, if the caller has it already
+        """
+        if record is None:
+            record = self._dataStore.getRecord(key, value=False)
+        if record is None:
+            self._due.pop(key, None)
+            return
+        if earliest is None:
+            earliest = time.time() + self._check_interval
+
+        dueAt = max(self._dueAt(record), earliest)
+        self._due[key] = dueAt
+        heapq.heappush(self._heap, (dueAt, key))
+
+        # Rescheduled keys leave stale entries behind; drop them once
+        # they outnumber the live ones
+        if len(self._heap) > 2 * len(self._due) + self._slice_size:
+            self._heap = [(due, k) for k, due in self._due.iteritems()]
+            heapq.heapify(self._heap)
+
+        if self._started:
+            self._arm(dueAt)
+
+    def pending(self):
+        """ Return the number of keys that are due now """
+        now = time.time()
+        return sum(1 for dueAt in self._due.itervalues() if dueAt <= now)
+
+    def _dueAt(self, record):
+        expiresAt = int(record.originallyPublished) + constants.dataExpireTimeout - AGE_OFFSET
+        if record.originalPublisherID == self._guid:
+            return expiresAt
+        return min(expiresAt, int(record.lastPublished) + constants.replicateInterval)
+
+    def _action(self, record, now):
+        age = now - int(record.originallyPublished) + AGE_OFFSET
+
+        if record.originalPublisherID == self._guid:
+            # This node is the original publisher; it has to republish
+            # the data before it expires (24 hours in basic Kademlia)
+            if age >= constants.dataExpireTimeout:
+                return REPUBLISH
+        else:
+            # This node needs to replicate the data at set intervals,
+            # until it expires, without changing the metadata associated with it
+            if age >= constants.dataExpireTimeout:
+                return EXPIRE
+            elif now - int(record.lastPublished) >= constants.replicateInterval:
+                return REPLICATE
+
+    def _refill(self, now):
+        self._tokens = min(float(self._slice_size),
+                           self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+    def _arm(self, at):
+        if self._timeout is not None:
+            if self._timeout_at <= at:
+                return
+            self._io_loop.remove_timeout(self._timeout)
+        self._timeout_at = at
+        self._timeout = self._io_loop.add_timeout(at, self._run)
+
+    def _disarm(self):
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _run(self):
+        self._timeout = None
+        if not self._started:
+            return
+
+        now = int(time.time())
+        self._refill(time.time())
+        handled = 0
+
+        while self._heap and handled < self._slice_size:
+            dueAt, key = self._heap[0]
+            if dueAt > now:
+                break
+            if self._due.get(key) != dueAt:
+                heapq.heappop(self._heap)
+                continue
+
+            # Only the metadata is needed to tell what is due
+            record = self._dataStore.getRecord(key, value=False)
+            if record is None:
+                heapq.heappop(self._heap)
+                del self._due[key]
+                continue
+
+            action = self._action(record, now)
+            if action in (REPUBLISH, REPLICATE) and self._tokens < 1:
+                break
+
+            heapq.heappop(self._heap)
+            handled += 1
+
+            if action == EXPIRE:
+                # This key/value pair has expired (and it has not been
+                # republished by the original publishing node) - remove it
+                del self._due[key]
+                del self._dataStore[key]
+                continue
+
+            if action == REPUBLISH:
+                self._tokens -= 1
+                self._store(key, self._dataStore.getRecord(key).value, None, 0)
+            elif action == REPLICATE:
+                self._tokens -= 1
+                age = now - int(record.originallyPublished) + AGE_OFFSET
+                self._store(key, self._dataStore.getRecord(key).value, record.originalPublisherID, age)
+            self.schedule(key, now + self._check_interval)
+
+        if handled:
+            self._log.debug('Handled %d due keys' % handled)
+
+        if self._heap:
+            if self._heap[0][0] <= now:
+                # More keys are due: continue on the next tick, or once a
+                # store can be sent again
+                delay = 0 if self._tokens >= 1 else (1 - self._tokens) / self._rate
+                self._arm(time.time() + delay)
+            else:
+                self._arm(self._heap[0][0])
@@ -5,12 +5,15 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
+from collections import OrderedDict
+import heapq
 import time
 import random
 import logging
 
 import constants
 import kbucket
+import node_id
 # from protocol import TimeoutError
 
 
@@ -38,19 +41,28 @@ class RoutingTable(object):
         exists, its status will be updated
 
         @param contact: The contact to add to this node's k-buckets
-        @type contact: p2p.PeerConnection
+        @type contact: contact.Contact
         """
 
     @staticmethod
     def distance(keyOne, keyTwo):
-        """ Calculate the XOR result between two string variables
+        """ Calculate the XOR distance between two node IDs or keys
 
-        @return: XOR result of two long variables
+        @type keyOne: str or node_id.NodeID
+        @type keyTwo: str or node_id.NodeID
+
+        @return: XOR result of the two IDs
         @rtype: long
         """
-        valKeyOne = long(keyOne.encode('hex'), 16)
-        valKeyTwo = long(keyTwo.encode('hex'), 16)
-        return valKeyOne ^ valKeyTwo
+        return node_id.distance(keyOne, keyTwo)
+
+    def contactFailed(self, contactID):
+        """ Record that the contact with the specified node ID did not
+        answer an RPC in time
+
+        @param contactID: The node ID of the contact
+        @type contactID: str
+        """
 
     def findCloseNodes(self, key, count, _rpcNodeID=None):
         """ Finds a number of known nodes closest to the node/value with the
@@ -103,12 +115,15 @@ class RoutingTable(object):
         @rtype: list
         """
 
-    def removeContact(self, contactID):
+    def removeContact(self, contactID, replace=True):
         """ Remove the contact with the specified node ID from the routing
         table
 
         @param contactID: The node ID of the contact to remove
         @type contactID: str
+        @param replace: Whether a contact from the replacement cache, if
+                        any, takes its place
+        @type replace: bool
         """
 
     def touchKBucket(self, key):
@@ -146,82 +161,81 @@ class TreeRoutingTable(RoutingTable):
         self._log = logging.getLogger(
             '[%s] %s' % (market_id, self.__class__.__name__)
         )
+        # Bucket i holds the contacts whose IDs share exactly i leading bits
+        # with ours; the last one holds those sharing more, including us
         self._buckets = [
-            kbucket.KBucket(rangeMin=0, rangeMax=2 ** 200, market_id=market_id)
+            kbucket.KBucket(rangeMin=0, rangeMax=2 ** node_id.ID_BITS, market_id=market_id)
         ]
         self._parentNodeID = parentNodeID
+        self._parentID = node_id.NodeID(parentNodeID)
+        # GUID -> contact, for every contact in the buckets
+        self._contactIndex = {}
 
     def addContact(self, contact):
         """ Add the given contact to the correct k-bucket; if it already
         exists, its status will be updated
 
         @param contact: The contact to add to this node's k-buckets
-        @type contact: p2p.PeerConnection
+        @type contact: contact.Contact
         """
 
         # If contact is itself return
-        if contact._guid == self._parentNodeID:
+        if contact.guid == self._parentNodeID:
             return
 
-        bucketIndex = self._kbucketIndex(contact._guid)
-
-        # If already added then update
-        if not self._buckets[bucketIndex].getContact(contact):
+        bucketIndex = self._kbucketIndex(contact.guid)
 
-            try:
-                self._buckets[bucketIndex].addContact(contact)
-            except kbucket.BucketFull:
-                # The bucket is full; see if it can be split (by checking if
-                # its range includes the host node's id)
-                if self._buckets[bucketIndex].keyInRange(self._parentNodeID):
-                    self._splitBucket(bucketIndex)
-                    # Retry the insertion attempt
+        # Adds the contact, or moves it to the tail of its bucket if it is
+        # there already
+        try:
+            self._buckets[bucketIndex].addContact(contact)
+            self._contactIndex[contact.guid] = contact
+        except kbucket.BucketFull:
+            # The bucket is full; see if it can be split (by checking if
+            # its range includes the host node's id)
+            if self._buckets[bucketIndex].keyInRange(self._parentNodeID):
+                self._splitBucket(bucketIndex)
+                # Retry the insertion attempt
+                self.addContact(contact)
+            else:
+                # We can't split the k-bucket
+                # NOTE:
+                # In section 2.4 of the 13-page version of the Kademlia
+                # paper, it is specified that in this case, the new
+                # contact should simply be dropped. However, in
+                # section 2.2, it states that the head contact in the
+                # k-bucket (i.e. the least-recently seen node) should be
+                # pinged - if it does not reply, it should be dropped, and
+                # the new contact added to the tail of the k-bucket. This
+                # implementation follows section 2.2 regarding this point.
+
+                def replaceContact(failure):
+                    """Callback for the deferred PING RPC to see if the
+                       head node in the k-bucket is still responding
+
+                       @type failure: twisted.python.failure.Failure"""
+                    failure.trap(TimeoutError)
+                    print '==replacing contact=='
+                    # Remove the old contact...
+                    deadContactID = failure.getErrorMessage()
+                    self.removeContact(deadContactID)
+                    # ...and add the new one at the tail of the bucket
                     self.addContact(contact)
-                else:
-                    # We can't split the k-bucket
-                    # NOTE:
-                    # In section 2.4 of the 13-page version of the Kademlia
-                    # paper, it is specified that in this case, the new
-                    # contact should simply be dropped. However, in
-                    # section 2.2, it states that the head contact in the
-                    # k-bucket (i.e. the least-recently seen node) should be
-                    # pinged - if it does not reply, it should be dropped, and
-                    # the new contact added to the tail of the k-bucket. This
-                    # implementation follows section 2.2 regarding this point.
-
-                    def replaceContact(failure):
-                        """Callback for the deferred PING RPC to see if the
-                           head node in the k-bucket is still responding
-
-                           @type failure: twisted.python.failure.Failure"""
-                        failure.trap(TimeoutError)
-                        print '==replacing contact=='
-                        # Remove the old contact...
-                        deadContactID = failure.getErrorMessage()
-                        try:
-                            bucket = self._buckets[bucketIndex]
-                            bucket.removeContact(deadContactID)
-                        except ValueError:
-                            # The contact has already been removed (probably
-                            # due to a timeout)
-                            pass
-                        # ...and add the new one at the tail of the bucket
-                        self.addContact(contact)
 
-                    # Ping the least-recently seen contact in this k-bucket
-                    headContact = self._buckets[bucketIndex]._contacts[0]
+                # Ping the least-recently seen contact in this k-bucket
+                headContact = self._buckets[bucketIndex].head()
 
-                    # headContact.send({
-                    #     "type": "ping",
-                    #     "guid": self._guid,
-                    #     "uri": self._uri,
-                    #     "findValue": peer['findValue']
-                    # })
+                # headContact.send({
+                #     "type": "ping",
+                #     "guid": self._guid,
+                #     "uri": self._uri,
+                #     "findValue": peer['findValue']
+                # })
 
-                    df = headContact.ping()
-                    # If there's an error (i.e. timeout), remove the head
-                    # contact, and append the new one
-                    df.addErrback(replaceContact)
+                df = headContact.ping()
+                # If there's an error (i.e. timeout), remove the head
+                # contact, and append the new one
+                df.addErrback(replaceContact)
 
     def findCloseNodes(self, key, count, nodeID=None):
         """ Finds a number of known nodes closest to the node/value with the
@@ -238,62 +252,29 @@ class TreeRoutingTable(RoutingTable):
 
         @return: A list of node contacts
                  (C{kademlia.contact.Contact instances})
-                 closest to the specified key.
+                 closest to the specified key, closest first.
                  This method will return C{k} (or C{count}, if specified)
                  contacts if at all possible; it will only return fewer if the
                  node is returning all of the contacts that it knows of.
         @rtype: list
         """
-        bucketIndex = self._kbucketIndex(key)
-        bucket = self._buckets[bucketIndex]
-        closestNodes = bucket.getContacts(constants.k, nodeID)
-
-        # This method must return k contacts (even if we have the node with
-        # the specified key as node ID), unless there is less than k remote
-        # nodes in the routing table
-        i = 1
-        canGoLower = bucketIndex - i >= 0
-        canGoHigher = bucketIndex + i < len(self._buckets)
-        # Fill up the node list to k nodes, starting with the closest
-        # neighbouring nodes known
-        while len(closestNodes) < constants.k and (canGoLower or canGoHigher):
-            # TODO: this may need to be optimized
-            if canGoLower:
-                bucket = self._buckets[bucketIndex - i]
-                closestNodes.extend(
-                    bucket.getContacts(
-                        constants.k - len(closestNodes), nodeID
-                    )
-                )
-                canGoLower = bucketIndex - (i + 1) >= 0
-            if canGoHigher:
-                bucket = self._buckets[bucketIndex + i]
-                closestNodes.extend(
-                    bucket.getContacts(
-                        constants.k - len(closestNodes), nodeID
-                    )
-                )
-                canGoHigher = bucketIndex + (i + 1) < len(self._buckets)
-            i += 1
+        # Every contact is looked at, but only the closest count of them
+        # are kept on a bounded heap
+        keyID = node_id.toNodeID(key)
+        closestNodes = heapq.nsmallest(
+            count,
+            (contact for guid, contact in self._contactIndex.iteritems() if guid != nodeID),
+            key=lambda contact: keyID.distance(contact.guid)
+        )
 
         self._log.debug('Closest Nodes: %s' % closestNodes)
         return closestNodes
 
     def getContact(self, contactID):
-        """ Returns the (known) contact with the specified node ID
-
-        @raise ValueError: No contact with the specified contact ID is known
-                           by this node
+        """ Returns the (known) contact with the specified node ID, or None
+        if no contact with that ID is known by this node
         """
-
-        bucketIndex = self._kbucketIndex(contactID)
-
-        try:
-            contact = self._buckets[bucketIndex].getContact(contactID)
-        except ValueError:
-            raise
-        else:
-            return contact
+        return self._contactIndex.get(contactID)
 
     def getRefreshList(self, startIndex=0, force=False):
         """ Finds all k-buckets that need refreshing, starting at the
@@ -326,19 +307,18 @@ class TreeRoutingTable(RoutingTable):
             bucketIndex += 1
         return refreshIDs
 
-    def removeContact(self, contactID):
+    def removeContact(self, contactID, replace=True):
         """ Remove the contact with the specified node ID from the routing
         table
 
         @param contactID: The node ID of the contact to remove
         @type contactID: str
+        @param replace: Whether a contact from the replacement cache, if
+                        any, takes its place
+        @type replace: bool
         """
-        bucketIndex = self._kbucketIndex(contactID)
-        try:
-            self._buckets[bucketIndex].removeContact(contactID)
-        except ValueError:
-            # print 'removeContact(): Contact not in routing table'
-            return
+        if self._contactIndex.pop(contactID, None) is not None:
+            self._buckets[self._kbucketIndex(contactID)].removeContact(contactID)
 
     def touchKBucket(self, key):
         """ Update the "last accessed" timestamp of the k-bucket which covers
@@ -360,17 +340,11 @@ class TreeRoutingTable(RoutingTable):
         @return: The index of the k-bucket responsible for the specified key
         @rtype: int
         """
-        # print key
-        # print obelisk.DecodeBase58Check(key)
-        valKey = long(key, 16)
-
-        i = 0
-        for bucket in self._buckets:
-            if bucket.keyInRange(valKey):
-                return i
-            else:
-                i += 1
-        return i
+        # Buckets are ordered by the number of leading bits their IDs share
+        # with ours, which is the position of the highest bit set in the
+        # XOR distance
+        sharedBits = node_id.ID_BITS - self._parentID.distance(key).bit_length()
+        return min(max(sharedBits, 0), len(self._buckets) - 1)
 
     def _randomIDInBucketRange(self, bucketIndex):
         """ Returns a random ID in the specified k-bucket's range
@@ -399,24 +373,25 @@ class TreeRoutingTable(RoutingTable):
                                list of k-buckets)
         @type oldBucketIndex: int
         """
-        # Resize the range of the current (old) k-bucket
+        # Only the last bucket, the one holding our own ID, is ever split.
+        # The half of its range without our ID becomes a new k-bucket just
+        # before it, for the IDs sharing exactly oldBucketIndex leading bits
+        # with ours
         oldBucket = self._buckets[oldBucketIndex]
         splitPoint = oldBucket.rangeMax - (oldBucket.rangeMax - oldBucket.rangeMin) / 2
-        # Create a new k-bucket to cover the range split off from the old
-        # bucket
-        newBucket = kbucket.KBucket(
-            splitPoint, oldBucket.rangeMax, self._market_id
-        )
-        oldBucket.rangeMax = splitPoint
-        # Now, add the new bucket into the routing table tree
-        self._buckets.insert(oldBucketIndex + 1, newBucket)
-        # Finally, copy all nodes that belong to the new k-bucket into it...
-        for contact in oldBucket._contacts:
-            if newBucket.keyInRange(contact.id):
+        if self._parentID.value < splitPoint:
+            newBucket = kbucket.KBucket(splitPoint, oldBucket.rangeMax, self._market_id)
+            oldBucket.rangeMax = splitPoint
+        else:
+            newBucket = kbucket.KBucket(oldBucket.rangeMin, splitPoint, self._market_id)
+            oldBucket.rangeMin = splitPoint
+        self._buckets.insert(oldBucketIndex, newBucket)
+
+        # Finally, move all nodes that belong to the new k-bucket into it
+        for contact in oldBucket.getContacts():
+            if newBucket.keyInRange(contact.guid):
                 newBucket.addContact(contact)
-        # ...and remove them from the old bucket
-        for contact in newBucket._contacts:
-            oldBucket.removeContact(contact)
+                oldBucket.removeContact(contact.guid)
 
 
 class OptimizedTreeRoutingTable(TreeRoutingTable):
@@ -427,7 +402,8 @@ class OptimizedTreeRoutingTable(TreeRoutingTable):
 
     def __init__(self, parentNodeID, market_id):
         TreeRoutingTable.__init__(self, parentNodeID, market_id)
-        # Cache containing nodes eligible to replace stale k-bucket entries
+        # Cache containing nodes eligible to replace stale k-bucket entries:
+        # bucket index -> OrderedDict of GUID -> contact, most recently seen last
         self._replacementCache = {}
 
     def addContact(self, contact):
@@ -435,116 +411,105 @@ class OptimizedTreeRoutingTable(TreeRoutingTable):
         exists, its status will be updated
 
         @param contact: The contact to add to this node's k-buckets
-        @type contact: kademlia.contact.Contact
+        @type contact: contact.Contact
         """
 
-        if not contact._guid:
+        if not contact.guid:
             self._log.error('No guid specified')
             return
 
-        if contact._guid == self._parentNodeID:
+        if contact.guid == self._parentNodeID:
             self._log.info('Trying to add yourself. Leaving.')
             return
 
         # Initialize/reset the "successively failed RPC" counter
-        contact.failedRPCs = 0
-
-        bucketIndex = self._kbucketIndex(contact._guid)
+        contact.failures = 0
+        contact.lastSeen = time.time()
 
-        old_contact = self._buckets[bucketIndex].getContact(contact)
+        bucketIndex = self._kbucketIndex(contact.guid)
 
-        if not old_contact:
+        try:
+            # Adds the contact, or moves it to the tail of its bucket if it
+            # is there already, picking up a changed address
+            self._buckets[bucketIndex].addContact(contact)
+            self._contactIndex[contact.guid] = contact
+        except kbucket.BucketFull:
+            # The bucket is full; see if it can be split (by checking if
+            # its range includes the host node's id)
+            if self._buckets[bucketIndex].keyInRange(self._parentNodeID):
+                self._splitBucket(bucketIndex)
+                # Retry the insertion attempt
+                self.addContact(contact)
+            else:
+                # We can't split the k-bucket
+                # NOTE: This implementation follows section 4.1 of the 13
+                # page version of the Kademlia paper (optimized contact
+                # accounting without PINGs - results in much less network
+                # traffic, at the expense of some memory)
+
+                # A contact that stopped answering makes way for the new
+                # one straight away...
+                for staleContact in self._buckets[bucketIndex].getContacts():
+                    if staleContact.failures >= constants.maxFailedRPCs:
+                        self._log.debug('Replacing stale contact %s' % staleContact.guid)
+                        del self._contactIndex[staleContact.guid]
+                        self._buckets[bucketIndex].removeContact(staleContact.guid)
+                        self.addContact(contact)
+                        return
+
+                # ...otherwise put the new contact in our replacement cache
+                # for the corresponding k-bucket (or update it's position if
+                # it exists already), dropping the least recently seen one
+                # if the cache is full
+                replacements = self._replacementCache.setdefault(bucketIndex, OrderedDict())
+                replacements.pop(contact.guid, None)
+                replacements[contact.guid] = contact
+                if len(replacements) > constants.replacementCacheSize:
+                    replacements.popitem(last=False)
+
+    def contactFailed(self, contactID):
+        """ Record that the contact with the specified node ID did not
+        answer an RPC in time; after maxFailedRPCs failures in a row it is
+        replaced from its k-bucket's replacement cache, if that has anyone
+        to replace it with
+
+        @param contactID: The node ID of the contact
+        @type contactID: str
+        """
+        contact = self._contactIndex.get(contactID)
+        if contact is None:
+            return
 
-            try:
-                self._buckets[bucketIndex].addContact(contact)
-            except kbucket.BucketFull:
-                # The bucket is full; see if it can be split (by checking if
-                # its range includes the host node's id)
-                if self._buckets[bucketIndex].keyInRange(self._parentNodeID):
-                    self._splitBucket(bucketIndex)
-                    # Retry the insertion attempt
-                    self.addContact(contact)
-                else:
-                    # We can't split the k-bucket
-                    # NOTE: This implementation follows section 4.1 of the 13
-                    # page version of the Kademlia paper (optimized contact
-                    # accounting without PINGs - results in much less network
-                    # traffic, at the expense of some memory)
-
-                    # Put the new contact in our replacement cache for the
-                    # corresponding k-bucket (or update it's position if it
-                    # exists already)
-                    if bucketIndex not in self._replacementCache:
-                        self._replacementCache[bucketIndex] = []
-                    if contact in self._replacementCache[bucketIndex]:
-                        self._replacementCache[bucketIndex].remove(contact)
-                    # TODO: Using k to limit the size of the contact
-                    # replacement cache - maybe define a separate value for
-                    # this in constants.py?
-                    elif len(self._replacementCache) >= constants.k:
-                        self._replacementCache.pop(0)
-                    self._replacementCache[bucketIndex].append(contact)
+        contact.failures += 1
+        if contact.failures >= constants.maxFailedRPCs and \
+                self._replacementCache.get(self._kbucketIndex(contactID)):
+            self._log.debug('Replacing stale contact %s' % contactID)
+            self.removeContact(contactID)
 
-        else:
-            if old_contact._address != contact._address:
-
-                self._log.info('Remove contact')
-                self.removeContact(contact._guid)
-
-                try:
-                    self._buckets[bucketIndex].addContact(contact)
-                except kbucket.BucketFull:
-                    # The bucket is full; see if it can be split (by checking
-                    # if its range includes the host node's id)
-                    if self._buckets[bucketIndex].keyInRange(self._parentNodeID):
-                        self._splitBucket(bucketIndex)
-                        # Retry the insertion attempt
-                        self.addContact(contact)
-                    else:
-                        # We can't split the k-bucket
-                        # NOTE: This implementation follows section 4.1 of the
-                        # 13 page version of the Kademlia paper (optimized
-                        # contact accounting without PINGs - results in much
-                        # less network traffic, at the expense of some memory)
-
-                        # Put the new contact in our replacement cache for the
-                        # corresponding k-bucket (or update it's position if
-                        # it exists already)
-                        if bucketIndex not in self._replacementCache:
-                            self._replacementCache[bucketIndex] = []
-                        if contact in self._replacementCache[bucketIndex]:
-                            self._replacementCache[bucketIndex].remove(contact)
-                        # TODO: Using k to limit the size of the contact
-                        # replacement cache - maybe define a separate value
-                        # for this in constants.py?
-                        elif len(self._replacementCache) >= constants.k:
-                            self._replacementCache.pop(0)
-                        self._replacementCache[bucketIndex].append(contact)
-
-    def removeContact(self, contactID):
+    def removeContact(self, contactID, replace=True):
         """ Remove the contact with the specified node ID from the routing
         table
 
         @param contactID: The node ID of the contact to remove
         @type contactID: str
+        @param replace: Whether a contact from the replacement cache, if
+                        any, takes its place
+        @type replace: bool
         """
         bucketIndex = self._kbucketIndex(contactID)
-        try:
-            contact = self._buckets[bucketIndex].getContact(contactID)
-        except ValueError:
-            # print 'removeContact(): Contact not in routing table'
+        replacements = self._replacementCache.get(bucketIndex)
+
+        if self._contactIndex.pop(contactID, None) is None:
+            # It may be waiting in the replacement cache instead
+            if replacements:
+                replacements.pop(contactID, None)
             return
 
-        if contact:
-            self._buckets[bucketIndex].removeContact(contactID)
-            # Replace this stale contact with one from our replacement
-            # cache, if we have any
-            # if self._replacementCache.has_key(bucketIndex):
-            #     if len(self._replacementCache[bucketIndex]) > 0:
-            #         self._buckets[bucketIndex].addContact(
-            #             self._replacementCache[bucketIndex].pop()
-            #         )
-
-            self._log.debug(
-                'Contacts: %s' % self._buckets[bucketIndex]._contacts
-            )
+        self._buckets[bucketIndex].removeContact(contactID)
+
+        # Replace this stale contact with the most recently seen one from
+        # our replacement cache, if we have any
+        if replace and replacements:
+            guid, replacement = replacements.popitem()
+            self._buckets[bucketIndex].addContact(replacement)
+            self._contactIndex[guid] = replacement
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+import ast
+import copy
+import threading
+
+from pybitcointools import privkey_to_pubkey
+
+
+class SettingsCache(object):
+    """ Read-through cache of one market's row in the settings table.
+
+    The row is loaded on first use and dropped whenever anything writes to
+    the settings table, so callers always see committed values without
+    querying and re-parsing the row on every call. Callers get copies and
+    may modify them freely.
+    """
+
+    def __init__(self, db, market_id):
+        """
+        @param db: The Obdb instance holding the settings table
+        @param market_id: The market whose settings are cached
+        """
+        self._db = db
+        self._market_id = market_id
+        # Reentrant: loading may create the row, which invalidates the cache
+        self._lock = threading.RLock()
+        self._row = None
+        self._settings = None
+        db.addChangeListener("settings", self.invalidate)
+
+    def invalidate(self, table="settings"):
+        """ Drop the cached row; the next read reloads it """
+        with self._lock:
+            self._row = None
+            self._settings = None
+
+    def _load(self):
+        if self._row is None:
+            self._row = self._db.getOrCreate("settings",
+                                             {"market_id": self._market_id},
+                                             {"market_id": self._market_id})
+        return self._row
+
+    def row(self):
+        """ Return the settings row as it is stored """
+        with self._lock:
+            return dict(self._load())
+
+    def get(self):
+        """ Return the settings with the flags as booleans, the notaries
+        and trusted arbiters as lists and the derived btc_pubkey """
+        with self._lock:
+            if self._settings is None:
+                self._settings = self._parse(dict(self._load()))
+            return copy.deepcopy(self._settings)
+
+    @staticmethod
+    def _parse(settings):
+        if settings['arbiter'] == 1:
+            settings['arbiter'] = True
+        if settings['notary'] == 1:
+            settings['notary'] = True
+
+        settings['notaries'] = ast.literal_eval(settings['notaries']) if settings['notaries'] != "" else []
+        settings['trustedArbiters'] = ast.literal_eval(settings['trustedArbiters']) if settings['trustedArbiters'] != "" else []
+        settings['privkey'] = settings['privkey'] if 'secret' in settings else ""
+        settings['btc_pubkey'] = privkey_to_pubkey(settings.get('privkey'))
+        settings['secret'] = settings['secret'] if 'secret' in settings else ""
+        return settings
@@ -7,26 +7,31 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
+import logging
 from os import path, remove
 from pysqlcipher import dbapi2 as sqlite
 import sys
 
 import constants
+from db_store import unlock_db
+import value_codec
 
 DB_PATH = constants.DB_PATH
 
-# TODO: Use indexes.
 # TODO: Maybe it makes sense to put tags on a different table
 
 
-def setup_db(db_path):
+def setup_db(db_path, pragmas=None):
+    """ Create the database if it doesn't exist yet and bring its schema up
+    to date
+    @param pragmas: PRAGMA settings, see db_store.resolve_pragmas. The
+    SQLCipher settings in here are fixed for the lifetime of the database.
+    """
     if not path.isfile(db_path):
         con = sqlite.connect(db_path)
         with con:
             cur = con.cursor()
-
-            # Use PRAGMA key to encrypt / decrypt database.
-            cur.execute("PRAGMA key = 'passphrase';")
+            unlock_db(cur, pragmas)
 
             cur.execute("CREATE TABLE markets("
                         "id INTEGER PRIMARY KEY AUTOINCREMENT, "
@@ -158,9 +163,117 @@ def setup_db(db_path):
                         "lastPublished TEXT, "
                         "originallyPublished TEXT, "
                         "originalPublisherID TEXT, "
-                        "value TEXT, "
+                        "value BLOB, "
                         "FOREIGN KEY(market_id) REFERENCES markets(id))")
 
+    migrate_db(db_path, pragmas)
+
+
+def _remove_duplicates(cur, table, columns):
+    """ Keep only the newest row of every group sharing C{columns} so a
+    UNIQUE index can be created on them """
+    cur.execute("DELETE FROM %s WHERE id NOT IN "
+                "(SELECT MAX(id) FROM %s GROUP BY %s)"
+                % (table, table, ", ".join(columns)))
+
+
+def _add_lookup_indexes(cur):
+    """ Index the columns every hot lookup filters on and make datastore
+    entries and peers unique, so they can be upserted in place """
+    _remove_duplicates(cur, "datastore", ["market_id", "key"])
+    cur.execute("CREATE UNIQUE INDEX datastore_market_id_key "
+                "ON datastore(market_id, key)")
+    cur.execute("CREATE INDEX datastore_key ON datastore(key)")
+
+    cur.execute("DELETE FROM peers WHERE guid IS NOT NULL AND id NOT IN "
+                "(SELECT MAX(id) FROM peers GROUP BY guid)")
+    cur.execute("CREATE UNIQUE INDEX peers_guid ON peers(guid)")
+    cur.execute("CREATE INDEX peers_uri ON peers(uri)")
+    cur.execute("CREATE INDEX peers_market_id ON peers(market_id)")
+
+    cur.execute("CREATE INDEX orders_order_id ON orders(order_id)")
+    cur.execute("CREATE INDEX orders_buyer_order_id ON orders(buyer_order_id)")
+    cur.execute("CREATE INDEX orders_market_id_updated "
+                "ON orders(market_id, updated)")
+
+    cur.execute("CREATE INDEX contracts_market_id ON contracts(market_id)")
+    cur.execute("CREATE INDEX settings_market_id ON settings(market_id)")
+
+
+def _encode_datastore_values(cur):
+    """ Move datastore values from their str() in a TEXT column to
+    value_codec encoded BLOBs. SQLite can't change a column's type, so the
+    table is rebuilt. """
+    cur.execute("CREATE TABLE datastore_encoded("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "market_id INT, "
+                "key TEXT, "
+                "lastPublished TEXT, "
+                "originallyPublished TEXT, "
+                "originalPublisherID TEXT, "
+                "value BLOB, "
+                "FOREIGN KEY(market_id) REFERENCES markets(id))")
+
+    rows = cur.connection.cursor()
+    rows.execute("SELECT id, market_id, key, lastPublished, originallyPublished, "
+                 "originalPublisherID, value FROM datastore")
+    for row in rows:
+        value = row[6]
+        if not isinstance(value, buffer):
+            value = buffer(value_codec.encode(value_codec.decode_legacy(value)))
+        cur.execute("INSERT INTO datastore_encoded VALUES(?, ?, ?, ?, ?, ?, ?)",
+                    row[:6] + (value,))
+
+    cur.execute("DROP TABLE datastore")
+    cur.execute("ALTER TABLE datastore_encoded RENAME TO datastore")
+    cur.execute("CREATE UNIQUE INDEX datastore_market_id_key "
+                "ON datastore(market_id, key)")
+    cur.execute("CREATE INDEX datastore_key ON datastore(key)")
+
+
+# Ordered schema migrations. The database stores how many of these it has
+# applied in schema_version; append new steps at the end and never reorder
+# or remove existing ones.
+MIGRATIONS = [
+    _add_lookup_indexes,
+    _encode_datastore_values,
+]
+
+
+def migrate_db(db_path, pragmas=None):
+    """ Bring an existing database up to the latest schema version. Every
+    migration step runs in its own transaction together with the version
+    bump, so an interrupted upgrade can simply be run again.
+    """
+    con = sqlite.connect(db_path)
+    con.isolation_level = None
+    try:
+        cur = con.cursor()
+        unlock_db(cur, pragmas)
+
+        cur.execute("CREATE TABLE IF NOT EXISTS schema_version(version INT)")
+        row = cur.execute("SELECT version FROM schema_version").fetchone()
+        if row is None:
+            cur.execute("INSERT INTO schema_version(version) VALUES(0)")
+            version = 0
+        else:
+            version = row[0]
+
+        for step in MIGRATIONS[version:]:
+            version += 1
+            cur.execute("BEGIN")
+            try:
+                step(cur)
+                cur.execute("UPDATE schema_version SET version = ?", (version,))
+            except Exception:
+                logging.getLogger('setup_db').exception(
+                    'Migrating %s to schema version %d failed' % (db_path, version))
+                cur.execute("ROLLBACK")
+                raise
+            cur.execute("COMMIT")
+    finally:
+        con.close()
+
 
 def remove_db(db_path):
     remove(db_path)
@@ -6,8 +6,10 @@ from zmq.eventloop import ioloop
 ioloop.install()
 
 from crypto2crypto import CryptoTransportLayer
-from db_store import Obdb
+from db_store import Obdb, PRAGMA_PROFILES, check_pragma, resolve_pragmas
+import constants
 from market import Market
+from setup_db import setup_db
 from ws import WebSocketHandler
 import logging
 import signal
@@ -24,9 +26,14 @@ class MainHandler(tornado.web.RequestHandler):
 class MarketApplication(tornado.web.Application):
     def __init__(self, market_ip, market_port, market_id=1,
                  bm_user=None, bm_pass=None, bm_port=None, seed_peers=[],
-                 seed_mode=0, dev_mode=False, db_path='db/ob.db'):
+                 seed_mode=0, dev_mode=False, db_path='db/ob.db',
+                 db_pool_size=constants.DB_POOL_SIZE, db_pragmas=None):
 
-        db = Obdb(db_path)
+        # Create the database or upgrade its schema
+        setup_db(db_path, db_pragmas)
+
+        db = Obdb(db_path, db_pool_size, db_pragmas)
+        self.db = db
 
         self.transport = CryptoTransportLayer(market_ip,
                                               market_port,
@@ -115,7 +122,10 @@ def start_node(my_market_ip,
                dev_mode=False,
                log_level=None,
                database='db/ob.db',
-               disable_upnp=False):
+               disable_upnp=False,
+               db_pool_size=constants.DB_POOL_SIZE,
+               db_profile=constants.DB_PRAGMA_PROFILE,
+               db_pragmas=None):
 
     logging.basicConfig(level=int(log_level),
                         format='%(asctime)s - %(name)s -  \
@@ -138,7 +148,9 @@ def start_node(my_market_ip,
                                     seed_peers,
                                     seed_mode,
                                     dev_mode,
-                                    database)
+                                    database,
+                                    db_pool_size,
+                                    resolve_pragmas(db_profile, db_pragmas))
 
     error = True
     http_port = 8888
@@ -169,8 +181,11 @@ def start_node(my_market_ip,
         application.cleanup_upnp_port_mapping()
         tornado.ioloop.IOLoop.instance().stop()
 
+        # Release the pooled database connections
+        application.db.close()
+
         # TODO:
-        # we should implement the shutdown of the dht connections, db connection, bitmessage connection
+        # we should implement the shutdown of the dht connections, bitmessage connection
         # maybe this was meant to do all that but nobody ever got around it.
         # application.market.p.kill()
         sys.exit(0)
@@ -185,6 +200,19 @@ def start_node(my_market_ip,
     else:
         tornado.ioloop.IOLoop.instance().start()
 
+
+def pragma_arg(text):
+    """ Parse a NAME=VALUE PRAGMA override given on the command line """
+    name, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE, got %r" % text)
+    try:
+        check_pragma(name, value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return name, value
+
+
 # Run this if executed directly
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -213,6 +241,20 @@ if __name__ == "__main__":
                         default=10, help="Numeric value for logging level")
     parser.add_argument("--disable_upnp",
                         action='store_true')
+    parser.add_argument("--db_pool_size",
+                        type=int, default=constants.DB_POOL_SIZE,
+                        help="Number of pooled database connections")
+    parser.add_argument("--db_profile",
+                        choices=sorted(PRAGMA_PROFILES),
+                        default=constants.DB_PRAGMA_PROFILE,
+                        help="Database PRAGMA preset")
+    parser.add_argument("--db_pragma",
+                        action='append', default=[], metavar="NAME=VALUE",
+                        type=pragma_arg,
+                        help="Override a single database PRAGMA, e.g. "
+                             "synchronous=FULL. kdf_iter and cipher_page_size "
+                             "must match the values the database was "
+                             "created with")
     args = parser.parse_args()
     start_node(args.my_market_ip,
                args.my_market_port,
@@ -226,4 +268,7 @@ if __name__ == "__main__":
                args.dev_mode,
                args.log_level,
                args.database,
-               args.disable_upnp)
+               args.disable_upnp,
+               args.db_pool_size,
+               args.db_profile,
+               dict(args.db_pragma))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+from collections import OrderedDict
+import sys
+import threading
+
+import constants
+
+
+class ValueCache(object):
+    """ A least recently used cache of DHT values, bounded by the total
+    size of the cached values rather than by their number, so a few large
+    contracts can't crowd out memory while small hot indexes stay cached.
+
+    Entries are sized by the memory their decoded values take, see
+    L{sizeof}. The cache keeps its own copy of mutable values and hands
+    out copies, so a caller changing a value it got can't change it for
+    everyone else.
+    """
+
+    def __init__(self, max_bytes=constants.DHT_VALUE_CACHE_BYTES):
+        """
+        @param max_bytes: Total size of the values kept in the cache
+        """
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size), oldest first
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the cached value of C{key}, or C{default} on a miss """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                return default
+            self._entries[key] = entry
+            self._hits += 1
+            value = entry[0]
+        return _copy(value)
+
+    def put(self, key, value):
+        """ Cache C{value} under C{key}, evicting the least recently used
+        values until the cache fits. Values larger than the whole cache
+        are not cached. """
+        value = _copy(value)
+        size = sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if size > self._max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def invalidate(self, key):
+        """ Drop C{key} from the cache """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """ Return the hit, miss and eviction counters and the current size """
+        with self._lock:
+            return {'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'max_bytes': self._max_bytes}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+
+def sizeof(value):
+    """ Approximate memory taken by a decoded value, including what its
+    containers hold """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sizeof(key) + sizeof(item) for key, item in value.iteritems())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sizeof(item) for item in value)
+    return size
+
+
+def _copy(value):
+    """ Copy the mutable containers of a decoded value; strings, numbers
+    and the other immutable values are shared """
+    if isinstance(value, dict):
+        return dict((key, _copy(item)) for key, item in value.iteritems())
+    elif isinstance(value, list):
+        return [_copy(item) for item in value]
+    elif isinstance(value, tuple):
+        return tuple(_copy(item) for item in value)
+    elif isinstance(value, set):
+        return set(value)
+    return value
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+""" Binary encoding of the values kept in the DHT datastore.
+
+An encoded value is a three byte header followed by the payload::
+
+    version | type tag | flags | payload
+
+The type tag says how the payload is turned back into a value, so byte
+strings, unicode text and JSON documents no longer get mixed up the way
+they did with str() and ast.literal_eval. Payloads above
+C{constants.DHT_VALUE_COMPRESS_THRESHOLD} bytes are zlib compressed.
+"""
+
+import ast
+import json
+import zlib
+
+import constants
+
+VERSION = 1
+
+TAG_BYTES = 'b'  # str, stored as is
+TAG_TEXT = 'u'  # unicode, UTF-8 encoded
+TAG_JSON = 'j'  # anything JSON can represent
+TAG_LITERAL = 'r'  # Python literals JSON would change, by their repr
+
+FLAG_ZLIB = 1
+
+
+def encode(value, compress_threshold=constants.DHT_VALUE_COMPRESS_THRESHOLD):
+    """ Encode C{value} for storage
+    @return: The encoded bytes, as a str
+    """
+    if isinstance(value, str):
+        tag, payload = TAG_BYTES, value
+    elif isinstance(value, unicode):
+        tag, payload = TAG_TEXT, value.encode('utf-8')
+    elif _json_exact(value):
+        tag, payload = TAG_JSON, json.dumps(value, separators=(',', ':'))
+    else:
+        tag, payload = TAG_LITERAL, repr(value)
+
+    flags = 0
+    if len(payload) > compress_threshold:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            flags, payload = FLAG_ZLIB, compressed
+
+    return chr(VERSION) + tag + chr(flags) + payload
+
+
+def _json_exact(value):
+    """ Whether JSON gives C{value} back unchanged; tuples and non-string
+    dict keys would silently change type """
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return not isinstance(value, str) or _is_utf8(value)
+    if isinstance(value, list):
+        return all(_json_exact(item) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(key, basestring) and _json_exact(key) and _json_exact(item)
+                   for key, item in value.iteritems())
+    return False
+
+
+def _is_utf8(text):
+    try:
+        text.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def decode(data):
+    """ Decode a value read from the datastore table. Text columns hold
+    values written before the table was migrated and are decoded the way
+    they always were.
+    """
+    if not isinstance(data, buffer):
+        return decode_legacy(data)
+
+    data = str(data)
+    version, tag, flags = ord(data[0]), data[1], ord(data[2])
+    if version != VERSION:
+        raise ValueError("Unknown value encoding version %d" % version)
+
+    payload = data[3:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+
+    if tag == TAG_BYTES:
+        return payload
+    elif tag == TAG_TEXT:
+        return payload.decode('utf-8')
+    elif tag == TAG_JSON:
+        return json.loads(payload)
+    elif tag == TAG_LITERAL:
+        return ast.literal_eval(payload)
+    raise ValueError("Unknown value type tag %r" % tag)
+
+
+def decode_legacy(text):
+    """ Decode a value stored by its str(), as values were before
+    this encoding """
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError, TypeError):
+        return text
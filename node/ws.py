@@ -8,6 +8,8 @@ import obelisk
 import pybitcointools
 from pybitcointools import *
 
+import tornado.concurrent
+import tornado.gen
 import tornado.websocket
 from zmq.eventloop import ioloop
 from twisted.internet import reactor
@@ -66,6 +68,7 @@ class ProtocolHandler:
             "import_raw_contract": self.client_import_raw_contract,
             "create_contract": self.client_create_contract,
             "clear_dht_data": self.client_clear_dht_data,
+            "query_dht_usage": self.client_query_dht_usage,
             "clear_peers_data": self.client_clear_peers_data,
             "read_log": self.client_read_log,
             "create_backup": self.client_create_backup,
@@ -74,7 +77,7 @@ class ProtocolHandler:
 
         self._timeouts = []
 
-        # unused for now, wipe it if you want later.
+        # Watches the Futures returned by coroutine handlers, see handle_request
         self.loop = loop_instance
 
         self._log = logging.getLogger(
@@ -174,11 +177,21 @@ class ProtocolHandler:
 
     def client_clear_dht_data(self, socket_handler, msg):
         self._log.debug('Clearing DHT Data')
-        self._db.deleteEntries("datastore")
+        self._transport._dht._dataStore.clear()
+
+    def client_query_dht_usage(self, socket_handler, msg):
+        self._log.debug('Querying DHT storage usage')
+        data_store = self._transport._dht._dataStore
+        self.send_to_client(None, {
+            "type": "dht_usage",
+            "usage": data_store.usage(),
+            "cache": data_store.cacheStats()
+        })
 
     def client_clear_peers_data(self, socket_handler, msg):
         self._log.debug('Clearing Peers Data')
-        self._db.deleteEntries("peers")
+        self._db.write_behind.discard("peers")
+        self._db.write_behind.after_writes(self._db.deleteEntries, "peers")
 
     # Requests coming from the client
     def client_connect(self, socket_handler, msg):
@@ -193,15 +206,17 @@ class ProtocolHandler:
     def client_welcome_dismissed(self, socket_handler, msg):
         self._market.disable_welcome_screen()
 
+    @tornado.gen.coroutine
     def client_check_order_count(self, socket_handler, msg):
         self._log.debug('Checking order count')
+        count = yield self._db.executor.numEntries(
+            "orders",
+            {"market_id": self._transport._market_id,
+             "state": "Waiting for Payment"}
+        )
         self.send_to_client(None, {
             "type": "order_count",
-            "count": self._db.numEntries(
-                "orders",
-                "market_id = '%s' and state = '%s'" %
-                (self._transport._market_id, "Waiting for Payment")
-            )
+            "count": count
         })
 
     def refresh_peers(self):
@@ -248,6 +263,7 @@ class ProtocolHandler:
         #     lambda query_id=query_id: unreachable_market(query_id)
         # )
 
+    @tornado.gen.coroutine
     def client_query_orders(self, socket_handler=None, msg=None):
 
         self._log.info("Querying for Orders %s " % msg)
@@ -259,11 +275,11 @@ class ProtocolHandler:
 
         if msg is not None and 'merchant' in msg:
             if msg['merchant'] == 1:
-                orders = self._market.orders.get_orders(page, True)
+                orders = yield self._market.orders.get_orders_async(page, True)
             else:
-                orders = self._market.orders.get_orders(page, False)
+                orders = yield self._market.orders.get_orders_async(page, False)
         else:
-            orders = self._market.orders.get_orders(page)
+            orders = yield self._market.orders.get_orders_async(page)
 
         self.send_to_client(None, {
             "type": "myorders",
@@ -272,12 +288,13 @@ class ProtocolHandler:
             "orders": orders['orders']
         })
 
+    @tornado.gen.coroutine
     def client_query_contracts(self, socket_handler, msg):
 
         self._log.info("Querying for Contracts")
 
         page = msg['page'] if 'page' in msg else 0
-        contracts = self._market.get_contracts(page)
+        contracts = yield self._market.get_contracts_async(page)
 
         self.send_to_client(None, {
             "type": "contracts",
@@ -876,9 +893,20 @@ class ProtocolHandler:
         params = request["params"]
         # Create callback handler to write response to the socket.
         self._log.debug('found a handler!')
-        self._handlers[command](socket_handler, params)
+        result = self._handlers[command](socket_handler, params)
+
+        # Coroutine handlers fail on the Future they return
+        if isinstance(result, tornado.concurrent.Future):
+            self.loop.add_future(result, lambda future: self._handler_done(command, future))
         return True
 
+    def _handler_done(self, command, future):
+        try:
+            future.result()
+        except Exception as e:
+            self._log.exception('Handler for %s failed' % command)
+            self.send_to_client(str(e) or e.__class__.__name__, {"type": command})
+
     def get_peers(self):
         peers = []
 
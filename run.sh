@@ -20,6 +20,7 @@ OPTIONS:
   -c    Bitmessage API port
   -u    Market ID
   -j    Disable upnp
+  -f    Database profile (throughput or durability)
 EOF
 }
 
@@ -38,6 +39,7 @@ DEVELOPMENT=0
 SEED_URI='seed.openbazaar.org seed2.openbazaar.org'
 LOG_FILE=production.log
 DISABLE_UPNP=0
+DB_PROFILE=throughput
 
 # CRITICAL   50
 # ERROR      40
@@ -63,7 +65,7 @@ TOR_HASHED_CONTROL_PASSWORD=
 TOR_PROXY_IP=127.0.0.1
 TOR_PROXY_PORT=7000
 
-while getopts "hp:l:dn:a:b:c:u:oi:j" OPTION
+while getopts "hp:l:dn:a:b:c:u:oi:jf:" OPTION
 do
      case ${OPTION} in
          h)
@@ -103,6 +105,9 @@ do
          j)
              DISABLE_UPNP=1
              ;;
+         f)
+             DB_PROFILE=$OPTARG
+             ;;
          ?)
              usage
              exit
@@ -138,7 +143,7 @@ if [ "$SEED_MODE" == 1 ]; then
        wait
     fi
 
-    $PYTHON node/tornadoloop.py $SERVER_IP -p $SERVER_PORT $DISABLE_UPNP -s 1 --bmuser $BM_USERNAME --bmpass $BM_PASSWORD --bmport $BM_PORT -l $LOGDIR/production.log -u 1 --log_level $LOG_LEVEL &
+    $PYTHON node/tornadoloop.py $SERVER_IP -p $SERVER_PORT $DISABLE_UPNP -s 1 --bmuser $BM_USERNAME --bmpass $BM_PASSWORD --bmport $BM_PORT -l $LOGDIR/production.log -u 1 --log_level $LOG_LEVEL --db_profile $DB_PROFILE &
 
 elif [ "$DEVELOPMENT" == 0 ]; then
     echo "Production Mode"
@@ -150,7 +155,7 @@ elif [ "$DEVELOPMENT" == 0 ]; then
        wait
     fi
 
-	$PYTHON node/tornadoloop.py $SERVER_IP -p $SERVER_PORT $DISABLE_UPNP --bmuser $BM_USERNAME --bmpass $BM_PASSWORD --bmport $BM_PORT -S $SEED_URI -l $LOGDIR/production.log -u 1 --log_level $LOG_LEVEL &
+	$PYTHON node/tornadoloop.py $SERVER_IP -p $SERVER_PORT $DISABLE_UPNP --bmuser $BM_USERNAME --bmpass $BM_PASSWORD --bmport $BM_PORT -S $SEED_URI -l $LOGDIR/production.log -u 1 --log_level $LOG_LEVEL --db_profile $DB_PROFILE &
 
 else
 	# Primary Market - No SEED_URI specified
@@ -163,7 +168,7 @@ else
        wait
     fi
 
-	$PYTHON node/tornadoloop.py 127.0.0.1 $DISABLE_UPNP --database db/ob-dev.db -s 1 --bmuser $BM_USERNAME -d --bmpass $BM_PASSWORD --bmport $BM_PORT -l $LOGDIR/development.log -u 1 --log_level $LOG_LEVEL &
+	$PYTHON node/tornadoloop.py 127.0.0.1 $DISABLE_UPNP --database db/ob-dev.db -s 1 --bmuser $BM_USERNAME -d --bmpass $BM_PASSWORD --bmport $BM_PORT -l $LOGDIR/development.log -u 1 --log_level $LOG_LEVEL --db_profile $DB_PROFILE &
     ((NODES=NODES+1))
     i=2
     while [[ $i -le $NODES ]]
@@ -175,7 +180,7 @@ else
            $PYTHON node/setup_db.py db/ob-dev-$i.db
            wait
         fi
-	    $PYTHON node/tornadoloop.py 127.0.0.$i $DISABLE_UPNP --database db/ob-dev-$i.db -d --bmuser $BM_USERNAME --bmpass $BM_PASSWORD --bmport $BM_PORT -S 127.0.0.1 -l $LOGDIR/development.log -u $i --log_level $LOG_LEVEL &
+	    $PYTHON node/tornadoloop.py 127.0.0.$i $DISABLE_UPNP --database db/ob-dev-$i.db -d --bmuser $BM_USERNAME --bmpass $BM_PASSWORD --bmport $BM_PORT -S 127.0.0.1 -l $LOGDIR/development.log -u $i --log_level $LOG_LEVEL --db_profile $DB_PROFILE &
 	    ((i=i+1))
     done
 fi
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import sys
+import unittest
+
+# Add root directory of the project to our path in order to import chunked_value
+dir_of_executable = os.path.dirname(__file__)
+path_to_project_root = os.path.abspath(os.path.join(dir_of_executable, '..'))
+sys.path.insert(0, path_to_project_root)
+from node import chunked_value
+from node.chunked_value import Reassembler
+
+
+class ChunkStore(object):
+    """ Answers lookups when told to, so chunks can arrive out of order """
+    def __init__(self, chunks):
+        self.chunks = dict(chunks)
+        self.lookups = []
+
+    def fetch(self, key, callback):
+        self.lookups.append((key, callback))
+
+    def answer(self, position):
+        key, callback = self.lookups.pop(position)
+        callback(self.chunks.get(key, []))
+
+
+class TestChunkedValue(unittest.TestCase):
+    def setUp(self):
+        self.value = "-----BEGIN PGP SIGNED MESSAGE-----" + "x" * 100 + u"\u20ac".encode('utf-8') * 10
+        self.manifest, self.chunks = chunked_value.split(self.value, chunk_size=16)
+        self.results = []
+
+    def test_split(self):
+        self.assertEqual(chunked_value.split("small", chunk_size=16), (None, None))
+        self.assertEqual(chunked_value.split({"listings": []}, chunk_size=16), (None, None))
+
+        # Chunks are addressed by their contents and listed in the manifest
+        self.assertTrue(chunked_value.is_manifest(self.manifest))
+        self.assertEqual(self.manifest['chunked_value']['chunks'], [key for key, _ in self.chunks])
+        for key, chunk in self.chunks:
+            self.assertEqual(key, hashlib.sha1(chunk).hexdigest())
+            chunk.decode('utf-8')
+        self.assertEqual(''.join(chunk for _, chunk in self.chunks), self.value)
+
+    def test_reassembly(self):
+        store = ChunkStore(self.chunks)
+        Reassembler(self.manifest, store.fetch, self.results.append, window=3).start()
+        self.assertEqual(len(store.lookups), 3)
+
+        # Chunks arriving early wait for their turn
+        store.answer(2)
+        store.answer(1)
+        self.assertEqual(len(store.lookups), 1)
+        while store.lookups:
+            store.answer(0)
+        self.assertEqual(self.results, [self.value])
+
+    def test_streaming(self):
+        store = ChunkStore(self.chunks)
+        received = []
+        Reassembler(self.manifest, store.fetch, self.results.append, on_chunk=received.append).start()
+        while store.lookups:
+            store.answer(len(store.lookups) - 1)
+        self.assertEqual(''.join(received), self.value)
+        self.assertEqual(self.results, [True])
+
+    def test_synchronous_fetch(self):
+        # Chunks answered from the local store arrive before fetch returns
+        store = dict(self.chunks)
+
+        def fetch(key, callback):
+            callback(store[key])
+
+        for window in (1, 3):
+            self.results = []
+            Reassembler(self.manifest, fetch, self.results.append, window=window).start()
+            self.assertEqual(self.results, [self.value])
+
+            received = []
+            self.results = []
+            Reassembler(self.manifest, fetch, self.results.append,
+                        on_chunk=received.append, window=window).start()
+            self.assertEqual(''.join(received), self.value)
+            self.assertEqual(self.results, [True])
+
+    def test_missing_chunk(self):
+        store = ChunkStore(self.chunks[1:])
+        Reassembler(self.manifest, store.fetch, self.results.append).start()
+        while store.lookups:
+            store.answer(0)
+        self.assertEqual(self.results, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
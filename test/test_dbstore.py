@@ -8,14 +8,26 @@
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 import os
 import sys
+import threading
+import time
 import unittest
 
 # Add root directory of the project to our path in order to import db_store
 dir_of_executable = os.path.dirname(__file__)
 path_to_project_root = os.path.abspath(os.path.join(dir_of_executable, '..'))
 sys.path.insert(0, path_to_project_root)
-from node.db_store import Obdb
-from node.setup_db import setup_db
+from pysqlcipher import dbapi2 as sqlite
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from node.db_executor import DbExecutor
+from node.db_store import Obdb, resolve_pragmas
+from node.db_write_behind import WriteBehindQueue
+from node.datastore import DictDataStore, MongoDataStore, SqliteDataStore
+from node.settings_cache import SettingsCache
+from node.value_cache import ValueCache, sizeof
+from node import constants, value_codec
+from node.setup_db import setup_db, migrate_db, MIGRATIONS
 
 TEST_DB_PATH = "test/test_ob.db"
 
@@ -31,13 +43,32 @@ def tearDownModule():
     # Cleanup.
     print "Cleaning up."
     print os.remove(TEST_DB_PATH)
+    # Files left behind by write-ahead logging
+    for suffix in ("-wal", "-shm"):
+        if os.path.isfile(TEST_DB_PATH + suffix):
+            os.remove(TEST_DB_PATH + suffix)
 
 
-class TestDbOperations(unittest.TestCase):
-    def test_insert_select_operations(self):
-
+class DbTestCase(unittest.TestCase):
+    def setUp(self):
         # Initialize our db instance
-        db = Obdb(TEST_DB_PATH)
+        self.db = Obdb(TEST_DB_PATH)
+
+    def tearDown(self):
+        # Closing also writes out anything still queued
+        self.db.close()
+
+
+class DataStoreTestCase(DbTestCase):
+    def setUp(self):
+        # Start from an empty datastore table
+        DbTestCase.setUp(self)
+        self.db.deleteEntries("datastore")
+        self.key = "key".encode("hex")
+
+
+class TestDbOperations(DbTestCase):
+    def test_insert_select_operations(self):
 
         # Create a dictionary of a random review
         review_to_store = {"pubKey": "123",
@@ -47,10 +78,10 @@ class TestDbOperations(unittest.TestCase):
                            "rating": 10}
 
         # Use the insert operation to add it to the db
-        db.insertEntry("reviews", review_to_store)
+        self.db.insertEntry("reviews", review_to_store)
 
         # Try to retrieve the record we just added based on the pubkey
-        retrieved_review = db.selectEntries("reviews", "pubkey = '123'")
+        retrieved_review = self.db.selectEntries("reviews", "pubkey = '123'")
 
         # The above statement will return a list with all the
         # retrieved records as dictionaries
@@ -86,38 +117,625 @@ class TestDbOperations(unittest.TestCase):
 
     def test_update_operation(self):
 
-        # Initialize our db instance
-        db = Obdb(TEST_DB_PATH)
-
         # Retrieve the record with pubkey equal to '123'
-        retrieved_review = db.selectEntries("reviews", "pubkey = '123'")[0]
+        retrieved_review = self.db.selectEntries("reviews", "pubkey = '123'")[0]
 
         # Check that the rating is still '10' as expected
         self.assertEqual(retrieved_review["rating"], 10)
 
         # Update the record with pubkey equal to '123'
         # and lower its rating to 9
-        db.updateEntries("reviews", {"pubkey": "123"}, {"rating": 9})
+        self.db.updateEntries("reviews", {"pubkey": "123"}, {"rating": 9})
 
         # Retrieve the same record again
-        retrieved_review = db.selectEntries("reviews", "pubkey = '123'")[0]
+        retrieved_review = self.db.selectEntries("reviews", "pubkey = '123'")[0]
 
         # Test that the rating has been updated succesfully
         self.assertEqual(retrieved_review["rating"], 9)
 
     def test_delete_operation(self):
 
-        # Initialize our db instance
-        db = Obdb(TEST_DB_PATH)
-
         # Delete the entry with pubkey equal to '123'
-        db.deleteEntries("reviews", {"pubkey": "123"})
+        self.db.deleteEntries("reviews", {"pubkey": "123"})
 
         # Looking for this record with will bring nothing
-        retrieved_review = db.selectEntries("reviews", "pubkey = '123'")
+        retrieved_review = self.db.selectEntries("reviews", "pubkey = '123'")
         self.assertEqual(len(retrieved_review), 0)
 
 
+class TestConnectionPool(unittest.TestCase):
+    def test_connection_per_thread(self):
+
+        # A pooled instance keeps one connection per thread
+        db = Obdb(TEST_DB_PATH, pool_size=1)
+        db.numEntries("reviews")
+        con = db._acquire()
+        db.numEntries("reviews")
+        self.assertIs(db._acquire(), con)
+
+        # Closing releases the pool; the next call reconnects on demand
+        db.close()
+        self.assertEqual(len(db._pool), 0)
+        db.numEntries("reviews")
+        self.assertEqual(len(db._pool), 1)
+        db.close()
+
+
+class TestParameterizedQueries(DbTestCase):
+    def test_quoted_values(self):
+
+        # Values are bound, not formatted into the query, so quotes are safe
+        self.db.insertEntry("reviews", {"pubKey": "456",
+                                        "subject": "It's a 'quoted' review",
+                                        "rating": 5})
+
+        # WHERE clauses can be given as a dictionary...
+        retrieved_review = self.db.selectEntries("reviews", {"pubKey": "456"})
+        self.assertEqual(len(retrieved_review), 1)
+        self.assertEqual(retrieved_review[0]["subject"], "It's a 'quoted' review")
+
+        # ...or as a clause with placeholders and its parameters
+        self.db.updateEntries("reviews", {"pubKey": "456"}, {"rating": 4})
+        retrieved_review = self.db.selectEntries("reviews", ("pubKey = ? and rating < ?", ("456", 5)))
+        self.assertEqual(retrieved_review[0]["rating"], 4)
+        self.assertEqual(self.db.numEntries("reviews", {"pubKey": "456"}), 1)
+
+        self.db.deleteEntries("reviews", {"pubKey": "456"})
+        self.assertEqual(self.db.numEntries("reviews", {"pubKey": "456"}), 0)
+
+
+class TestTransactions(DbTestCase):
+    def tearDown(self):
+        self.db.deleteEntries("reviews", {"pubKey": "789"})
+        DbTestCase.tearDown(self)
+
+    def test_commit(self):
+
+        # Everything inside the block is committed together
+        with self.db.transaction():
+            self.db.insertEntry("reviews", {"pubKey": "789", "rating": 1})
+            self.db.updateEntries("reviews", {"pubKey": "789"}, {"rating": 2})
+        self.assertEqual(self.db.selectEntries("reviews", {"pubKey": "789"})[0]["rating"], 2)
+
+    def test_rollback(self):
+        self.db.insertEntry("reviews", {"pubKey": "789", "rating": 1})
+
+        # A block that fails is rolled back as a whole
+        try:
+            with self.db.transaction():
+                self.db.deleteEntries("reviews", {"pubKey": "789"})
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(self.db.numEntries("reviews", {"pubKey": "789"}), 1)
+
+
+class TestBulkOperations(DbTestCase):
+    def setUp(self):
+        DbTestCase.setUp(self)
+        self.ids = self.db.insertMany("reviews", [{"pubKey": "bulk", "subject": "a", "rating": 1},
+                                                  {"pubKey": "bulk", "subject": "b", "rating": 2}])
+
+    def tearDown(self):
+        self.db.deleteEntries("reviews", {"pubKey": "bulk"})
+        DbTestCase.tearDown(self)
+
+    def test_insert_many(self):
+
+        # Insert several records at once and get their ids back
+        self.assertEqual(len(self.ids), 2)
+        self.assertEqual(self.db.selectEntries("reviews", {"id": self.ids[1]})[0]["subject"], "b")
+
+        # Rows skipped on a conflict have no id
+        ignored = self.db.insertMany("reviews", [{"id": self.ids[0], "pubKey": "bulk", "subject": "x", "rating": 1},
+                                                 {"id": self.ids[1] + 100, "pubKey": "bulk", "subject": "y", "rating": 1}],
+                                     on_conflict="IGNORE")
+        self.assertEqual(ignored, [None, self.ids[1] + 100])
+
+    def test_upsert_many(self):
+
+        # Upserting updates existing records and inserts the missing ones
+        upserted = self.db.upsertMany("reviews", [{"pubKey": "bulk", "subject": "a", "rating": 3},
+                                                  {"pubKey": "bulk", "subject": "c", "rating": 4}],
+                                      ("pubKey", "subject"))
+        self.assertEqual(upserted[0], self.ids[0])
+        self.assertEqual(self.db.selectEntries("reviews", {"id": self.ids[0]})[0]["rating"], 3)
+        self.assertEqual(self.db.numEntries("reviews", {"pubKey": "bulk"}), 3)
+
+
+class TestSchemaMigrations(DbTestCase):
+    def version(self):
+        return self.db.selectEntries("schema_version", order_field="version")[0]["version"]
+
+    def test_latest_version(self):
+
+        # A fresh db is created at the latest schema version
+        self.assertEqual(self.version(), len(MIGRATIONS))
+
+        # Running the migrations again is a no-op
+        migrate_db(TEST_DB_PATH)
+        self.assertEqual(self.version(), len(MIGRATIONS))
+
+    def test_indexes(self):
+
+        # Lookup columns are indexed
+        indexes = self.db.selectEntries("sqlite_master", {"type": "index"}, order_field="name")
+        index_names = [index["name"] for index in indexes]
+        self.assertIn("datastore_market_id_key", index_names)
+        self.assertIn("peers_guid", index_names)
+
+    def test_failing_step(self):
+
+        # A failing step is rolled back and its error raised, whether it
+        # comes from the database or from the step's own code
+        def failing_step(cur):
+            cur.execute("CREATE TABLE half_migrated(id INT)")
+            raise ValueError("bad legacy row")
+
+        for step, error in [(lambda cur: cur.execute("CREATE TABLE peers(id INT)"), sqlite.DatabaseError),
+                            (failing_step, ValueError)]:
+            MIGRATIONS.append(step)
+            try:
+                self.assertRaises(error, migrate_db, TEST_DB_PATH)
+            finally:
+                MIGRATIONS.pop()
+            self.assertEqual(self.version(), len(MIGRATIONS))
+        self.assertEqual(self.db.numEntries("sqlite_master", {"name": "half_migrated"}), 0)
+
+
+class TestPragmaProfiles(unittest.TestCase):
+    def test_throughput(self):
+
+        # The throughput profile switches the db to write-ahead logging
+        db = Obdb(TEST_DB_PATH, pragmas=resolve_pragmas('throughput', {'synchronous': 'FULL'}))
+        with db.transaction():
+            with db._connection() as con:
+                self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()["journal_mode"], "wal")
+                self.assertEqual(con.execute("PRAGMA synchronous").fetchone()["synchronous"], 2)
+        db.close()
+
+    def test_validation(self):
+
+        # Only known PRAGMAs are accepted
+        self.assertRaises(ValueError, resolve_pragmas, 'unknown')
+        self.assertRaises(ValueError, resolve_pragmas, None, {'foreign_keys': 'ON'})
+        self.assertRaises(ValueError, resolve_pragmas, None, {'synchronous': 'FULL; DROP TABLE peers'})
+
+
+class TestIterEntries(DbTestCase):
+    def test_chunks(self):
+        self.db.insertMany("reviews", [{"pubKey": "stream", "rating": rating} for rating in range(5)])
+
+        # Rows are streamed in chunks, optionally with only some columns
+        rows = list(self.db.iterEntries("reviews", {"pubKey": "stream"}, select_fields=["rating"], chunk_size=2))
+        self.assertEqual([row["rating"] for row in rows], range(5))
+        self.assertEqual(sorted(rows[0].keys()), ["id", "rating"])
+
+        rows = self.db.iterEntries("reviews", {"pubKey": "stream"}, order="DESC", chunk_size=2)
+        self.assertEqual([row["rating"] for row in rows], range(4, -1, -1))
+
+        self.db.deleteEntries("reviews", {"pubKey": "stream"})
+
+
+class TestDbExecutor(DbTestCase):
+    def setUp(self):
+        DbTestCase.setUp(self)
+        self.io_loop = IOLoop()
+        self.executor = DbExecutor(self.db, readers=2, io_loop=self.io_loop)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        DbTestCase.tearDown(self)
+        self.io_loop.close()
+
+    def test_futures(self):
+        reviews = self.db.numEntries("reviews")
+
+        @gen.coroutine
+        def run():
+            ids = yield self.executor.insertMany("reviews", [{"pubKey": "a", "subject": "s1"},
+                                                             {"pubKey": "b", "subject": "s2"}])
+            count, rows = yield [self.executor.numEntries("reviews"),
+                                 self.executor.selectEntries("reviews", {"pubKey": "b"})]
+            raise gen.Return((ids, count, rows))
+
+        ids, count, rows = self.io_loop.run_sync(run)
+        self.assertEqual(count, reviews + 2)
+        self.assertEqual(rows[0]["id"], ids[1])
+
+    def test_errors(self):
+
+        # Errors raised on a worker thread surface at the yield
+        self.assertRaises(Exception, self.io_loop.run_sync,
+                          lambda: self.executor.selectEntries("no_such_table"))
+
+
+class TestWriteBehindQueue(DbTestCase):
+    def queue(self, **kwargs):
+        queue = WriteBehindQueue(self.db, io_loop=IOLoop(), **kwargs)
+        queue.register("reviews", lambda rows: self.db.insertMany("reviews", rows))
+        return queue
+
+    def test_coalesce(self):
+        queue = self.queue(batch_size=3)
+        reviews = self.db.numEntries("reviews")
+
+        # Rows queued under the same key coalesce and can be read back
+        queue.put("reviews", "a", {"pubKey": "a", "subject": "old"})
+        queue.put("reviews", "a", {"pubKey": "a", "subject": "new"})
+        queue.put("reviews", "b", {"pubKey": "b", "subject": "s2"})
+        self.assertEqual(queue.get("reviews", "a")["subject"], "new")
+        self.assertEqual(queue.keys("reviews"), set(["a", "b"]))
+        self.assertEqual(self.db.numEntries("reviews"), reviews)
+
+        # The batch size triggers a flush; closing waits for it to be written
+        queue.put("reviews", "c", {"pubKey": "c", "subject": "s3"})
+        self.db.close()
+        self.assertEqual(self.db.numEntries("reviews"), reviews + 3)
+        self.assertIsNone(queue.get("reviews", "a"))
+
+        stats = queue.stats()
+        self.assertEqual((stats['queued'], stats['coalesced']), (4, 1))
+        self.assertEqual((stats['flushes'], stats['flushed_rows']), (1, 3))
+        self.assertEqual((stats['pending'], stats['in_flight']), (0, 0))
+
+    def test_after_writes(self):
+        queue = self.queue()
+
+        # Direct deletes run after the rows already handed to the writer
+        queue.put("reviews", "d", {"pubKey": "d", "subject": "s4"})
+        queue.flush()
+        queue.discard("reviews")
+        queue.after_writes(self.db.deleteEntries, "reviews", {"pubKey": "d"})
+        self.db.close()
+        self.assertEqual(self.db.numEntries("reviews", {"pubKey": "d"}), 0)
+
+    def test_put_many(self):
+        queue = self.queue()
+
+        # Rows queued together are written in one batch
+        queue.putMany("reviews", [(key, {"pubKey": key, "subject": "many"}) for key in ("e", "f")])
+        queue.flush()
+        self.db.close()
+        self.assertEqual(self.db.numEntries("reviews", {"subject": "many"}), 2)
+        self.assertEqual(queue.stats()['flushes'], 1)
+
+    def test_retries(self):
+        queue = WriteBehindQueue(self.db, flush_interval=0, retries=2, io_loop=IOLoop())
+        failures = [Exception("locked"), Exception("locked")]
+
+        def write(rows):
+            if failures:
+                raise failures.pop()
+            self.db.insertMany("reviews", rows)
+
+        # A failing batch is retried until it is written...
+        queue.register("reviews", write)
+        reviews = self.db.numEntries("reviews")
+        queue.put("reviews", "a", {"pubKey": "a", "subject": "retried"})
+        queue.flush()
+        self.db.close()
+        self.assertEqual(self.db.numEntries("reviews"), reviews + 1)
+        stats = queue.stats()
+        self.assertEqual((stats['failed_flushes'], stats['flushes'], stats['dropped_rows']), (2, 1, 0))
+
+        # ...or dropped, and counted, once it has run out of retries
+        failures.extend([Exception("locked")] * 3)
+        queue.put("reviews", "b", {"pubKey": "b", "subject": "dropped"})
+        queue.flush()
+        self.db.close()
+        self.assertEqual(self.db.numEntries("reviews"), reviews + 1)
+        stats = queue.stats()
+        self.assertEqual((stats['failed_flushes'], stats['dropped_rows'], stats['in_flight']), (5, 1, 0))
+
+
+class TestWriteBehindBackpressure(DataStoreTestCase):
+    def setUp(self):
+        DataStoreTestCase.setUp(self)
+        self.queue = self.db._write_behind = WriteBehindQueue(self.db, batch_size=1, max_in_flight=1,
+                                                              io_loop=IOLoop())
+        self.written = threading.Event()
+        self.queue.register("reviews", lambda rows: self.written.wait())
+        self.store = SqliteDataStore(self.db, guid="f" * 40)
+
+        # Stall the writer on its first row
+        self.assertTrue(self.queue.put("reviews", "a", {"pubKey": "a", "subject": "s1"}))
+
+    def tearDown(self):
+        self.written.set()
+        DataStoreTestCase.tearDown(self)
+
+    def test_refuses(self):
+
+        # While the writer is stalled new rows are refused right away
+        start = time.time()
+        self.assertFalse(self.queue.put("reviews", "b", {"pubKey": "b", "subject": "s2"}))
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(self.queue.full())
+        self.assertFalse(self.store.setItem("stalled".encode("hex"), "value", 10, 5, "publisher"))
+        self.assertEqual(self.store.usage()['rejected'], 1)
+        self.assertEqual(self.queue.stats()['refused_rows'], 1)
+
+    def test_own_data(self):
+
+        # Data we published is never refused, it is queued regardless
+        own = "own".encode("hex")
+        self.assertTrue(self.queue.full())
+        self.assertTrue(self.store.setItem(own, "mine", 10, 5, "f" * 40))
+        self.assertEqual(self.store[own], "mine")
+        self.assertEqual(self.store.usage()['rejected'], 0)
+        self.written.set()
+        self.db.close()
+        self.assertEqual(len(self.db.selectEntries("datastore", {"key": own})), 1)
+
+    def test_blocking_put(self):
+
+        # Threads other than the IOLoop can wait for the writer instead
+        blocked = threading.Thread(target=self.queue.put, args=("reviews", "c", {"pubKey": "c", "subject": "s3"}, True))
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+        self.written.set()
+        blocked.join()
+        self.db.close()
+        self.assertFalse(self.queue.full())
+        self.assertEqual(self.queue.stats()['backpressure_waits'], 1)
+
+
+class TestSettingsCache(DbTestCase):
+    def tearDown(self):
+        self.db.deleteEntries("settings", {"market_id": 7})
+        DbTestCase.tearDown(self)
+
+    def test_settings_cache(self):
+        self.db.insertEntry("settings", {"market_id": 7, "privkey": "1" * 64, "notaries": "['guid1']"})
+        cache = SettingsCache(self.db, 7)
+
+        settings = cache.get()
+        self.assertEqual(settings['notaries'], ['guid1'])
+        self.assertEqual(settings['btc_pubkey'][:2], "04")
+
+        # Callers get copies
+        settings['notaries'].append('guid2')
+        self.assertEqual(cache.get()['notaries'], ['guid1'])
+
+        # Writes to the settings table invalidate the cache; inside a
+        # transaction only once it has been committed
+        with self.db.transaction():
+            self.db.updateEntries("settings", {"market_id": 7}, {"notaries": "['guid3']"})
+            self.assertEqual(cache.row()['notaries'], "['guid1']")
+        self.assertEqual(cache.get()['notaries'], ['guid3'])
+
+
+class TestSqliteDataStore(DataStoreTestCase):
+    def setUp(self):
+        DataStoreTestCase.setUp(self)
+        self.store = SqliteDataStore(self.db)
+        self.store.setItem(self.key, {"notaries": ["guid1"]}, 10, 5, "publisher")
+
+    def test_in_memory(self):
+        self.assertIn(self.key, self.store)
+        self.assertEqual(self.store[self.key], {"notaries": ["guid1"]})
+        self.assertEqual(self.store.originalPublisherID(self.key), "publisher")
+        self.assertEqual(self.store.keys(), [self.key])
+        self.assertNotIn("missing", self.store)
+        self.assertIsNone(self.store["missing"])
+
+    def test_warm_from_table(self):
+
+        # Closing flushes the queue; a new store is warmed from the table
+        self.db.close()
+        self.assertEqual(self.db.numEntries("datastore", {"key": self.key}), 1)
+        store = SqliteDataStore(self.db)
+        self.assertEqual(store[self.key], {"notaries": ["guid1"]})
+        self.assertEqual(store.lastPublished(self.key), 10)
+        self.assertEqual(store.originalPublishTime(self.key), 5)
+
+    def test_update_keeps_id(self):
+
+        # Updates keep the entry's id
+        self.db.close()
+        row_id = self.db.selectEntries("datastore", {"key": self.key})[0]["id"]
+        self.store.setItem(self.key, {"notaries": ["guid1"]}, 11, 5, "publisher")
+        self.db.close()
+        self.assertEqual([row["id"] for row in self.db.selectEntries("datastore", {"key": self.key})], [row_id])
+
+    def test_delete(self):
+        del self.store[self.key]
+        self.assertNotIn(self.key, self.store)
+        self.db.close()
+        self.assertEqual(self.db.numEntries("datastore", {"key": self.key}), 0)
+
+
+class TestDataStoreRecords(DataStoreTestCase):
+    def setUp(self):
+        DataStoreTestCase.setUp(self)
+        self.store = SqliteDataStore(self.db)
+        self.store.setItem(self.key, {"notaries": ["guid1"]}, 10, 5, "publisher")
+
+    def test_records(self):
+        record = self.store.getRecord(self.key)
+        self.assertEqual((record.key, record.value, record.originalPublisherID),
+                         (self.key, {"notaries": ["guid1"]}, "publisher"))
+        self.assertIsNone(self.store.getRecord("missing"))
+        self.assertEqual([r.key for r in self.store.iterRecords()], [self.key])
+
+    def test_mongo_datastore(self):
+        self.db.close()
+
+        # The table can be read and written through MongoDataStore as well
+        mongo = MongoDataStore(self.db)
+        self.assertEqual(mongo.getRecord(self.key).value, {"notaries": ["guid1"]})
+        self.assertEqual(mongo[self.key], {"notaries": ["guid1"]})
+        mongo.setItem(self.key, {"notaries": ["guid2"]}, 10, 5, "publisher")
+        self.assertEqual([r.value for r in mongo.iterRecords()], [{"notaries": ["guid2"]}])
+
+
+class TestValueCodec(DbTestCase):
+    def test_round_trip(self):
+        for value in ["bytes", u"text \u20ac", {"notaries": ["guid1"]}, '{"a": 1}', 42, None,
+                      "x" * 5000, (1, 2), {1: "a"}]:
+            encoded = value_codec.encode(value)
+            self.assertEqual(value_codec.decode(buffer(encoded)), value)
+            self.assertEqual(type(value_codec.decode(buffer(encoded))), type(value))
+
+        # Large values are compressed
+        self.assertLess(len(value_codec.encode("x" * 5000)), 100)
+
+    def test_legacy_values(self):
+
+        # Values stored before the migration come back as they used to
+        self.db.updateEntries("schema_version", {}, {"version": 1})
+        with self.db._connection() as con:
+            con.execute("DROP TABLE datastore")
+            con.execute("CREATE TABLE datastore(id INTEGER PRIMARY KEY AUTOINCREMENT, market_id INT, "
+                        "key TEXT, lastPublished TEXT, originallyPublished TEXT, "
+                        "originalPublisherID TEXT, value TEXT)")
+        self.db.insertEntry("datastore", {"key": "legacy", "value": {"listings": ["a"]}})
+        self.db.close()
+
+        migrate_db(TEST_DB_PATH)
+        value = self.db.selectEntries("datastore", {"key": "legacy"})[0]["value"]
+        self.assertIsInstance(value, buffer)
+        self.assertEqual(value_codec.decode(value), {"listings": ["a"]})
+        self.db.deleteEntries("datastore", {"key": "legacy"})
+
+
+class TestValueCache(unittest.TestCase):
+    def test_lru(self):
+        size = sizeof("aaaa")
+        cache = ValueCache(max_bytes=2 * size + 1)
+        cache.put("a", "aaaa")
+        cache.put("b", "bbbb")
+        self.assertEqual(cache.get("a"), "aaaa")
+
+        # Bounded by the size of the decoded values; the least recently
+        # used value goes first
+        cache.put("c", "cccc")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "cccc")
+        cache.put("d", "d" * 2 * size)
+        self.assertIsNone(cache.get("d"))
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (2, 2, 1))
+        self.assertEqual((stats['entries'], stats['bytes']), (2, 2 * size))
+
+    def test_copies(self):
+
+        # Containers count what they hold, and callers get their own copies
+        value = {"listings": ["a"]}
+        self.assertGreater(sizeof(value), sizeof({}) + sizeof(["a"]))
+        cache = ValueCache()
+        cache.put("e", value)
+        value["listings"].append("b")
+        cache.get("e")["listings"].append("c")
+        self.assertEqual(cache.get("e"), {"listings": ["a"]})
+
+    def test_dict_datastore(self):
+
+        # A DictDataStore reading through a cache sees every write
+        store = DictDataStore(cache=ValueCache())
+        store.setItem("key", {"listings": ["a"]}, 1, 1, "publisher", 1)
+        self.assertEqual(store["key"], {"listings": ["a"]})
+        store.setItem("key", {"listings": ["a", "b"]}, 1, 1, "publisher", 1)
+        self.assertEqual(store["key"], {"listings": ["a", "b"]})
+        store["key"]["listings"].append("c")
+        self.assertEqual(store["key"], {"listings": ["a", "b"]})
+        del store["key"]
+        self.assertRaises(KeyError, store.__getitem__, "key")
+
+
+class TestSqliteDataStoreCache(DataStoreTestCase):
+    def test_cache(self):
+
+        # SqliteDataStore serves values through its cache
+        store = SqliteDataStore(self.db, cache=ValueCache())
+        store.setItem(self.key, "value", 10, 5, "publisher")
+        self.db.close()
+        store = SqliteDataStore(self.db, cache=ValueCache())
+        self.assertEqual(store[self.key], "value")
+        self.assertEqual(store[self.key], "value")
+        self.assertEqual(store.getRecord(self.key).size, len(value_codec.encode("value")))
+        stats = store.cacheStats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+
+class TestDataStoreQuotas(DataStoreTestCase):
+    def setUp(self):
+        DataStoreTestCase.setUp(self)
+        self.size = len(value_codec.encode("v" * 10))
+
+    def test_value_limit(self):
+        store = SqliteDataStore(self.db, guid="f" * 40, max_value_bytes=self.size)
+
+        # Values over the size limit are refused, unless we published them
+        self.assertFalse(store.setItem("01", "v" * 11, 1, 1, "p1"))
+        self.assertTrue(store.setItem("02", "v" * 11, 1, 1, "f" * 40))
+        self.assertEqual(store.usage()['rejected'], 1)
+
+    def test_publisher_quota(self):
+        store = SqliteDataStore(self.db, guid="f" * 40, max_publisher_bytes=2 * self.size)
+
+        # A publisher over its quota loses its oldest data first
+        store.setItem("01", "v" * 10, 1, 1, "p1")
+        store.setItem("02", "v" * 10, 2, 2, "p1")
+        store.setItem("03", "v" * 10, 3, 3, "p1")
+        self.assertEqual(sorted(r.key for r in store.iterRecords(values=False)), ["02", "03"])
+        self.assertEqual(store.publisherUsage("p1"), 2 * self.size)
+
+    def test_total_quota(self):
+        store = SqliteDataStore(self.db, guid="f" * 40, max_bytes=3 * self.size)
+
+        # Over the total quota the oldest data of anyone goes
+        store.setItem("02", "v" * 10, 2, 2, "p1")
+        store.setItem("03", "v" * 10, 3, 3, "p1")
+        store.setItem("04", "v" * 10, 4, 4, "p2")
+        store.setItem("05", "v" * 10, 5, 5, "p2")
+        self.assertEqual(sorted(r.key for r in store.iterRecords(values=False)), ["03", "04", "05"])
+
+        usage = store.usage()
+        self.assertEqual((usage['bytes'], usage['records'], usage['evicted'], usage['rejected']),
+                         (3 * self.size, 3, 1, 0))
+        self.db.close()
+        self.assertEqual(sorted(row['key'] for row in self.db.selectEntries("datastore")), ["03", "04", "05"])
+
+    def test_refused_record(self):
+        store = SqliteDataStore(self.db, guid="f" * 40, max_bytes=3 * self.size, max_publisher_bytes=self.size)
+
+        # A record refused by the total quota costs its publisher nothing
+        store.setItem("01", "v" * 10, 1, 1, "p1")
+        for key in ("a1", "a2", "a3"):
+            store.setItem(key, "v" * 10, 1, 1, "f" * 40)
+        self.assertFalse(store.setItem("02", "v" * 10, 2, 2, "p1"))
+        self.assertIn("01", store)
+        self.assertEqual(store.usage()['evicted'], 0)
+
+    def test_farthest_policy(self):
+        store = SqliteDataStore(self.db, guid="0" * 40, max_bytes=3 * self.size, eviction='farthest')
+        for key in ("03", "04", "05"):
+            store.setItem(key, "v" * 10, 1, 1, "p2")
+
+        # The farthest policy evicts the keys farthest from our GUID
+        store.setItem("01", "v" * 10, 6, 6, "p3")
+        self.assertEqual(sorted(store.keys()), ["01", "03", "04"])
+        self.assertRaises(ValueError, SqliteDataStore, self.db, eviction='newest')
+
+    def test_deletes_in_chunks(self):
+        store = SqliteDataStore(self.db)
+        keys = ["%04x" % i for i in range(2 * constants.DB_MAX_VARIABLES + 1)]
+        store.setItems([(key, "v", 1, 1, "p1") for key in keys])
+
+        # Evicting many keys at once stays under SQLite's variable limit
+        deletes = []
+        delete = self.db.deleteEntries
+        self.db.deleteEntries = lambda table, where: deletes.append(len(where[1])) or delete(table, where)
+        store._deleteRows(keys)
+        self.db.close()
+        self.assertEqual(deletes, [constants.DB_MAX_VARIABLES, constants.DB_MAX_VARIABLES, 1])
+        self.assertEqual(self.db.numEntries("datastore"), 0)
+
+
 if __name__ == '__main__':
     # Run tests.
     unittest.main()
@@ -0,0 +1,237 @@
+import os
+import sys
+import unittest
+
+# Add root directory of the project to our path in order to import dht
+dir_of_executable = os.path.dirname(__file__)
+path_to_project_root = os.path.abspath(os.path.join(dir_of_executable, '..'))
+sys.path.insert(0, path_to_project_root)
+from node import constants
+from node.contact import ConnectionPool
+from node.db_store import Obdb
+from node.dht import DHT
+from node.routingtable import RoutingTable
+from node.setup_db import setup_db
+
+TEST_DB_PATH = "test/test_dht.db"
+MY_GUID = "f" * 40
+KEY = "0" * 40
+
+
+def setUpModule():
+    setup_db(TEST_DB_PATH)
+
+
+def tearDownModule():
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.isfile(TEST_DB_PATH + suffix):
+            os.remove(TEST_DB_PATH + suffix)
+
+
+class Connection(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg, callback=None):
+        self.sent.append(msg)
+
+    def check_port(self):
+        return False
+
+
+class Table(object):
+    """ The part of the routing table a search uses """
+    distance = staticmethod(RoutingTable.distance)
+
+    def __init__(self, contacts):
+        self.contacts = dict((contact.guid, contact) for contact in contacts)
+        self.failed = []
+
+    def findCloseNodes(self, key, count, nodeID=None):
+        return sorted(self.contacts.values(), key=lambda c: self.distance(c.guid, key))[:count]
+
+    def getContact(self, guid):
+        return self.contacts.get(guid)
+
+    def touchKBucket(self, key):
+        pass
+
+    def addContact(self, contact):
+        pass
+
+    def contactFailed(self, guid):
+        self.failed.append(guid)
+
+
+class Transport(object):
+    guid = _guid = MY_GUID
+    _uri = "tcp://127.0.0.1:12345"
+    pubkey = "mine"
+    _nickname = "me"
+
+    def __init__(self):
+        self.peers = {}  # GUID -> connection
+        self.saved = []  # Batches of peers queued for the database
+        self._connections = ConnectionPool(self.connect, 1)
+
+    def queue_peers_to_db(self, peer_tuples):
+        self.saved.append(peer_tuples)
+
+    def connect(self, contact):
+        return self.peers.setdefault(contact.guid, Connection())
+
+    def get_crypto_peer(self, guid=None, uri=None, pubkey=None, nickname=None):
+        return Connection()
+
+
+class Loop(object):
+    """ Timeouts that fire when the test says so """
+    def __init__(self):
+        self.timeouts = {}
+
+    def add_timeout(self, deadline, callback):
+        handle = object()
+        self.timeouts[handle] = callback
+        return handle
+
+    def remove_timeout(self, handle):
+        self.timeouts.pop(handle, None)
+
+    def fire(self):
+        for handle in list(self.timeouts):
+            self.timeouts.pop(handle)()
+
+
+class TestDHTSearch(unittest.TestCase):
+    def setUp(self):
+        self.loop = Loop()
+        self.db = Obdb(TEST_DB_PATH)
+        self.dht = DHT(Transport(), 1, {'guid': MY_GUID}, self.db, io_loop=self.loop)
+        self.contacts = [self.dht._transport._connections.contact("%x" % i * 40, "tcp://127.0.0.1:%s" % (1000 + i))
+                         for i in range(1, 6)]
+        self.dht._routingTable = Table(self.contacts)
+        self.results = []
+
+    def tearDown(self):
+        self.db.close()
+
+    def probed(self):
+        return [connection for connection in self.dht._transport.peers.values() if connection.sent]
+
+    def sent(self, contact):
+        return self.dht._transport.peers[contact.guid].sent
+
+    def answer(self, contact, **found):
+        msg = {'senderGUID': contact.guid, 'senderNick': '', 'pubkey': 'pubkey',
+               'uri': contact.uri, 'findID': self.sent(contact)[-1]['findID']}
+        msg.update(found or {'foundNodes': []})
+        self.dht.on_findNodeResponse(None, msg)
+
+    def test_lookup_converges_on_the_k_closest(self):
+        self.dht.iterativeFindNode(KEY, callback=self.results.append)
+        self.assertEqual(len(self.probed()), constants.alpha)
+
+        # An answer frees a slot, here for a closer node it told us about
+        closer = "0" * 39 + "9"
+        self.answer(self.contacts[0], foundNodes=[(closer, "tcp://127.0.0.1:2000", "theirs", "")])
+        self.assertEqual(self.dht._transport.peers[closer].sent[0]['key'], KEY)
+        self.assertEqual(self.dht._transport.saved, [[("theirs", "tcp://127.0.0.1:2000", closer, "")]])
+        self.assertIsNotNone(self.contacts[0].rtt)
+
+        # Nodes that do not answer in time are passed over
+        self.loop.fire()
+        self.assertEqual(len(self.probed()), 6)
+        self.assertEqual(self.results, [])
+        self.assertEqual(sorted(self.dht._routingTable.failed), [closer] + [c.guid for c in self.contacts[1:3]])
+
+        self.answer(self.contacts[3])
+        self.answer(self.contacts[4])
+        self.assertEqual([node[2] for node in self.results[0]],
+                         [self.contacts[0].guid, self.contacts[3].guid, self.contacts[4].guid])
+        self.assertEqual(self.dht._searches, {})
+        self.assertEqual(self.loop.timeouts, {})
+
+    def test_no_contacts(self):
+        self.dht._routingTable = Table([])
+        self.dht.iterativeFindNode(KEY, callback=self.results.append)
+        self.assertEqual(self.results, [[]])
+        self.assertEqual(self.dht._searches, {})
+        self.assertEqual(self.loop.timeouts, {})
+
+    def test_found_value_ends_the_search(self):
+        self.dht.iterativeFindValue(KEY, callback=self.results.append)
+        self.answer(self.contacts[1], foundKey={'listings': ['contract']})
+        self.assertEqual(self.results, [{'listings': ['contract']}])
+        self.assertEqual(self.dht._searches, {})
+        self.assertEqual(self.loop.timeouts, {})
+
+        # Late answers to a finished search are ignored
+        self.answer(self.contacts[0])
+        self.assertEqual(len(self.results), 1)
+
+    def test_searches_time_out(self):
+        self.dht.iterativeFindNode(KEY, callback=self.results.append)
+        self.answer(self.contacts[0])
+        self.assertIn(self.sent(self.contacts[0])[0]['findID'], self.dht._searches)
+
+        # The reaper ends searches running for too long with what they found
+        self.dht._searches.values()[0]._started -= constants.searchTimeout + 1
+        self.loop.timeouts.pop(self.dht._reaper)()
+        self.assertEqual([node[2] for node in self.results[0]], [self.contacts[0].guid])
+        self.assertEqual(self.dht._searches, {})
+        self.assertEqual(self.loop.timeouts, {})
+
+
+class TestActivePeers(unittest.TestCase):
+    def setUp(self):
+        self.db = Obdb(TEST_DB_PATH)
+        self.dht = DHT(Transport(), 1, {'guid': MY_GUID}, self.db, io_loop=Loop())
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_peer_reconnects_with_a_new_guid(self):
+        uri = "tcp://127.0.0.1:1001"
+        old, new = "1" * 40, "2" * 40
+        peer = self.dht._transport._connections.contact(old, uri, "pubkey", "nick")
+        self.dht._activePeers.append(peer)
+        self.dht._routingTable.addContact(peer)
+
+        # The same URI comes back under another GUID: the routing table
+        # only knows it by the new one
+        self.dht.add_peer(self.dht._transport, uri, "pubkey", new, "nick")
+        table = self.dht._routingTable
+        self.assertIsNone(table.getContact(old))
+        self.assertIs(table.getContact(new), peer)
+        self.assertEqual(table._contactIndex.keys(), [new])
+        self.assertEqual(sum(len(bucket) for bucket in table._buckets), 1)
+
+    def test_peer_keeps_its_place_in_a_full_bucket(self):
+        table = self.dht._routingTable
+        pool = self.dht._transport._connections
+        guids = ["%x" % (i % 8) + "%039x" % i for i in range(constants.k + 2)]
+        contacts = [pool.contact(guid, "tcp://127.0.0.1:%s" % (1000 + i)) for i, guid in enumerate(guids)]
+        for contact in contacts:
+            table.addContact(contact)
+        peer = contacts[0]
+        self.dht._activePeers.append(peer)
+        cached = list(table._replacementCache[0])
+        self.assertEqual(cached, guids[constants.k:])
+
+        # A new URI updates the peer where it is
+        self.dht.add_peer(self.dht._transport, "tcp://127.0.0.1:2000", None, peer.guid, None)
+        self.assertIs(table.getContact(peer.guid), peer)
+        self.assertEqual(peer.uri, "tcp://127.0.0.1:2000")
+        self.assertEqual(list(table._replacementCache[0]), cached)
+
+        # A new GUID does not let a cached contact take the peer's place
+        new = "7" * 40
+        self.dht.add_peer(self.dht._transport, peer.uri, None, new, None)
+        self.assertIsNone(table.getContact(guids[0]))
+        self.assertIs(table.getContact(new), peer)
+        self.assertEqual(len(table._buckets[0]), constants.k)
+        self.assertEqual(list(table._replacementCache[0]), cached)
+
+
+if __name__ == '__main__':
+    unittest.main()
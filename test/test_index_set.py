@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+import unittest
+
+# Add root directory of the project to our path in order to import index_set
+dir_of_executable = os.path.dirname(__file__)
+path_to_project_root = os.path.abspath(os.path.join(dir_of_executable, '..'))
+sys.path.insert(0, path_to_project_root)
+from node import index_set
+from node.index_set import IndexSet
+
+
+class TestIndexSet(unittest.TestCase):
+    def test_deltas(self):
+        add = index_set.parse(json.dumps({'keyword_index_add': 'contract1'}), 'guid1', 10)
+        self.assertEqual(add.to_value(), {'listings': ['contract1'],
+                                          'versions': {'contract1': [[10, 'guid1'], None]}})
+
+        # A delta only carries the element it changes
+        index = IndexSet.from_value('listings', {'listings': ['contract2']})
+        self.assertTrue(index.merge(add))
+        self.assertEqual(index.elements(), ['contract1', 'contract2'])
+        self.assertFalse(index.merge(add))
+
+        remove = index_set.parse({'keyword_index_remove': 'contract2'}, 'guid1', 11)
+        index.merge(remove)
+        self.assertEqual(index.to_value(versions=False), {'listings': ['contract1']})
+
+        # Notary indexes work the same way; other values are not indexes
+        notaries = index_set.parse('{"notary_index_add": "guid2"}', 'guid2', 10)
+        self.assertEqual(notaries.elements(), ['guid2'])
+        self.assertEqual(notaries.field, 'notaries')
+        self.assertIsNone(index_set.parse('not json', 'guid1', 10))
+        self.assertIsNone(index_set.parse({'contract': 1}, 'guid1', 10))
+
+    def test_replicas_converge(self):
+        updates = [index_set.parse({'keyword_index_add': 'c1'}, 'guid1', 10),
+                   index_set.parse({'keyword_index_remove': 'c1'}, 'guid2', 12),
+                   index_set.parse({'keyword_index_add': 'c1'}, 'guid1', 11),
+                   index_set.parse({'keyword_index_add': 'c2'}, 'guid2', 12),
+                   index_set.parse({'keyword_index_remove': 'c2', 'stamp': [12, 'guid2']}, 'guid3', 20)]
+
+        # The newest stamp wins whatever order the updates arrive in, adds
+        # winning ties
+        forward, backward = IndexSet('listings'), IndexSet('listings')
+        for update in updates:
+            forward.merge(update)
+        for update in reversed(updates):
+            backward.merge(update)
+        self.assertEqual(forward.to_value(), backward.to_value())
+        self.assertEqual(forward.elements(), ['c2'])
+
+        # Stored values round trip through JSON
+        stored = json.loads(json.dumps(forward.to_value()))
+        self.assertEqual(IndexSet.from_value('listings', stored).to_value(), forward.to_value())
+        self.assertEqual(index_set.public_value(stored), {'listings': ['c2']})
+
+
+if __name__ == '__main__':
+    unittest.main()
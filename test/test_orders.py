@@ -0,0 +1,98 @@
+import json
+import os
+import sys
+import unittest
+
+# Add root directory of the project to our path in order to import orders
+dir_of_executable = os.path.dirname(__file__)
+path_to_project_root = os.path.abspath(os.path.join(dir_of_executable, '..'))
+sys.path.insert(0, path_to_project_root)
+from node.contact import ConnectionPool
+from node.db_store import Obdb
+from node.orders import Orders
+from node.routingtable import OptimizedTreeRoutingTable
+from node.setup_db import setup_db
+
+TEST_DB_PATH = "test/test_orders.db"
+MY_GUID = "a" * 40
+SELLER_GUID = "b" * 40
+
+
+def setUpModule():
+    setup_db(TEST_DB_PATH)
+
+
+def tearDownModule():
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.isfile(TEST_DB_PATH + suffix):
+            os.remove(TEST_DB_PATH + suffix)
+
+
+class Connection(object):
+    def __init__(self, contact):
+        self._guid = contact.guid
+        self.encrypted = []
+
+    def encrypt(self, data):
+        self.encrypted.append(data)
+        return 'ciphertext'
+
+
+class DHT(object):
+    def __init__(self):
+        self._routingTable = OptimizedTreeRoutingTable(MY_GUID, 1)
+
+
+class Transport(object):
+    _guid = guid = MY_GUID
+    _market_id = 1
+    settings = {'PGPPubKey': 'pgp', 'city': 'Springfield'}
+
+    def __init__(self):
+        self._dht = DHT()
+        self.connections = []
+        self._connections = ConnectionPool(self.connect, 1)
+
+    def connect(self, contact):
+        self.connections.append(Connection(contact))
+        return self.connections[-1]
+
+    def add_callback(self, section, callback):
+        pass
+
+
+class GPG(object):
+    def sign(self, data, passphrase=None, keyid=None):
+        self.signed = data
+        return data
+
+
+class TestOrders(unittest.TestCase):
+    def setUp(self):
+        self.db = Obdb(TEST_DB_PATH)
+        self.transport = Transport()
+        self.orders = Orders(self.transport, 1, self.db)
+        self.orders._gpg = GPG()
+        self.sent = []
+        self.orders.send_order = lambda *args: self.sent.append(args)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_new_order_encrypts_for_routing_table_contact(self):
+        seller = self.transport._connections.contact(SELLER_GUID, "tcp://127.0.0.1:12345", "pubkey", "seller")
+        self.transport._dht._routingTable.addContact(seller)
+
+        self.orders.new_order({'sellerGUID': SELLER_GUID, 'btc_pubkey': 'btc', 'message': 'hi',
+                               'rawContract': 'contract', 'notary': 'notary'})
+
+        # The shipping address is encrypted over the pooled connection to the seller
+        connection, = self.transport.connections
+        self.assertEqual(connection._guid, SELLER_GUID)
+        self.assertEqual(json.loads(connection.encrypted[0])['city'], 'Springfield')
+        self.assertIn('ciphertext'.encode('hex'), self.orders._gpg.signed.replace('\n', ''))
+        self.assertEqual(len(self.sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import unittest
+
+from tornado.ioloop import IOLoop
+
+# Add root directory of the project to our path in order to import republisher
+dir_of_executable = os.path.dirname(__file__)
+path_to_project_root = os.path.abspath(os.path.join(dir_of_executable, '..'))
+sys.path.insert(0, path_to_project_root)
+from node.datastore import DataRecord
+from node.republisher import RepublishScheduler
+
+MY_GUID = "a" * 40
+
+
+class RecordStore(object):
+    """ The part of SqliteDataStore the scheduler uses """
+    def __init__(self):
+        self.records = {}
+        self.value_loads = []
+
+    def add(self, key, publisher, published):
+        self.records[key] = DataRecord(key, "value", published, published, publisher)
+
+    def getRecord(self, key, value=True):
+        record = self.records.get(key)
+        if record is not None and value:
+            self.value_loads.append(key)
+        return record
+
+    def iterRecords(self, values=True):
+        return iter(self.records.values())
+
+    def __delitem__(self, key):
+        del self.records[key]
+
+
+class TestRepublishScheduler(unittest.TestCase):
+    def setUp(self):
+        self.store = RecordStore()
+        self.sent = []
+        now = int(time.time())
+        for key in ("01", "02", "03"):
+            self.store.add(key, MY_GUID, now)
+        self.store.add("00", "b" * 40, now)
+
+    def scheduler(self, **kwargs):
+        return RepublishScheduler(self.store, MY_GUID,
+                                  lambda *args: self.sent.append(args),
+                                  1, io_loop=IOLoop(), **kwargs)
+
+    def test_due_keys_are_handled_in_slices(self):
+        scheduler = self.scheduler(slice_size=3, rate=1)
+        self.assertEqual(scheduler.pending(), 4)
+
+        scheduler.start()
+        scheduler._run()
+
+        # Only a slice of the due keys is handled per run
+        self.assertNotIn("00", self.store.records)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(scheduler.pending(), 1)
+
+        # Handled keys are not looked at again before the check interval
+        scheduler._last_refill -= 10
+        scheduler._run()
+        self.assertEqual(sorted(args[0] for args in self.sent), ["01", "02", "03"])
+        self.assertEqual(scheduler.pending(), 0)
+
+    def test_values_are_only_loaded_to_be_sent(self):
+        scheduler = self.scheduler()
+        self.assertEqual(self.store.value_loads, [])
+
+        scheduler.start()
+        scheduler._run()
+
+        # The expired record is removed without reading its value
+        self.assertNotIn("00", self.store.records)
+        self.assertEqual(sorted(self.store.value_loads), ["01", "02", "03"])
+
+    def test_new_records_wait_for_the_check_interval(self):
+        scheduler = self.scheduler()
+        scheduler.start()
+        scheduler._run()
+        del self.sent[:]
+
+        self.store.add("05", MY_GUID, int(time.time()))
+        scheduler.schedule("05")
+        scheduler._run()
+        self.assertEqual(self.sent, [])
+        self.assertEqual(scheduler.pending(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
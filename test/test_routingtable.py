@@ -0,0 +1,280 @@
+import json
+import os
+import sys
+import unittest
+
+from zmq.eventloop import ioloop, zmqstream
+import zmq
+
+# Add root directory of the project to our path in order to import routingtable
+dir_of_executable = os.path.dirname(__file__)
+path_to_project_root = os.path.abspath(os.path.join(dir_of_executable, '..'))
+sys.path.insert(0, path_to_project_root)
+from node.contact import ConnectionPool, Contact
+from node.p2p import PeerConnection
+from node.kbucket import KBucket
+from node.node_id import NodeID, distance
+from node import constants
+from node.routingtable import OptimizedTreeRoutingTable, RoutingTable
+
+MY_GUID = "0" * 40
+
+
+class TestNodeID(unittest.TestCase):
+    def test_forms(self):
+        guid = "0123456789abcdef0123456789abcdef01234567"
+        node = NodeID(guid)
+        self.assertEqual(node.value, 0x0123456789abcdef0123456789abcdef01234567)
+        self.assertEqual(node.hex, guid)
+
+        # Raw IDs, integers and other NodeIDs name the same node
+        self.assertEqual(NodeID(guid.decode('hex')), node)
+        self.assertEqual(NodeID(node.value), node)
+        self.assertEqual(NodeID(node), node)
+        self.assertEqual(len(set([node, NodeID(guid.upper())])), 1)
+
+    def test_distance(self):
+        one, two = "1" * 40, "3" * 40
+        self.assertEqual(distance(one, two), long("2" * 40, 16))
+        self.assertEqual(NodeID(one).distance(two), RoutingTable.distance(one, NodeID(two)))
+        self.assertEqual(distance(one, one), 0)
+
+        # Buckets compare the same values
+        bucket = KBucket(0, 2 ** 159)
+        self.assertTrue(bucket.keyInRange("7" + "f" * 39))
+        self.assertFalse(bucket.keyInRange("8" + "0" * 39))
+
+
+class TestRoutingTable(unittest.TestCase):
+    def test_contacts(self):
+        table = OptimizedTreeRoutingTable(MY_GUID, 1)
+        far = ["%x" % (8 + i % 8) + "%039x" % i for i in range(constants.k + 1)]
+        for guid in far:
+            table.addContact(Contact(guid, "127.0.0.1", 12345))
+
+        # A full bucket away from our ID is not split, extra contacts wait
+        # in the replacement cache
+        self.assertEqual(len(table._buckets), 2)
+        self.assertEqual(len(table._buckets[0]), constants.k)
+        self.assertIsNone(table.getContact(far[-1]))
+
+        # The bucket holding our ID was split once, by the first bit
+        self.assertEqual(table._kbucketIndex(far[0]), 0)
+        self.assertEqual(table._kbucketIndex("7" + "f" * 39), 1)
+        self.assertTrue(table._buckets[1].keyInRange(MY_GUID))
+
+        # Contacts seen again move to the tail of their bucket
+        moved = Contact(far[0], "127.0.0.1", 1)
+        table.addContact(moved)
+        self.assertIs(table.getContact(far[0]), moved)
+        self.assertIs(table._buckets[0].getContacts()[-1], moved)
+
+        # A removed contact makes way for one from the replacement cache
+        table.removeContact(far[0])
+        self.assertIsNone(table.getContact(far[0]))
+        self.assertIsNotNone(table.getContact(far[-1]))
+        self.assertEqual(len(table._buckets[0]), constants.k)
+
+    def test_replacement_cache(self):
+        table = OptimizedTreeRoutingTable(MY_GUID, 1)
+        far = ["%x" % (8 + i % 8) + "%039x" % i for i in range(constants.k + 3)]
+        for guid in far:
+            table.addContact(Contact(guid, "127.0.0.1", 12345))
+        self.assertEqual(list(table._replacementCache[0]), far[constants.k:])
+
+        # A contact that keeps failing to answer is replaced by the most
+        # recently seen replacement
+        for _ in range(constants.maxFailedRPCs):
+            table.contactFailed(far[0])
+        self.assertIsNone(table.getContact(far[0]))
+        self.assertIsNotNone(table.getContact(far[-1]))
+        self.assertEqual(len(table._buckets[0]), constants.k)
+
+        # Answering resets the count
+        table.contactFailed(far[1])
+        table.addContact(table.getContact(far[1]))
+        self.assertEqual(table.getContact(far[1]).failures, 0)
+
+        # With no replacements left, a stale contact makes way for the
+        # next new one
+        table.removeContact(far[constants.k + 1])
+        self.assertEqual(list(table._replacementCache[0]), [far[constants.k]])
+        table.removeContact(far[2])
+        self.assertEqual(len(table._replacementCache[0]), 0)
+        for _ in range(constants.maxFailedRPCs):
+            table.contactFailed(far[3])
+        self.assertIsNotNone(table.getContact(far[3]))
+        newcomer = "f" + "0" * 39
+        table.addContact(Contact(newcomer, "127.0.0.1", 12345))
+        self.assertIsNone(table.getContact(far[3]))
+        self.assertIsNotNone(table.getContact(newcomer))
+
+        # The cache is bounded
+        for i in range(constants.replacementCacheSize + 2):
+            table.addContact(Contact("e%039x" % i, "127.0.0.1", 12345))
+        self.assertEqual(len(table._replacementCache[0]), constants.replacementCacheSize)
+
+    def test_split(self):
+        table = OptimizedTreeRoutingTable(MY_GUID, 1)
+        near = ["%040x" % (1 << i) for i in range(constants.k + 1)]
+        for guid in near:
+            table.addContact(Contact(guid, "127.0.0.1", 12345))
+
+        # Buckets are split until the contacts fit, each holding the IDs
+        # sharing a given number of leading bits with ours
+        for guid in near:
+            contact = table.getContact(guid)
+            bucket = table._buckets[table._kbucketIndex(guid)]
+            self.assertIs(bucket.getContact(guid), contact)
+            self.assertTrue(bucket.keyInRange(guid))
+        self.assertEqual(sum(len(bucket) for bucket in table._buckets), len(near))
+
+    def test_find_close_nodes(self):
+        table = OptimizedTreeRoutingTable(MY_GUID, 1)
+        guids = ["%040x" % (i * 0x1234567 << 100) for i in range(1, 40)]
+        for guid in guids:
+            table.addContact(Contact(guid, "127.0.0.1", 12345))
+        guids = [guid for guid in guids if table.getContact(guid)]
+
+        # The exact closest contacts by XOR distance, closest first,
+        # whichever buckets they are in
+        key = "%040x" % (0x12345 << 120)
+        expected = sorted(guids, key=lambda guid: distance(guid, key))
+        closest = table.findCloseNodes(key, constants.k)
+        self.assertEqual([contact.guid for contact in closest], expected[:constants.k])
+
+        # The RPC sender is left out
+        closest = table.findCloseNodes(key, 3, expected[0])
+        self.assertEqual([contact.guid for contact in closest], expected[1:4])
+
+
+class Connection(object):
+    def __init__(self, contact):
+        self._guid = contact.guid
+        self._address = contact.uri
+        self._pub = contact.pubkey
+        self._nickname = contact.nickname
+        self.sent = []
+        self.closed = False
+
+    def send(self, data, callback):
+        self.sent.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class TestContact(unittest.TestCase):
+    def setUp(self):
+        self.made = []
+        self.pool = ConnectionPool(self.connect, 1, size=2)
+
+    def connect(self, contact):
+        self.made.append(Connection(contact))
+        return self.made[-1]
+
+    def test_record(self):
+        contact = self.pool.contact("1" * 40, "tcp://10.0.0.1:12345", "pubkey", "nick")
+        self.assertFalse(hasattr(contact, '__dict__'))
+        self.assertEqual((contact.ip, contact.port), ("10.0.0.1", 12345))
+        self.assertEqual(contact.toTuple(), ("10.0.0.1", 12345, "1" * 40, "nick"))
+        self.assertEqual(contact, "1" * 40)
+        self.assertEqual((contact._guid, contact._address, contact._pub, contact._nickname),
+                         ("1" * 40, "tcp://10.0.0.1:12345", "pubkey", "nick"))
+
+    def test_pool(self):
+        one, two, three = [self.pool.contact(str(i) * 40, "tcp://10.0.0.%s:12345" % i) for i in (1, 2, 3)]
+        self.assertEqual(self.made, [])
+
+        # Connections are made on the first send and reused after that
+        one.send({'type': 'ping'})
+        one.send({'type': 'ping'})
+        self.assertEqual(len(self.made), 1)
+        self.assertEqual(len(self.made[0].sent), 2)
+
+        # A contact that moved gets a new connection to its new address
+        one.uri = "tcp://10.0.0.9:12345"
+        one.send({'type': 'ping'})
+        self.assertEqual(len(self.made), 2)
+        self.assertTrue(self.made[0].closed)
+        self.assertEqual(self.made[1]._address, "tcp://10.0.0.9:12345")
+
+        # The least recently used connection is closed to make room
+        two.send({'type': 'ping'})
+        one.send({'type': 'ping'})
+        three.send({'type': 'ping'})
+        self.assertEqual(len(self.pool), 2)
+        self.assertTrue(self.made[2].closed)
+        self.assertFalse(self.made[1].closed)
+
+        # A connection made for a handshake is kept for the contact
+        handshake = Connection(self.pool.contact("4" * 40, "tcp://10.0.0.4:12345", "pubkey"))
+        contact = self.pool.adopt(handshake)
+        self.assertEqual(contact._pub, "pubkey")
+        contact.send({'type': 'ping'})
+        self.assertEqual(handshake.sent, [{'type': 'ping'}])
+        self.assertEqual(len(self.made), 4)
+
+        # Adopting a new connection for a pooled contact closes the old one
+        again = Connection(contact)
+        self.pool.adopt(again, contact)
+        self.assertTrue(handshake.closed)
+        self.pool.adopt(again, contact)
+        self.assertFalse(again.closed)
+
+
+class Transport(object):
+    _market_id = 1
+
+
+class TestPeerConnection(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = ioloop.IOLoop()
+        self.io_loop.make_current()
+        self.ctx = zmq.Context()
+        server = self.ctx.socket(zmq.REP)
+        self.uri = "tcp://127.0.0.1:%s" % server.bind_to_random_port("tcp://127.0.0.1")
+        self.server = zmqstream.ZMQStream(server, io_loop=self.io_loop)
+        self.server.on_recv(lambda msg: self.server.send(json.dumps({'type': 'pong'})))
+        self.pool = ConnectionPool(lambda contact: PeerConnection(Transport(), contact.uri), 1, size=1)
+
+    def tearDown(self):
+        self.ctx.destroy()
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+    def test_evicted_with_a_pending_send(self):
+        replies = []
+
+        def replied(msg):
+            replies.append(msg)
+            self.io_loop.stop()
+
+        one = self.pool.contact("1" * 40, self.uri)
+        one.send({'type': 'ping'}, replied)
+        connection = self.pool.connection(one)
+
+        # Pushed out of the pool before the reply comes in
+        two = self.pool.contact("2" * 40, "tcp://127.0.0.1:1")
+        two.send({'type': 'ping'})
+        self.assertEqual(len(self.pool), 1)
+        self.assertFalse(connection._ctx.closed)
+
+        # The reply still arrives, then the connection closes
+        self.io_loop.add_timeout(self.io_loop.time() + 5, self.io_loop.stop)
+        self.io_loop.start()
+        self.assertEqual([json.loads(msg[0]) for msg in replies], [{'type': 'pong'}])
+        self.assertTrue(connection._ctx.closed)
+
+        # One that never gets a reply closes after its timeout
+        other = self.pool.connection(two)
+        other._timeout = 0.1
+        self.pool.discard(two.guid)
+        self.assertFalse(other._ctx.closed)
+        self.io_loop.add_timeout(self.io_loop.time() + 1, self.io_loop.stop)
+        self.io_loop.start()
+        self.assertTrue(other._ctx.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()